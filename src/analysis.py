@@ -1,39 +1,319 @@
+import copy
+import itertools
+import metrics
+import numpy as np
+import os
 import pandas as pd
-from reddit_scraper import remove_brand_by_threshold
-from tqdm import tqdm
-from transformers import pipeline
+import stage_cache
+import threading
+import time
+from cascade import CascadeScorer, load_first_stage
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from data_fetcher import compact_layout, remove_brand_by_threshold
+from functools import partial
+from onnx_backend import OnnxSentimentTask
+from sentiment_cache import SentimentCache
+from sharded_inference import score_texts_sharded
 
-def analyse_sentiment(data):
+def analyse_sentiment(data, token_budget=16_384, max_length=512, cache=None, scorer=None, model_id=None, verbose=True):
     '''
     Analyze sentiment of comments using a pre-trained model from Hugging Face.
+    Every distinct (whitespace normalized) comment is scored once and the result is shared by all
+    rows containing it. With a cache, comments scored by the same model in earlier runs are skipped.
 
     :param data: DataFrame containing comments.
-    :return: DataFrame with sentiment analysis results.
+    :param token_budget: Maximum number of (padded) tokens per batch.
+    :param max_length: Number of tokens comments are truncated to.
+    :param cache: Optional SentimentCache shared between runs.
+    :param scorer: Optional function scoring a list of texts, e.g. a partial of sharded_inference.score_texts_sharded.
+                   Defaults to score_texts with the global sentiment_task.
+    :param model_id: String identifying the model in the cache, defaults to the path of the global sentiment_task.
+    :param verbose: If False, nothing is printed, e.g. for the many small batches of the scoring service.
+    :return: DataFrame with sentiment analysis results, 'sentiment' as categorical and 'score' as float32.
     '''
-    batch_size = 256
-    results = []
+    with metrics.stage('sentiment', rows_in=len(data)) as record:
+        # rows refer to distinct comments and those to distinct normalized texts, only the latter are scored
+        comment_ids, comments = pd.factorize(data['comment'], use_na_sentinel=False)
+        text_ids, unique_texts = pd.factorize(np.array([normalize_segment(comment) for comment in comments], dtype=object))
+        text_ids = text_ids[comment_ids]
+        unique_texts = unique_texts.tolist()
+        model_id = model_id or sentiment_task.model.name_or_path
+        scorer = scorer or (lambda batch: score_texts(batch, token_budget, max_length, verbose=verbose))
+        scored = cache.get_many(unique_texts, model_id) if cache else {}
+        to_score = [text for text in unique_texts if text not in scored]
+        if cache:
+            metrics.count('sentiment_cache_hits', len(scored))
+            metrics.count('sentiment_cache_misses', len(to_score))
+        if verbose:
+            print(f'{len(data)} rows, {len(unique_texts)} distinct texts, {len(unique_texts) - len(to_score)} cached')
 
-    for i in tqdm(range(0, len(data), batch_size)):
-        batch = data['comment'][i:i+batch_size].tolist()
-        batch_results = sentiment_task(batch)
-        results.extend(batch_results)
+        new_results = dict(zip(to_score, scorer(to_score)))
+        if cache:
+            cache.put_many(new_results, model_id)
+        scored.update(new_results)
+
+        labels = pd.Categorical([scored[text]['label'] for text in unique_texts])
+        analytics = pd.DataFrame(data)
+        analytics['sentiment'] = pd.Categorical.from_codes(labels.codes[text_ids], labels.categories)
+        analytics['score'] = np.array([scored[text]['score'] for text in unique_texts], dtype=np.float32)[text_ids]
+        record.rows_out = len(analytics)
 
-    analytics = pd.DataFrame(data)
-    analytics['sentiment'] = [result['label'] for result in results]
-    analytics['score'] = [result['score'] for result in results]
-    
     return analytics
 
 
-def filter_sentiment(data):
+def score_texts(texts, token_budget=16_384, max_length=512, prefetch=2, tokenizer_threads=1, window_size=8192,
+                verbose=True):
+    '''
+    Score texts with the sentiment model. Texts are batched by token length under a token budget,
+    so short texts aren't padded to the length of a long one. Upcoming windows of texts are tokenized
+    once and padded into batches in background threads while the model runs the current window.
+
+    :param texts: List of strings.
+    :param token_budget: Maximum number of (padded) tokens per batch.
+    :param max_length: Number of tokens texts are truncated to.
+    :param prefetch: Maximum number of tokenized windows waiting for the model.
+    :param tokenizer_threads: Number of tokenizer threads, each with its own copy of the tokenizer.
+    :param window_size: Number of consecutive texts sorted into batches together, bounds the memory of tokenized texts.
+    :param verbose: If False, the throughput and phase timings aren't printed.
+    :return: List of result dictionaries with 'label' and 'score', in the order of texts.
+    '''
+    if not texts:
+        return []
+    forward, label_names = model_phases(sentiment_task)
+    labels = np.empty(len(texts), dtype=np.int64)
+    scores = np.empty(len(texts), dtype=np.float64)
+    timings = {'tokenize': 0.0, 'wait': 0.0, 'forward': 0.0, 'decode': 0.0}
+    batch_count = 0
+    token_count = 0
+    local = threading.local()
+
+    def tokenize(window_start):
+        # fast tokenizers raise 'Already borrowed' when one instance is used by several threads
+        if not hasattr(local, 'tokenizer'):
+            local.tokenizer = copy.deepcopy(sentiment_task.tokenizer)
+        tokenize_start = time.perf_counter()
+        batches = encode_window(local.tokenizer, texts[window_start:window_start + window_size], token_budget, max_length)
+        return window_start, batches, time.perf_counter() - tokenize_start
+
+    start = time.perf_counter()
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=tokenizer_threads) as executor:
+        for window_start in itertools.chain(range(0, len(texts), window_size), [None]):
+            if window_start is not None:
+                pending.append(executor.submit(tokenize, window_start))
+            while pending and (window_start is None or len(pending) > prefetch):
+                phase_start = time.perf_counter()
+                offset, batches, seconds = pending.popleft().result()
+                timings['tokenize'] += seconds
+                timings['wait'] += time.perf_counter() - phase_start
+
+                for batch, inputs, tokens in batches:
+                    phase_start = time.perf_counter()
+                    logits = forward(inputs)
+                    timings['forward'] += time.perf_counter() - phase_start
+
+                    phase_start = time.perf_counter()
+                    labels[offset + batch], scores[offset + batch] = softmax_decode(logits)
+                    timings['decode'] += time.perf_counter() - phase_start
+                    batch_count += 1
+                    token_count += tokens
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    metrics.count('inference_batches', batch_count)
+    metrics.count('inference_texts', len(texts))
+    metrics.count('inference_tokens', token_count)
+    if verbose:
+        print(f'{len(texts) / elapsed:.1f} rows/s, {token_count / elapsed:.0f} tokens/s in {batch_count} batches '
+              f'({", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in timings.items())})')
+    return [{'label': label, 'score': score} for label, score in zip(label_names[labels].tolist(), scores.tolist())]
+
+
+def softmax_decode(logits):
+    '''
+    :param logits: Numpy array of shape (number of texts, number of labels).
+    :return: Tuple of numpy arrays with the index and the probability of the most likely label of every text.
+    '''
+    logits = logits.astype(np.float32)
+    probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probabilities /= probabilities.sum(axis=1, keepdims=True)
+    best = probabilities.argmax(axis=1)
+    return best, probabilities[np.arange(len(best)), best]
+
+
+def model_phases(task):
+    '''
+    Split a sentiment task into tokenization and forward pass, so both can run in different threads.
+
+    :param task: Sentiment task returned by load_sentiment_task.
+    :return: Tuple (forward, label_names). forward(inputs) takes the numpy arrays of pad_batch and returns a numpy
+             array of logits, label_names is a numpy array indexed by label id.
+    '''
+    if isinstance(task, OnnxSentimentTask):
+        config = task.model
+
+        def forward(inputs):
+            return task.forward({name: array for name, array in inputs.items() if name in task.input_names})
+    else:
+        import torch
+
+        config = task.model.config
+
+        def forward(inputs):
+            with torch.inference_mode():
+                return task.model(**{name: torch.from_numpy(array).to(task.device)
+                                     for name, array in inputs.items()}).logits.float().cpu().numpy()
+    label_names = np.array([config.id2label[i] for i in range(len(config.id2label))], dtype=object)
+    return forward, label_names
+
+
+def load_sentiment_task(model_path, backend='torch', onnx_dir=None, quantize=True, threads=None, max_length=512):
+    '''
+    Load the sentiment model with the selected inference backend.
+
+    :param model_path: Hugging Face model id or local directory.
+    :param backend: 'torch' for a transformers pipeline (on the GPU if there is one) or 'onnx' for ONNX Runtime on the CPU.
+    :param onnx_dir: Directory of the exported ONNX model, exported from model_path if it doesn't exist yet.
+    :param quantize: If True, the ONNX export is quantized to int8.
+    :param threads: Number of intra-op threads of ONNX Runtime, defaults to the number of cores.
+    :param max_length: Number of tokens comments are truncated to.
+    :return: Callable sentiment task with a 'tokenizer' and 'model' attribute.
+    '''
+    if backend == 'onnx':
+        return OnnxSentimentTask(ensure_onnx_export(model_path, onnx_dir, quantize), threads, max_length, quantize)
+    if backend == 'torch':
+        import torch
+        from transformers import pipeline
+
+        device = 0 if torch.cuda.is_available() else -1
+        return pipeline("sentiment-analysis", model=model_path, tokenizer=model_path, device=device, max_length=max_length, truncation=True)
+    raise ValueError(f'Unknown inference backend {backend}')
+
+
+def ensure_onnx_export(model_path, onnx_dir=None, quantize=True):
+    '''
+    Export the model to ONNX unless the file the quantize setting selects exists already.
+
+    :param model_path: Hugging Face model id or local directory.
+    :param onnx_dir: Directory of the exported ONNX model, defaults to default_onnx_dir.
+    :param quantize: If True, the export is quantized to int8.
+    :return: String path of the ONNX directory.
+    '''
+    from onnx_backend import export_onnx, onnx_model_file
+
+    onnx_dir = onnx_dir or default_onnx_dir(model_path, quantize)
+    if not os.path.exists(onnx_model_file(onnx_dir, quantize)):  # also a float only export
+        export_onnx(model_path, onnx_dir, quantize)
+    return onnx_dir
+
+
+def default_onnx_dir(model_path, quantize=True):
+    '''
+    :return: String path of the directory the ONNX export of a model is written to, one per quantize setting.
+    '''
+    return os.path.join('data', 'onnx', model_path.replace('/', '_') + ('_int8' if quantize else ''))
+
+
+def sentiment_model_id(model_path, backend='torch', onnx_dir=None, quantize=True):
+    '''
+    Identify the model as loaded by load_sentiment_task in the sentiment cache and the stage keys.
+    ONNX variants are told apart by the model file they run, so quantized and unquantized results aren't mixed.
+
+    :param model_path: Hugging Face model id or local directory.
+    :param backend: Inference backend, see load_sentiment_task.
+    :param onnx_dir: Directory of the exported ONNX model, see load_sentiment_task.
+    :param quantize: Whether the ONNX export is quantized to int8.
+    :return: String model id, e.g. 'cardiffnlp/twitter-roberta-base-sentiment-latest[torch]'.
+    '''
+    if backend != 'onnx':
+        return f'{model_path}[{backend}]'
+    from onnx_backend import onnx_model_file
+
+    return f'{model_path}[onnx:{onnx_model_file(onnx_dir or default_onnx_dir(model_path, quantize), quantize)}]'
+
+
+def normalize_segment(text):
+    '''
+    :param text: String of a comment segment.
+    :return: String with surrounding whitespace removed and inner whitespace collapsed.
+    '''
+    return ' '.join(text.split())
+
+
+def encode_window(tokenizer, texts, token_budget, max_length=512):
+    '''
+    Tokenize texts once and pad them into batches of similar length under a token budget.
+
+    :param tokenizer: Hugging Face tokenizer of the model.
+    :param texts: List of strings.
+    :param token_budget: Maximum number of (padded) tokens per batch.
+    :param max_length: Number of tokens texts are truncated to.
+    :return: List of (batch, inputs, tokens) tuples. batch is a numpy array of positions in texts,
+             inputs the model inputs of pad_batch and tokens the number of tokens without padding.
+    '''
+    input_ids = tokenizer(texts, truncation=True, max_length=max_length)['input_ids']
+    lengths = [len(ids) for ids in input_ids]
+    return [(np.array(batch), pad_batch([input_ids[i] for i in batch], tokenizer.pad_token_id, tokenizer.padding_side),
+             sum(lengths[i] for i in batch))
+            for batch in token_budget_batches(lengths, token_budget)]
+
+
+def pad_batch(input_ids, pad_token_id, padding_side='right'):
+    '''
+    Pad token ids to the longest row, like the tokenizer does with padding=True.
+
+    :param input_ids: List of lists of token ids.
+    :param pad_token_id: Id of the padding token.
+    :param padding_side: 'right' or 'left'.
+    :return: Dictionary with numpy arrays 'input_ids' and 'attention_mask' of dtype int64.
+    '''
+    width = max(len(ids) for ids in input_ids)
+    padded = np.full((len(input_ids), width), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(input_ids), width), dtype=np.int64)
+    for row, ids in enumerate(input_ids):
+        columns = slice(width - len(ids), width) if padding_side == 'left' else slice(0, len(ids))
+        padded[row, columns] = ids
+        attention_mask[row, columns] = 1
+    return {'input_ids': padded, 'attention_mask': attention_mask}
+
+
+def token_budget_batches(lengths, token_budget):
+    '''
+    Group texts of similar length into batches whose padded size stays within a token budget.
+    A single text longer than the budget gets a batch of its own.
+
+    :param lengths: List with the number of tokens of every text.
+    :param token_budget: Maximum of batch rows times the longest text in the batch.
+    :return: List of batches, each a list of row positions.
+    '''
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # rows are sorted by length, so the current row is the longest one of the batch
+        if batch and (len(batch) + 1) * lengths[i] > token_budget:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def filter_sentiment(data, remove_rare_brands=True):
     '''
     Filter sentiment analysis results based on score and neutrality.
 
     :param data: DataFrame with sentiment analysis results.
+    :param remove_rare_brands: If True, brands below the threshold of remove_brand_by_threshold are removed.
+                               Only meaningful on the whole corpus, not on a few scored comments.
     :return: Filtered DataFrame.
     '''
-    filtered = data[(data['score'] >= 0.500) & (data['sentiment'] != 'neutral')]
-    filtered = remove_brand_by_threshold(filtered)
+    with metrics.stage('filter', rows_in=len(data)) as record:
+        filtered = data[(data['score'] >= 0.500) & (data['sentiment'] != 'neutral')]
+        if remove_rare_brands:
+            filtered = remove_brand_by_threshold(filtered)
+        filtered = compact_layout(filtered)
+        record.rows_out = len(filtered)
     return filtered
 
 
@@ -42,10 +322,24 @@ if __name__ == '__main__':
 
     if RUNNABLE:
         model_path = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
-        sentiment_task = pipeline("sentiment-analysis", model=model_path, tokenizer=model_path, device=0, max_length=512, truncation=True)
-        
-        data = pd.read_json(r'data/segmented.json', orient='records', lines=True)
-        sentiment = analyse_sentiment(data)
+        backend = 'onnx'  # 'torch' on machines with a GPU
+        workers = 1  # more than one shards inference over processes, see sharded_inference.benchmark_splits
+        cascade_confidence = None  # e.g. 0.9 to only escalate uncertain segments, train the first stage with cascade.py
+        if workers > 1:
+            scorer = partial(score_texts_sharded, model_path=model_path, backend=backend, workers=workers)
+        else:
+            sentiment_task = load_sentiment_task(model_path, backend)
+            scorer = score_texts
+        model_id = sentiment_model_id(model_path, backend)
+        if cascade_confidence:
+            scorer = CascadeScorer(load_first_stage(r'data/cascade_first_stage.pkl'), scorer, cascade_confidence)
+            model_id += f'+cascade@{cascade_confidence}'
 
-        filtered = filter_sentiment(sentiment)
-        filtered.to_json(r'data/sentiment_filtered.json', orient='records', lines=True)
+        segmented_key = stage_cache.latest_key('segmented')
+        sentiment, sentiment_key = stage_cache.run_stage(
+            'sentiment', lambda: analyse_sentiment(stage_cache.load_artifact('segmented', segmented_key),
+                                                   cache=SentimentCache(r'data/sentiment_cache.sqlite'),
+                                                   scorer=scorer, model_id=model_id),
+            inputs=[segmented_key], params={'model_id': model_id, 'max_length': 512})
+        stage_cache.run_stage('sentiment_filtered', lambda: filter_sentiment(sentiment),
+                              inputs=[sentiment_key], params={'min_score': 0.5})
@@ -0,0 +1,244 @@
+import asyncio
+import httpx
+import json
+import metrics
+import pandas as pd
+import random
+import time
+from reddit_scraper import BASE_URL, HEADERS, comments_path, comments_to_df, listing_params, listing_path, posts_from_2024
+
+
+class TokenBucket:
+    '''
+    Asyncio rate limiter. Requests take a token each, tokens refill at a steady rate.
+    The rate follows Reddit's X-Ratelimit headers, spreading the remaining budget over
+    the time left until the rate limit window resets.
+    '''
+
+    def __init__(self, rate=10 / 60, capacity=5):
+        '''
+        :param rate: Tokens added per second until the first rate limit headers arrive.
+        :param capacity: Maximum number of tokens, i.e. the largest burst of requests.
+        '''
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        '''
+        Wait until a request may be sent and take a token.
+        '''
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                # wake up regularly, rate limit headers of running requests may change the rate
+                await asyncio.sleep(min((1 - self.tokens) / self.rate, 1.0))
+
+    def update_from_headers(self, headers):
+        '''
+        Adapt the rate to the X-Ratelimit-Remaining and X-Ratelimit-Reset headers of a response.
+
+        :param headers: Response headers.
+        '''
+        try:
+            remaining = float(headers['x-ratelimit-remaining'])
+            reset = float(headers['x-ratelimit-reset'])
+        except (KeyError, ValueError):
+            return
+        self._refill()
+        if remaining < 1:
+            self.tokens = 0
+            self.blocked_until = time.monotonic() + reset
+            return
+        self.rate = remaining / max(reset, 1)
+        self.tokens = min(self.tokens, remaining)
+
+    def block_for(self, seconds):
+        '''
+        Stop handing out tokens for some time, e.g. after a 429 response.
+
+        :param seconds: Number of seconds to block.
+        '''
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class AsyncRedditClient:
+    '''
+    Asynchronous Reddit JSON client sharing one pooled keep-alive connection and one rate limiter
+    across all requests. Failed requests are retried with exponential backoff.
+    Use it as async context manager.
+    '''
+
+    def __init__(self, base_url=BASE_URL, rate_limiter=None, max_connections=10, max_retries=5,
+                 backoff=2.0, timeout=30.0, cache=None):
+        '''
+        :param base_url: Url requests are sent to, can point to a local stand-in server.
+        :param rate_limiter: Optional TokenBucket, a default one is created otherwise.
+        :param max_connections: Maximum number of concurrent connections.
+        :param max_retries: Number of retries of a failed request before giving up.
+        :param backoff: Base delay in seconds, doubled for every retry.
+        :param timeout: Request timeout in seconds.
+        :param cache: Optional http_cache.ResponseCache serving and revalidating repeated requests.
+        '''
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter or TokenBucket()
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.client = None
+        self.requests = 0
+        self.retries = 0
+
+    async def __aenter__(self):
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        self.client = httpx.AsyncClient(base_url=self.base_url, headers=HEADERS, limits=limits, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+
+    async def get_json(self, path, params=None):
+        '''
+        Send a GET request respecting the rate limit and retrying on errors.
+        With a cache, fresh cached responses are returned without a request and stale ones are revalidated.
+
+        :param path: String path relative to the base url.
+        :param params: Optional dictionary of query parameters.
+        :return: Parsed JSON response.
+        '''
+        url = self.base_url + path
+        entry = self.cache.lookup(url, params) if self.cache else None
+        if entry is not None and self.cache.is_fresh(entry):
+            return json.loads(entry['body'])
+        headers = self.cache.conditional_headers(entry) if entry is not None else None
+
+        for attempt in range(self.max_retries + 1):
+            await self.rate_limiter.acquire()
+            self.requests += 1
+            metrics.count('http_requests')
+            delay = self.backoff * 2 ** attempt + random.random()  # jitter keeps retries apart
+            try:
+                response = await self.client.get(path, params=params, headers=headers)
+                self.rate_limiter.update_from_headers(response.headers)
+                if response.status_code == 304 and entry is not None:
+                    self.cache.mark_revalidated(entry)
+                    return json.loads(entry['body'])
+                if response.status_code == 429 or response.status_code >= 500:
+                    retry_after = response.headers.get('retry-after')
+                    if retry_after is not None and retry_after.replace('.', '', 1).isdigit():
+                        delay = max(delay, float(retry_after))
+                    self.rate_limiter.block_for(delay)
+                    raise httpx.HTTPStatusError(f'Status {response.status_code}', request=response.request,
+                                                response=response)
+                response.raise_for_status()
+                data = response.json()
+                if self.cache:
+                    self.cache.store(url, params, response)
+                return data
+            except (httpx.TransportError, httpx.HTTPStatusError) as error:
+                status = getattr(getattr(error, 'response', None), 'status_code', None)
+                if attempt == self.max_retries or (status is not None and status < 500 and status != 429):
+                    raise
+                self.retries += 1
+                metrics.count('http_retries')
+                print(f'Request to {path} failed ({error}), retrying in {delay:.1f}s')
+                await asyncio.sleep(delay)
+
+    async def get_posts_from_2024(self, endpoint, category='/hot', pages=10, onlyId=False):
+        '''
+        Async version of reddit_scraper.get_posts_from_2024. Listing pages depend on each other,
+        so they are fetched one after another.
+
+        :param endpoint: String representing the subreddit endpoint in the format '/r/subreddit_name'.
+        :param category: Optional string specifying the category of posts to retrieve.
+        :param pages: Number of listing pages of up to 100 posts.
+        :param onlyId: Optional boolean. If True, returns a DataFrame with only the post IDs.
+        :return: A pandas DataFrame containing the posts made in 2024 or None if nothing could be fetched.
+        '''
+        path = listing_path(endpoint, category)
+        dataset = []
+        last_after = None
+        for _ in range(pages):
+            try:
+                json_data = await self.get_json(path, listing_params(last_after))
+            except (httpx.HTTPError, ValueError) as error:
+                print(f'Failed to fetch posts of {endpoint}{category} :( ({error})')
+                break
+            dataset.extend([rec['data'] for rec in json_data['data']['children']])
+            last_after = json_data['data']['after']
+            if last_after is None:
+                break
+        print(f'Fetched {len(dataset)} posts of {endpoint}{category} :)')
+        return posts_from_2024(dataset, onlyId) if dataset else None
+
+    async def get_comments(self, post_id):
+        '''
+        Async version of reddit_scraper.get_comments.
+
+        :param post_id: String representing the unique identifier of the Reddit post.
+        :return: A pandas DataFrame containing subreddit and main comment body for each comment
+                 or None if the comments could not be fetched.
+        '''
+        try:
+            return comments_to_df(await self.get_json(comments_path(post_id)))
+        except (httpx.HTTPError, ValueError, KeyError, IndexError) as error:
+            print(f'Failed to fetch comments of {post_id} :( ({error})')
+            return None
+
+
+async def fetch_post_ids(client, endpoints, categories):
+    '''
+    Fetch the ids of all 2024 posts of several subreddit listings concurrently.
+
+    :param client: Open AsyncRedditClient.
+    :param endpoints: List of subreddit endpoints.
+    :param categories: List of listing categories.
+    :return: DataFrame with the unique post ids in listing order.
+    '''
+    listings = await asyncio.gather(*(client.get_posts_from_2024(endpoint, category, onlyId=True)
+                                      for endpoint in endpoints for category in categories))
+    listings = [listing for listing in listings if listing is not None]
+    if not listings:
+        return pd.DataFrame(columns=['id'])
+    return pd.concat(listings).drop_duplicates(subset='id').reset_index(drop=True)
+
+
+async def fetch_comments(client, post_ids, concurrency=10, on_result=None):
+    '''
+    Fetch the comments of many posts concurrently, bounded by the concurrency and the rate limiter.
+
+    :param client: Open AsyncRedditClient.
+    :param post_ids: List of post ids.
+    :param concurrency: Maximum number of posts fetched at the same time.
+    :param on_result: Optional function called with (post_id, comments) as soon as a post is fetched.
+                      If given, the comments are handed over instead of being collected.
+    :return: List of comment DataFrames (or None for failed posts) in the order of post_ids.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(post_id):
+        async with semaphore:
+            comments = await client.get_comments(post_id)
+        if on_result is None:
+            return comments
+        on_result(post_id, comments)
+        return None
+
+    return await asyncio.gather(*(fetch(post_id) for post_id in post_ids))
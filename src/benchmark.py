@@ -0,0 +1,394 @@
+import contextlib
+import io
+import json
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from data_fetcher import (compact_layout, normalize_text_column, normalize_unicode, preprocess_text,
+                          reformat_old_comments_to_df, remove_special_chars, remove_urls)
+
+BENCHMARK_DIR = 'data/benchmark'
+SIZES = (10_000, 1_000_000, 10_000_000)
+STAGES = ('prepare', 'segment', 'sentiment', 'prep_data')
+BRANDS = ['Argon 18', 'Bianchi', 'BMC', 'Cannondale', 'Canyon', 'Cervelo', 'Cinelli', 'Colnago', 'Cube', 'Giant',
+          'Merida', 'Orbea', 'Pinarello', 'Ridley', 'Rose', 'Scott', 'Specialized', 'Trek', 'Ventum', 'Wilier']
+NO_LOWERCASE = ['Cube', 'Giant', 'Rose']
+IMPORT_BUDGETS = {'cli': 0.3, 'stage_cache': 0.3, 'data_fetcher': 1.5, 'data_split': 1.5, 'analysis': 1.5,
+                  'visualization': 1.5, 'pipeline': 1.5, 'report': 1.5}  # seconds in a fresh interpreter
+HEAVY_MODULES = ('httpx', 'matplotlib', 'seaborn', 'torch', 'transformers')  # only imported where they are used
+SUBREDDITS = ['bicycling', 'cycling', 'RoadBikes']
+VOCABULARY = (
+    'the a to and I it of is that you for in my on with but this was have be just not so if like bike ride my '
+    'frame wheels gears carbon aluminium steel road gravel climb descent saddle bars tires tubeless disc brakes '
+    'groupset shimano sram ultegra 105 dura-ace stiff comfortable fast slow heavy light price shop warranty fit '
+    'size crash would really think pretty much better worse love hate great awful good bad new old buy bought '
+    'sold upgrade miles km watts cadence hill wind rain commute race crit century group ride they them mine '
+    'yours about after before because still also only than then there their what when which who why how'
+).split()
+UNICODE_NOISE = ['café', 'naïve', 'ﬁne', '“quoted”', '‘single’', '—', '…', '🚴', '👍', 'Ｂｉｋｅ', 'Ⅱ', 'µm', 'ß']
+URL_NOISE = ['https://www.reddit.com/r/cycling/comments/abc123/', 'http://imgur.com/a/XyZ12', 'www.bikeradar.com/reviews',
+             'https://www.youtube.com/watch?v=dQw4w9WgXcQ', '[link](https://www.strava.com/activities/123456)']
+
+
+def benchmark_normalization(texts, repeat=3):
+    '''
+    Compare the throughput of the original per-row normalization chain, the fused preprocess_text
+    and the vectorized normalize_text_column. Also checks that all of them produce exactly the same output.
+
+    :param texts: Series of comment texts.
+    :param repeat: Number of timed runs per variant, the fastest one is reported.
+    :return: Dictionary mapping the variant name to its throughput in comments per second.
+    '''
+    texts = texts.fillna('')
+    variants = {
+        'chained': lambda t: t.apply(lambda b: remove_special_chars(remove_urls(normalize_unicode(b)))),
+        'preprocess_text': lambda t: t.apply(lambda b: preprocess_text(b)),
+        'normalize_text_column': normalize_text_column,
+    }
+    try:
+        import pyarrow  # optional, enables the natively executed string column
+        variants['normalize_text_column[pyarrow]'] = lambda t: normalize_text_column(t.astype('string[pyarrow]'))
+    except ImportError:
+        pass
+
+    results = {}
+    outputs = {}
+    for name, variant in variants.items():
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs[name] = variant(texts)
+            best = min(best, time.perf_counter() - start)
+        results[name] = len(texts) / best
+        print(f'{name}: {results[name]:.0f} comments/s')
+
+    reference = outputs['chained'].tolist()
+    for name, output in outputs.items():
+        if output.tolist() != reference:
+            raise ValueError(f'{name} output differs from the chained normalization')
+    return results
+
+
+def iter_synthetic_comments(rows, seed=42, chunk_size=100_000):
+    '''
+    Generate a reproducible synthetic Reddit corpus. Comment lengths follow a heavy tailed lognormal
+    distribution, about 10% of the comments mention brands, a third of those several brands, and brand
+    names come with typos and case variants. Some comments carry unicode noise (ligatures, full width
+    letters, emoji, typographic quotes), URLs or are deleted.
+
+    :param rows: Number of comments.
+    :param seed: Seed of the random generator, the same seed always gives the same corpus.
+    :param chunk_size: Number of comments per DataFrame.
+    :return: Generator of DataFrames with columns 'subreddit', 'body', 'id' and 'created_utc'.
+    '''
+    rng = np.random.default_rng(seed)
+    brand_weights = 1 / np.arange(1, len(BRANDS) + 1)  # a few brands dominate like in the real data
+    brand_weights /= brand_weights.sum()
+    brand_order = rng.permutation(len(BRANDS))
+    vocabulary = np.array(VOCABULARY, dtype=object)
+    for start in range(0, rows, chunk_size):
+        size = min(chunk_size, rows - start)
+        lengths = np.clip(rng.lognormal(3.0, 1.0, size), 1, 2000).astype(int)
+        words = vocabulary[rng.integers(0, len(vocabulary), lengths.sum())]
+        stops = rng.random(lengths.sum()) < 0.08
+        words[stops] = words[stops] + rng.choice(np.array(['.', '?', '!', '...'], dtype=object), stops.sum())
+        brand_counts = np.where(rng.random(size) < 0.1, 1 + rng.binomial(3, 0.15, size), 0)
+        noise = rng.random((size, 3))
+        bodies = []
+        offset = 0
+        for i in range(size):
+            comment = list(words[offset:offset + lengths[i]])
+            offset += lengths[i]
+            for _ in range(brand_counts[i]):
+                brand = BRANDS[brand_order[rng.choice(len(BRANDS), p=brand_weights)]]
+                comment.insert(rng.integers(0, len(comment) + 1), _typo(brand, rng) if rng.random() < 0.15 else brand)
+            if noise[i, 0] < 0.05:
+                comment.insert(rng.integers(0, len(comment) + 1), UNICODE_NOISE[rng.integers(len(UNICODE_NOISE))])
+            if noise[i, 1] < 0.05:
+                comment.insert(rng.integers(0, len(comment) + 1), URL_NOISE[rng.integers(len(URL_NOISE))])
+            bodies.append('[deleted]' if noise[i, 2] < 0.02 else ' '.join(comment))
+        yield pd.DataFrame({
+            'subreddit': np.array(SUBREDDITS, dtype=object)[rng.integers(0, len(SUBREDDITS), size)],
+            'body': bodies,
+            'id': [np.base_repr(start + i, 36).lower() for i in range(size)],
+            'created_utc': 1_120_000_000 + (start + np.arange(size)) * 60
+        })
+
+
+def _typo(brand, rng):
+    position = int(rng.integers(0, len(brand)))
+    kind = rng.integers(0, 4)
+    if kind == 0 and position < len(brand) - 1:  # swap two letters
+        return brand[:position] + brand[position + 1] + brand[position] + brand[position + 2:]
+    if kind == 1 and len(brand) > 3:  # drop a letter
+        return brand[:position] + brand[position + 1:]
+    if kind == 2:  # double a letter
+        return brand[:position] + brand[position] + brand[position:]
+    return brand.lower()
+
+
+def synthetic_corpus_path(rows, seed=42):
+    '''
+    Write the synthetic corpus as Arrow IPC file unless it already exists.
+
+    :param rows: Number of comments.
+    :param seed: Seed of the random generator.
+    :return: String path of the corpus file.
+    '''
+    import pyarrow as pa
+
+    path = os.path.join(BENCHMARK_DIR, f'corpus-{rows}-{seed}.arrow')
+    if os.path.exists(path):
+        return path
+    os.makedirs(BENCHMARK_DIR, exist_ok=True)
+    writer = None
+    for batch in iter_synthetic_comments(rows, seed):
+        table = pa.Table.from_pandas(batch, preserve_index=False)
+        writer = writer or pa.ipc.new_file(path + '.tmp', table.schema)
+        writer.write_table(table)
+    writer.close()
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def iter_arrow_batches(path):
+    '''
+    :param path: String path of an Arrow IPC file.
+    :return: Generator of DataFrames, one per record batch, read from the memory-mapped file.
+    '''
+    for batch in _arrow_reader(path):
+        yield batch.to_pandas()
+
+
+def run_stage_isolated(stage, input_path, output_path, settings):
+    '''
+    Run one stage in a fresh process, so its peak memory isn't mixed up with other stages.
+
+    :param stage: Name of the stage, one of STAGES.
+    :param input_path: String path of the Arrow file with the stage input.
+    :param output_path: String path the stage output is written to, for the next stage.
+    :param settings: Dictionary with 'seed', 'workers', 'model_path' and 'backend'.
+    :return: Dictionary with rows in and out, wall and CPU seconds, throughput and peak RSS in MB.
+    '''
+    # not a multiprocessing.Pool, its daemonic workers can't start the processes of prepare_for_analysis
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(_stage_worker, stage, input_path, output_path, settings).result()
+
+
+def _stage_worker(stage, input_path, output_path, settings):
+    from pyarrow import feather
+
+    if stage == 'prepare':
+        from data_fetcher import prepare_for_analysis
+
+        data = iter_arrow_batches(input_path)
+        input_rows = sum(batch.num_rows for batch in _arrow_reader(input_path))
+        run = lambda: prepare_for_analysis(BRANDS, NO_LOWERCASE, data, workers=settings['workers'])
+    else:
+        data = feather.read_table(input_path, memory_map=True).to_pandas()
+        input_rows = len(data)
+        if stage == 'segment':
+            from data_split import keyword_based_segmentation
+
+            run = lambda: keyword_based_segmentation(data)
+        elif stage == 'sentiment':
+            import analysis
+
+            analysis.sentiment_task = analysis.load_sentiment_task(settings['model_path'], settings['backend'])
+            run = lambda: analysis.filter_sentiment(analysis.analyse_sentiment(data, verbose=False))
+        elif stage == 'prep_data':
+            from visualization import prep_data
+
+            if 'sentiment' not in data:  # without a model the labels are made up, prep_data only counts them
+                rng = np.random.default_rng(settings['seed'])
+                data['sentiment'] = np.where(rng.random(len(data)) < 0.6, 'positive', 'negative')
+            run = lambda: prep_data(data)
+        else:
+            raise ValueError(f'Unknown benchmark stage {stage}')
+
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):  # stages print whole tables
+        output = run()
+    seconds = time.perf_counter() - start
+    cpu_seconds = time.process_time() - cpu_start
+    result = {
+        'stage': stage,
+        'input_rows': input_rows,
+        'output_rows': len(output[0]) if isinstance(output, tuple) else len(output),
+        'seconds': seconds,
+        'cpu_seconds': cpu_seconds,
+        'rows_per_s': input_rows / max(seconds, 1e-9),
+        'peak_rss_mb': _peak_rss_mb('self'),
+        'children_peak_rss_mb': _peak_rss_mb('children')
+    }
+    if isinstance(output, pd.DataFrame):
+        result['output_mb'] = output.memory_usage(deep=True).sum() / 2 ** 20
+        output.reset_index(drop=True).to_feather(output_path)
+    return result
+
+
+def _arrow_reader(path):
+    import pyarrow as pa
+
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    return (reader.get_batch(i) for i in range(reader.num_record_batches))
+
+
+def _peak_rss_mb(who):
+    if who == 'self' and os.path.exists('/proc/self/status'):
+        # VmHWM starts fresh with the new process image, ru_maxrss on Linux keeps the peak of the parent it was forked from
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage / 1024 / 1024 if sys.platform == 'darwin' else usage / 1024  # bytes on macOS, kilobytes on Linux
+
+
+def run_benchmarks(sizes=SIZES, stages=STAGES, seed=42, workers=1, model_path=None, backend='onnx',
+                   results_path=os.path.join(BENCHMARK_DIR, 'results.json')):
+    '''
+    Run every stage on its own on synthetic corpora of the given sizes. Each stage runs in a fresh process
+    on the output of the previous stage. The sentiment stage is skipped without a model_path.
+
+    :param sizes: Numbers of comments of the synthetic corpora.
+    :param stages: Names of the stages to run, in pipeline order.
+    :param seed: Seed of the synthetic corpora.
+    :param workers: Number of processes of prepare_for_analysis.
+    :param model_path: Optional Hugging Face model id or local directory for the sentiment stage.
+    :param backend: Inference backend, see analysis.load_sentiment_task.
+    :param results_path: String path of the JSON results file.
+    :return: Dictionary with the machine description under 'meta' and one entry per stage and size under 'results'.
+    '''
+    settings = {'seed': seed, 'workers': workers, 'model_path': model_path, 'backend': backend}
+    results = []
+    for rows in sizes:
+        input_path = synthetic_corpus_path(rows, seed)
+        for stage in stages:
+            if stage == 'sentiment' and model_path is None:
+                print('Skipping the sentiment stage, no model given')
+                continue
+            output_path = os.path.join(BENCHMARK_DIR, f'{stage}-{rows}-{seed}.arrow')
+            result = run_stage_isolated(stage, input_path, output_path, settings)
+            result['rows'] = rows
+            results.append(result)
+            print(f'{stage} on {rows} comments: {result["rows_per_s"]:.0f} rows/s, {result["seconds"]:.1f}s, '
+                  f'peak RSS {result["peak_rss_mb"]} MB')
+            input_path = output_path
+
+    report = {
+        'meta': {'time': time.time(), 'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'seed': seed, 'workers': workers, 'model_path': model_path, 'backend': backend},
+        'results': results
+    }
+    os.makedirs(os.path.dirname(results_path) or '.', exist_ok=True)
+    with open(results_path, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2)
+    return report
+
+
+def compare_layouts(df):
+    '''
+    Measure a comment table in the layout of data_fetcher.compact_layout against the plain layout
+    the stages produced before, object columns of strings and float64 scores.
+
+    :param df: DataFrame of a stage output, e.g. loaded with stage_cache.load_artifact.
+    :return: Dictionary with the size of both layouts in MB and the fraction saved.
+    '''
+    compact = compact_layout(df)
+    plain = pd.DataFrame({column: values.astype(object) if isinstance(values.dtype, pd.CategoricalDtype)
+                          else values.astype('float64') if column == 'score' else values
+                          for column, values in df.items()})
+    # deep sizes count every string of an object column, like a table loaded from an artifact holds them
+    compact_mb = compact.memory_usage(deep=True).sum() / 2 ** 20
+    plain_mb = plain.memory_usage(deep=True).sum() / 2 ** 20
+    return {'rows': len(df), 'plain_mb': plain_mb, 'compact_mb': compact_mb, 'saved': 1 - compact_mb / max(plain_mb, 1e-9)}
+
+
+def check_import_times(budgets=IMPORT_BUDGETS, heavy_modules=HEAVY_MODULES, repeat=3):
+    '''
+    Import every module in a fresh interpreter and compare the fastest of a few imports with its budget.
+    Importing one of the heavy modules along the way is a violation as well, whatever the time.
+
+    :param budgets: Dictionary mapping module names to their import time budget in seconds.
+    :param heavy_modules: Names of modules that must only be imported inside the functions using them.
+    :param repeat: Number of imports per module, the fastest one is compared.
+    :return: List of strings describing every violation, empty if there is none.
+    '''
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    violations = []
+    for module, budget in budgets.items():
+        code = (f'import json, sys, time; start = time.perf_counter(); import {module}; '
+                f'print(json.dumps([time.perf_counter() - start, [m for m in {list(heavy_modules)!r} if m in sys.modules]]))')
+        runs = [json.loads(subprocess.run([sys.executable, '-c', code], cwd=source_dir, capture_output=True, text=True,
+                                          check=True).stdout.splitlines()[-1]) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        print(f'import {module}: {seconds:.2f}s (budget {budget:.2f}s)')
+        if seconds > budget:
+            violations.append(f'import {module} took {seconds:.2f}s, budget {budget:.2f}s')
+        if runs[0][1]:
+            violations.append(f'import {module} pulls in {", ".join(runs[0][1])}')
+    return violations
+
+
+def find_regressions(report, baseline_path, threshold=0.2):
+    '''
+    Compare benchmark results with a stored baseline of the same stages and sizes.
+
+    :param report: Dictionary returned by run_benchmarks.
+    :param baseline_path: String path of an earlier results file.
+    :param threshold: Allowed relative loss of throughput and growth of peak memory, 0.2 means 20%.
+    :return: List of strings describing every regression, empty if there is none.
+    '''
+    with open(baseline_path, 'r', encoding='utf-8') as file:
+        baseline = {(result['stage'], result['rows']): result for result in json.load(file)['results']}
+    regressions = []
+    for result in report['results']:
+        reference = baseline.get((result['stage'], result['rows']))
+        if reference is None:
+            continue
+        name = f'{result["stage"]} on {result["rows"]} comments'
+        if result['rows_per_s'] < reference['rows_per_s'] * (1 - threshold):
+            regressions.append(f'{name}: {result["rows_per_s"]:.0f} rows/s, baseline {reference["rows_per_s"]:.0f} rows/s')
+        if result['peak_rss_mb'] and reference['peak_rss_mb'] and \
+                result['peak_rss_mb'] > reference['peak_rss_mb'] * (1 + threshold):
+            regressions.append(f'{name}: peak RSS {result["peak_rss_mb"]:.0f} MB, baseline {reference["peak_rss_mb"]:.0f} MB')
+    return regressions
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        old_comments_df = reformat_old_comments_to_df()
+        benchmark_normalization(old_comments_df['body'])
+
+    MEASURE_LAYOUT = False  # memory of the compact layout on the stage outputs of the full corpus
+
+    if MEASURE_LAYOUT:
+        import stage_cache
+
+        for stage in ('filtered', 'segmented', 'sentiment', 'sentiment_filtered'):
+            print(f'{stage}: {compare_layouts(stage_cache.load_artifact(stage))}')
+
+    RUN_STAGES = False  # stage benchmarks on synthetic corpora, exits with 1 on regressions against the baseline
+
+    if RUN_STAGES:
+        baseline_path = os.path.join(BENCHMARK_DIR, 'baseline.json')  # copy a results file here to accept it
+        report = run_benchmarks(sizes=(10_000, 1_000_000), workers=os.cpu_count())
+        if os.path.exists(baseline_path):
+            regressions = find_regressions(report, baseline_path, threshold=0.2)
+            for regression in regressions:
+                print(f'Regression: {regression}')
+            sys.exit(1 if regressions else 0)
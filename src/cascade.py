@@ -0,0 +1,132 @@
+import metrics
+import numpy as np
+import pickle
+import time
+
+
+def train_first_stage(texts, full_scorer, n_features=2 ** 20):
+    '''
+    Train a cheap first-stage classifier (logistic regression on hashed word uni- and bigrams)
+    to imitate the full model. The training labels are the full model's predictions.
+
+    :param texts: List of strings used for training, a random sample of the segments.
+    :param full_scorer: Function scoring a list of texts with the full model.
+    :param n_features: Number of hashed features.
+    :return: Fitted scikit-learn pipeline with predict_proba.
+    '''
+    from sklearn.feature_extraction.text import HashingVectorizer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+
+    labels = [result['label'] for result in full_scorer(texts)]
+    vectorizer = HashingVectorizer(ngram_range=(1, 2), n_features=n_features, alternate_sign=False, norm='l2')
+    first_stage = make_pipeline(vectorizer, LogisticRegression(max_iter=1000, C=10.0))
+    first_stage.fit(texts, labels)
+    return first_stage
+
+
+def save_first_stage(first_stage, path):
+    with open(path, 'wb') as file:
+        pickle.dump(first_stage, file)
+
+
+def load_first_stage(path):
+    with open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+class CascadeScorer:
+    '''
+    Scores texts with the cheap first-stage classifier and only escalates the texts it is
+    unsure about to the full model. Usable as scorer of analysis.analyse_sentiment.
+    '''
+
+    def __init__(self, first_stage, full_scorer, confidence=0.9, verbose=True):
+        '''
+        :param first_stage: Classifier with predict_proba and classes_, see train_first_stage.
+        :param full_scorer: Function scoring a list of texts with the full model.
+        :param confidence: Minimum first-stage probability for a result to be kept without escalation.
+        :param verbose: If False, nothing is printed, e.g. when scoring many small batches.
+                        The escalations are counted in the metrics either way.
+        '''
+        self.first_stage = first_stage
+        self.full_scorer = full_scorer
+        self.confidence = confidence
+        self.verbose = verbose
+        self.scored = 0
+        self.escalated = 0
+
+    def __call__(self, texts):
+        '''
+        :param texts: List of strings.
+        :return: List of result dictionaries with 'label' and 'score', in the order of texts.
+        '''
+        if not texts:
+            return []
+        probabilities = self.first_stage.predict_proba(texts)
+        best = probabilities.argmax(axis=1)
+        scores = probabilities[np.arange(len(texts)), best]
+        results = [{'label': self.first_stage.classes_[label], 'score': float(score)} for label, score in zip(best, scores)]
+
+        uncertain = np.flatnonzero(scores < self.confidence)
+        if len(uncertain):
+            for i, result in zip(uncertain, self.full_scorer([texts[i] for i in uncertain])):
+                results[i] = result
+        self.scored += len(texts)
+        self.escalated += len(uncertain)
+        metrics.count('cascade_texts', len(texts))
+        metrics.count('cascade_escalated', len(uncertain))
+        if self.verbose:
+            print(f'Cascade escalated {len(uncertain)} of {len(texts)} texts to the full model')
+        return results
+
+    @property
+    def escalation_rate(self):
+        return self.escalated / max(self.scored, 1)
+
+
+def evaluate_cascade(first_stage, full_scorer, texts, confidence=0.9):
+    '''
+    Compare the cascade with the full model on held-out texts (not used for training).
+
+    :param first_stage: Classifier with predict_proba and classes_, see train_first_stage.
+    :param full_scorer: Function scoring a list of texts with the full model.
+    :param texts: List of held-out strings.
+    :param confidence: Minimum first-stage probability for a result to be kept without escalation.
+    :return: Dictionary with escalation rate, speedup and label agreement with the full model.
+    '''
+    start = time.perf_counter()
+    full_results = full_scorer(texts)
+    full_time = time.perf_counter() - start
+
+    cascade = CascadeScorer(first_stage, full_scorer, confidence)
+    start = time.perf_counter()
+    cascade_results = cascade(texts)
+    cascade_time = time.perf_counter() - start
+
+    agreement = np.mean([full['label'] == result['label'] for full, result in zip(full_results, cascade_results)])
+    report = {
+        'escalation_rate': cascade.escalation_rate,
+        'speedup': full_time / max(cascade_time, 1e-9),
+        'label_agreement': float(agreement)
+    }
+    print(f'Cascade on {len(texts)} texts with confidence {confidence}: {report}')
+    return report
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        import analysis
+        import stage_cache
+
+        model_path = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
+        analysis.sentiment_task = analysis.load_sentiment_task(model_path, 'onnx')
+        comments = stage_cache.load_artifact('segmented')['comment'].sample(60_000, random_state=42).tolist()
+        train_texts, held_out = comments[:50_000], comments[50_000:]
+
+        first_stage = train_first_stage(train_texts, analysis.score_texts)
+        save_first_stage(first_stage, r'data/cascade_first_stage.pkl')
+        for confidence in (0.8, 0.9, 0.95):
+            evaluate_cascade(first_stage, analysis.score_texts, held_out, confidence)
@@ -0,0 +1,207 @@
+import argparse
+import os
+import sys
+
+# heavy dependencies (pandas, rapidfuzz, httpx, transformers, matplotlib) are imported by the subcommands needing them,
+# so --help and light subcommands start fast. tests/test_import_budget.py guards this.
+
+BRANDS = ['Argon 18', 'Bianchi', 'BMC', 'Cannondale', 'Canyon', 'Cervelo', 'Cinelli', 'Colnago', 'Cube', 'Giant',
+          'Merida', 'Orbea', 'Pinarello', 'Ridley', 'Rose', 'Scott', 'Specialized', 'Trek', 'Ventum', 'Wilier']
+NO_LOWERCASE = ['Cube', 'Giant', 'Rose']  # found by testing
+SCRAPED_PATH = 'data/new_comments_temp.json'
+MODEL_PATH = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
+
+
+def ingest(args):
+    '''
+    Store the old comment dumps and the scraped comments as one 'comments' artifact, written batch by batch.
+    '''
+    import pandas as pd
+    import pyarrow as pa
+    import stage_cache
+    from data_fetcher import OLD_COMMENT_FILES, iter_chunks, iter_old_comments
+
+    columns = ['subreddit', 'body']
+    dump_paths = args.dumps or ['data/subreddits08-23/' + file_name for file_name in OLD_COMMENT_FILES]
+    scraped_paths = [args.scraped] if args.scraped and os.path.exists(args.scraped) else []
+
+    def batches():
+        yield from iter_old_comments(dump_paths, chunk_size=args.chunk_size, columns=columns, workers=args.workers)
+        for path in scraped_paths:
+            yield from iter_chunks(pd.read_json(path)[columns], args.chunk_size)
+
+    stage_cache.run_stage_batches('comments', batches,
+                                  inputs=[stage_cache.file_fingerprint(path) for path in dump_paths + scraped_paths],
+                                  params={'columns': columns},
+                                  schema=pa.schema([(column, pa.string()) for column in columns]))
+
+
+def scrape(args):
+    '''
+    Fetch the comments of the 2024 posts and save them for ingest.
+    '''
+    from data_fetcher import get_comments_from_2024
+
+    comments = get_comments_from_2024(concurrency=args.concurrency, cache_dir=None if args.no_cache else args.cache_dir)
+    comments.to_json(args.output)  # better safe than sorry
+    print(f'Saved {len(comments)} comments to {args.output}')
+
+
+def match(args):
+    '''
+    Find the brands in the ingested comments, see data_fetcher.prepare_for_analysis.
+    '''
+    import stage_cache
+    from data_fetcher import BRAND_THRESHOLD, prepare_for_analysis
+    from keyword_matcher import MIN_SCORE
+
+    comments_key = stage_cache.latest_key('comments')
+    stage_cache.run_stage(
+        'filtered',
+        lambda: prepare_for_analysis(args.brands, args.no_lowercase, stage_cache.iter_artifact('comments', comments_key),
+                                     match_cache_path=args.match_cache, workers=args.workers, chunk_size=args.chunk_size),
+        inputs=[comments_key],
+        params={'brands': args.brands, 'no_lowercase': args.no_lowercase, 'min_score': MIN_SCORE,
+                'threshold': BRAND_THRESHOLD})
+
+
+def segment(args):
+    '''
+    Cut the comments mentioning several brands into segments, see data_split.keyword_based_segmentation.
+    '''
+    import stage_cache
+    from data_split import keyword_based_segmentation
+
+    filtered_key = stage_cache.latest_key('filtered')
+    stage_cache.run_stage('segmented', lambda: keyword_based_segmentation(stage_cache.load_artifact('filtered', filtered_key)),
+                          inputs=[filtered_key], params={})
+
+
+def score(args):
+    '''
+    Score the segments with the sentiment model and filter the results, see analysis.analyse_sentiment.
+    '''
+    import analysis
+    import stage_cache
+    from functools import partial
+    from sentiment_cache import SentimentCache
+
+    if args.workers > 1:
+        from sharded_inference import score_texts_sharded
+
+        scorer = partial(score_texts_sharded, model_path=args.model, backend=args.backend, workers=args.workers,
+                         quantize=not args.no_quantize)
+    else:
+        analysis.sentiment_task = analysis.load_sentiment_task(args.model, args.backend, quantize=not args.no_quantize)
+        scorer = analysis.score_texts
+    model_id = analysis.sentiment_model_id(args.model, args.backend, quantize=not args.no_quantize)
+    if args.cascade:
+        from cascade import CascadeScorer, load_first_stage
+
+        scorer = CascadeScorer(load_first_stage(args.first_stage), scorer, args.cascade)
+        model_id += f'+cascade@{args.cascade}'
+
+    segmented_key = stage_cache.latest_key('segmented')
+    sentiment, sentiment_key = stage_cache.run_stage(
+        'sentiment', lambda: analysis.analyse_sentiment(stage_cache.load_artifact('segmented', segmented_key),
+                                                        cache=SentimentCache(args.cache), scorer=scorer, model_id=model_id),
+        inputs=[segmented_key], params={'model_id': model_id, 'max_length': 512})
+    stage_cache.run_stage('sentiment_filtered', lambda: analysis.filter_sentiment(sentiment),
+                          inputs=[sentiment_key], params={'min_score': 0.5})
+
+
+def report(args):
+    '''
+    Build the chart tables from the filtered sentiment once and render the charts to files, see report.render_report.
+    With --show the charts are shown in windows instead.
+    '''
+    import stage_cache
+    from visualization import prep_data
+
+    brand_df, sub_df, total = prep_data(stage_cache.load_artifact('sentiment_filtered'))
+    if args.show:
+        from visualization import vis_one, vis_three, vis_two
+
+        vis_one(brand_df, total)
+        vis_two(sub_df, total)
+        vis_three(brand_df, total)
+        return
+    from report import render_report
+
+    render_report(brand_df, sub_df, total, output_dir=args.output_dir, formats=args.formats, workers=args.workers,
+                  dpi=args.dpi, split_subreddits=not args.single_figure, force=args.force)
+
+
+def build_parser():
+    '''
+    :return: ArgumentParser with one subcommand per pipeline stage.
+    '''
+    parser = argparse.ArgumentParser(prog='cli.py', description='Sentiment analysis of bike brands on Reddit. '
+                                     'Stages read the latest output of the stage before them from data/stages.')
+    parser.add_argument('--metrics-log', help='append the metrics of every stage as JSON lines to this file')
+    parser.add_argument('--metrics-textfile', help='write the stage metrics as Prometheus textfile')
+    parser.add_argument('--profile-stage', help='run the stage of this name under cProfile, e.g. match or segment')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest_parser = subparsers.add_parser('ingest', help='store the comment dumps and scraped comments as one artifact')
+    ingest_parser.add_argument('--dumps', nargs='+', help='.ndjson dumps, defaults to the ones in data/subreddits08-23')
+    ingest_parser.add_argument('--scraped', default=SCRAPED_PATH, help='JSON file written by scrape, skipped if missing')
+    ingest_parser.add_argument('--chunk-size', type=int, default=100_000)
+    ingest_parser.add_argument('--workers', type=int, default=1, help='processes parsing each dump')
+    ingest_parser.set_defaults(run=ingest)
+
+    scrape_parser = subparsers.add_parser('scrape', help='fetch the comments of the 2024 posts from Reddit')
+    scrape_parser.add_argument('--output', default=SCRAPED_PATH)
+    scrape_parser.add_argument('--concurrency', type=int, default=10, help='posts fetched at the same time')
+    scrape_parser.add_argument('--cache-dir', default='data/http_cache')
+    scrape_parser.add_argument('--no-cache', action='store_true', help='disable the HTTP response cache')
+    scrape_parser.set_defaults(run=scrape)
+
+    match_parser = subparsers.add_parser('match', help='find the brands in the ingested comments')
+    match_parser.add_argument('--brands', nargs='+', default=BRANDS)
+    match_parser.add_argument('--no-lowercase', nargs='*', default=NO_LOWERCASE,
+                              help='brands dropped when matched in lowercase')
+    match_parser.add_argument('--match-cache', default='data/match_cache.json')
+    match_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    match_parser.add_argument('--chunk-size', type=int, default=50_000)
+    match_parser.set_defaults(run=match)
+
+    segment_parser = subparsers.add_parser('segment', help='cut comments mentioning several brands into segments')
+    segment_parser.set_defaults(run=segment)
+
+    score_parser = subparsers.add_parser('score', help='score the segments with the sentiment model')
+    score_parser.add_argument('--model', default=MODEL_PATH, help='Hugging Face model id or local directory')
+    score_parser.add_argument('--backend', choices=['onnx', 'torch'], default='onnx', help="'torch' on machines with a GPU")
+    score_parser.add_argument('--no-quantize', action='store_true', help='run the float ONNX export instead of the int8 one')
+    score_parser.add_argument('--workers', type=int, default=1, help='more than one shards inference over processes')
+    score_parser.add_argument('--cascade', type=float, help='confidence of the cascade first stage, e.g. 0.9')
+    score_parser.add_argument('--first-stage', default='data/cascade_first_stage.pkl')
+    score_parser.add_argument('--cache', default='data/sentiment_cache.sqlite')
+    score_parser.set_defaults(run=score)
+
+    report_parser = subparsers.add_parser('report', help='render the charts of the filtered sentiment to files')
+    report_parser.add_argument('--output-dir', default='data/report')
+    report_parser.add_argument('--formats', nargs='+', choices=['png', 'svg', 'pdf'], default=['png', 'svg'])
+    report_parser.add_argument('--workers', type=int, help='rendering processes, defaults to the number of cores')
+    report_parser.add_argument('--dpi', type=int, default=100)
+    report_parser.add_argument('--single-figure', action='store_true', help='all subreddits in one figure')
+    report_parser.add_argument('--force', action='store_true', help='render charts whose input is unchanged as well')
+    report_parser.add_argument('--show', action='store_true', help='show the charts in windows instead')
+    report_parser.set_defaults(run=report)
+    return parser
+
+
+def main(argv=None):
+    '''
+    :param argv: Optional list of arguments, defaults to sys.argv.
+    '''
+    args = build_parser().parse_args(argv)
+    if args.metrics_log or args.metrics_textfile or args.profile_stage:
+        import metrics
+
+        metrics.configure(log_path=args.metrics_log, textfile_path=args.metrics_textfile, profile_stage=args.profile_stage)
+    args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,65 +1,135 @@
+import asyncio
+import itertools
+import json
+import metrics
+import ndjson_reader
+import os
 import pandas as pd
-import random
 import re
-import reddit_scraper as reddit
+import stage_cache
 import time
 import unicodedata
-from rapidfuzz import fuzz
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from keyword_matcher import MIN_SCORE, KeywordMatcher
 
-def reformat_old_comments_to_df():
+BRAND_THRESHOLD = 100  # brands found less often than this are dropped
+MATCH_COLUMNS = ['subreddit', 'keyword', 'matched_word', 'comment']
+LABEL_COLUMNS = ['subreddit', 'keyword', 'matched_word', 'sentiment']  # few distinct values repeated on every row
+OLD_COMMENT_FILES = ['bicycling_comments.ndjson', 'cycling_comments.ndjson', 'roadBikes_comments.ndjson']
+
+
+def reformat_old_comments_to_df(workers=1):
     '''
     Reformat old comments from specified files into a single DataFrame.
     The comments are read from .ndjson files and concatenated into a unified DataFrame.
 
+    :param workers: Number of processes parsing each file.
     :return: DataFrame containing the reformatted comments with columns 'subreddit' and 'body'.
     '''
-    file_paths = ['bicycling_comments.ndjson', 'cycling_comments.ndjson', 'roadBikes_comments.ndjson']
-    all_comments_df = pd.DataFrame()
-
-    for file_path in file_paths:
-        df = pd.read_json('data/subreddits08-23/' + file_path, lines=True)
-        all_comments_df = pd.concat([all_comments_df, df], ignore_index=True)
-    
-    all_comments_df = all_comments_df[['subreddit', 'body']]
-    return all_comments_df
+    return pd.concat(iter_old_comments(workers=workers), ignore_index=True)
 
 
-def get_comments_from_2024():
+def iter_old_comments(file_paths=None, chunk_size=100_000, columns=('subreddit', 'body'), workers=1):
+    '''
+    Stream old comments from .ndjson files in batches of fixed size.
+    Only the requested fields are kept while parsing, so memory depends on the chunk size
+    instead of the size or number of files.
+
+    :param file_paths: Optional list of .ndjson paths, defaults to the downloaded subreddit dumps.
+    :param chunk_size: Maximum number of comments per batch.
+    :param columns: Fields to keep from every comment, missing fields become None.
+    :param workers: Number of processes parsing each file. With more than one, byte ranges of a file
+                    are parsed in parallel using a line index cached next to it.
+    :return: Generator of DataFrames with the requested columns.
+    '''
+    if file_paths is None:
+        file_paths = ['data/subreddits08-23/' + file_path for file_path in OLD_COMMENT_FILES]
+    if workers > 1:
+        for file_path in file_paths:
+            yield from ndjson_reader.iter_ndjson_parallel(file_path, columns, workers, chunk_size)
+        return
+
+    batch = {column: [] for column in columns}
+    size = 0
+    for file_path in file_paths:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                for column in columns:
+                    batch[column].append(record.get(column))
+                size += 1
+                if size == chunk_size:
+                    yield pd.DataFrame(batch)
+                    batch = {column: [] for column in columns}
+                    size = 0
+    if size:
+        yield pd.DataFrame(batch)
+
+
+def get_comments_from_2024(base_url=None, concurrency=10, journal_path=r'data/subreddits24/comments.journal',
+                           cache_dir=r'data/http_cache', ids_path=r'data/subreddits24/ids.json'):
     '''
     Retrieve comments from Reddit posts in specified subreddits for the year 2024.
     Due to Reddit endpoint limitations, only comments from up to 9000 posts can be fetched.
-
+    Listings and comments are fetched concurrently within Reddit's rate limit.
+    Fetched posts are appended to a journal, an interrupted scrape resumes with the posts still missing.
+    Once the comments are compacted, the journal and the post ids are archived, so the next call
+    scrapes the current posts again.
+
+    :param base_url: Optional url of the Reddit API, e.g. of a local stand-in server. Defaults to reddit_scraper.BASE_URL.
+    :param concurrency: Maximum number of posts whose comments are fetched at the same time.
+    :param journal_path: Path of the scrape journal.
+    :param cache_dir: Optional directory of the HTTP response cache, None disables caching.
+    :param ids_path: Path of the post ids of the current scrape, kept with the journal until it finished.
     :return: DataFrame containing the comments from the retrieved posts.
     '''
+    # the scraping modules pull in httpx, only the scrape imports them
+    from http_cache import ResponseCache
+    from reddit_scraper import BASE_URL
+    from scrape_journal import archive_journal, compact_journal
+
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    with metrics.stage('scrape') as record:
+        ids_list = asyncio.run(_get_comments_from_2024(base_url or BASE_URL, concurrency, journal_path, ids_path, cache))
+        comments = compact_journal(journal_path, ids_list)
+        # failed posts aren't retried by a later run, which scrapes the posts current by then
+        archive_journal(journal_path, [ids_path])
+        record.rows_in = len(ids_list)
+        record.rows_out = len(comments)
+    return comments
+
+
+async def _get_comments_from_2024(base_url, concurrency, journal_path, ids_path, cache):
+    from async_reddit import AsyncRedditClient, fetch_comments, fetch_post_ids
+    from scrape_journal import ScrapeJournal, archive_journal
+
     endpoints = ['/r/bicycling', '/r/cycling', '/r/RoadBikes']
     categories = ['/hot', '/new', 'top/?t=year']
-    all_post_ids = pd.DataFrame()
-    for endpoint in endpoints:
-        for category in categories:
-            current_post_ids = reddit.get_posts_from_2024(endpoint, category, onlyId=True)
-            all_post_ids = pd.concat([all_post_ids, current_post_ids]).reset_index(drop=True)
-            time.sleep(20)
-
-    all_post_ids = all_post_ids.drop_duplicates(subset='id').reset_index(drop=True)
-    all_post_ids.to_json(r'data/subreddits24/ids.json')
-
-    time.sleep(120)  # snoozing time, wait before starting to fetch comments
-
-    ids_list = all_post_ids['id'].tolist()
-    all_comments_df = pd.DataFrame()
-    for number, id in enumerate(ids_list):
-        if number % 5 == 0:
-            time.sleep(30)
-        comments = reddit.get_comments(id)
-        all_comments_df = pd.concat([all_comments_df, comments]).reset_index(drop=True)
-        if number % 25 == 0:
-            all_comments_df.to_json(r'data/subreddits24/new_comments_temp.json')
-        sleeptime = float(random.randrange(0, 2))  # random sleeptime to be less suspicious
-        time.sleep(sleeptime)
-    return all_comments_df
-
-
-def prepare_for_analysis(keywords_to_include, no_lowercase_keywords, dataframe_to_filter):
+    async with AsyncRedditClient(base_url, cache=cache) as client:
+        # finished scrapes are archived, both files left over means the last run was interrupted
+        if os.path.exists(journal_path) and os.path.exists(ids_path):
+            all_post_ids = pd.read_json(ids_path)  # resume the interrupted scrape with the same posts
+        else:
+            archive_journal(journal_path)  # a journal without its post ids belongs to no resumable run
+            all_post_ids = await fetch_post_ids(client, endpoints, categories)
+            all_post_ids.to_json(ids_path)
+        ids_list = all_post_ids['id'].tolist()
+
+        with ScrapeJournal(journal_path) as journal:
+            missing_ids = [post_id for post_id in ids_list if post_id not in journal.completed]
+            print(f'{len(ids_list) - len(missing_ids)} of {len(ids_list)} posts already fetched')
+            await fetch_comments(client, missing_ids, concurrency, on_result=journal.append)
+    print(f'Sent {client.requests} requests, {client.retries} of them retries')
+    if cache:
+        print(f'Response cache: {cache.stats()}')
+    return ids_list
+
+
+def prepare_for_analysis(keywords_to_include, no_lowercase_keywords, dataframe_to_filter, match_cache_path=None,
+                         workers=1, chunk_size=50_000):
     '''
     Filter comments in a DataFrame to include only those mentioning specific keywords.
     This process also normalizes unicode characters and removes URLs from the comments.
@@ -67,33 +137,186 @@ def prepare_for_analysis(keywords_to_include, no_lowercase_keywords, dataframe_t
     Comments of Keywords which are found less than 100 times are removed.
 
     :param keywords_to_include: List of keywords to search for in the comments.
-    :param dataframe_to_filter: DataFrame containing the comments to be filtered.
+    :param dataframe_to_filter: DataFrame containing the comments to be filtered, or an iterable of such
+                                DataFrames (e.g. from iter_old_comments) which is consumed batch by batch.
                                 Must have columns 'body' and 'subreddit'.
+    :param match_cache_path: Optional path of a fuzzy match cache, loaded before and saved after matching.
+    :param workers: Number of processes used for preprocessing and matching. 1 runs everything in this process.
+    :param chunk_size: Number of comments handed to a worker at once.
     :return: DataFrame with rows representing comments that mention at least one of the keywords.
-             Columns include 'subreddit', 'keyword', 'matched_word', and 'comment'.
+             Columns include 'subreddit', 'keyword', 'matched_word', and 'comment', in the layout of compact_layout.
     '''
-    df = dataframe_to_filter.copy()
-    df['body'].fillna('', inplace=True)
-    df['body'] = df['body'].apply(lambda b: preprocess_text(b))
-  
+    with metrics.stage('match', rows_in=0) as record:
+        chunks = _count_rows(iter_chunks(dataframe_to_filter, chunk_size), record)
+        if workers > 1:
+            all_matches = match_comments_parallel(keywords_to_include, chunks, match_cache_path, workers, chunk_size)
+        else:
+            matcher = KeywordMatcher(keywords_to_include)
+            if match_cache_path:
+                matcher.load(match_cache_path)
+            all_matches = {column: [] for column in MATCH_COLUMNS}
+            for chunk in chunks:
+                _extend_matches(all_matches, match_comments(chunk, keywords_to_include, matcher))
+            print(f'Match cache: {matcher.hits} hits, {matcher.misses} misses, {matcher.scored_pairs} fuzzy comparisons')
+            _count_matcher(matcher.hits, matcher.misses, matcher.scored_pairs)
+            if match_cache_path:
+                matcher.save(match_cache_path)
+
+        match_df = matches_to_df(all_matches)
+        cleared_df = clear_of_lowercase(match_df, no_lowercase_keywords)
+        threshed_df = remove_brand_by_threshold(cleared_df)
+        return_df = compact_layout(threshed_df)  # also drops the comments of removed rows from the string table
+        return_df['multiple'] = return_df['comment'].duplicated(keep=False)
+        record.rows_out = len(return_df)
+
+    return return_df
+
+
+def _count_rows(chunks, record):
+    for chunk in chunks:
+        record.rows_in += len(chunk)
+        yield chunk
+
+
+def _extend_matches(all_matches, matches):
+    for column in MATCH_COLUMNS:
+        all_matches[column].extend(matches[column])
+
+
+def _count_matcher(hits, misses, scored_pairs):
+    metrics.count('match_cache_hits', hits)
+    metrics.count('match_cache_misses', misses)
+    metrics.count('fuzzy_comparisons', scored_pairs)
+
+
+def match_comments(dataframe_to_filter, keywords_to_include, matcher=None):
+    '''
+    Preprocess comments and collect one match for every keyword found in them.
+
+    :param dataframe_to_filter: DataFrame with columns 'body' and 'subreddit'.
+    :param keywords_to_include: List of keywords to search for in the comments.
+    :param matcher: Optional KeywordMatcher built for keywords_to_include.
+    :return: Dictionary of lists with the MATCH_COLUMNS, one entry for every keyword found, in comment order.
+             Turned into a DataFrame by matches_to_df.
+    '''
+    if matcher is None:
+        matcher = KeywordMatcher(keywords_to_include)
+    bodies = normalize_text_column(dataframe_to_filter['body'])
+
     # filter comments that mention any of the specified keywords
     # if multiple keywords are found, comments are returned multiple times with a different keyword each time
-    all_matches = []
-    for _, row in df.iterrows():
-        comment = row['body']
-        subreddit = row['subreddit']
-        matches = contains_keyword(subreddit, comment, keywords_to_include.copy())
-        all_matches.extend(matches)
-    match_df = pd.DataFrame(all_matches)
-    cleared_df = clear_of_lowercase(match_df, no_lowercase_keywords)
-    threshed_df = remove_brand_by_threshold(cleared_df)
-    return_df = threshed_df
-    comment_counts = return_df['comment'].value_counts()
-    return_df['multiple'] = return_df['comment'].apply(lambda x: comment_counts[x] > 1)
+    # matches are appended to columns instead of one dictionary each, the rows of a comment share its string
+    all_matches = {column: [] for column in MATCH_COLUMNS}
+    subreddits, keywords, matched_words, comments = (all_matches[column] for column in MATCH_COLUMNS)
+    for subreddit, comment in zip(dataframe_to_filter['subreddit'], bodies):
+        for keyword, matched_word in matcher.find_keywords(comment):
+            subreddits.append(subreddit)
+            keywords.append(keyword)
+            matched_words.append(matched_word)
+            comments.append(comment)
+    return all_matches
+
+
+def matches_to_df(matches):
+    '''
+    :param matches: Dictionary of match columns as returned by match_comments.
+    :return: DataFrame with the MATCH_COLUMNS in the layout of compact_layout.
+    '''
+    return compact_layout(pd.DataFrame(matches, columns=MATCH_COLUMNS))
+
+
+def match_comments_parallel(keywords_to_include, dataframe_to_filter, match_cache_path=None, workers=4, chunk_size=50_000):
+    '''
+    Run match_comments over chunks of the DataFrame in a pool of worker processes.
+    Results are merged in chunk order, so the output equals a single-process run.
+    Only a few chunks per worker are in flight at once, so batches are read lazily.
+    The tokens newly scored by the workers are merged into one cache, which is saved at the end.
+
+    :param keywords_to_include: List of keywords to search for in the comments.
+    :param dataframe_to_filter: DataFrame or iterable of DataFrames with columns 'body' and 'subreddit'.
+    :param match_cache_path: Optional path of a fuzzy match cache every worker starts from, saved after matching.
+    :param workers: Number of worker processes.
+    :param chunk_size: Number of comments per chunk.
+    :return: Dictionary of match columns as returned by match_comments, in comment order.
+    '''
+    chunks = (chunk[['subreddit', 'body']] for chunk in iter_chunks(dataframe_to_filter, chunk_size))
+    matcher = None
+    if match_cache_path:
+        matcher = KeywordMatcher(keywords_to_include)
+        matcher.load(match_cache_path)
+    all_matches = {column: [] for column in MATCH_COLUMNS}
+    worker_stats = {}  # pid -> [rows, seconds]
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_match_worker,
+                             initargs=(keywords_to_include, match_cache_path)) as executor:
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                pending.append(executor.submit(_match_chunk, chunk))
+            # collect finished chunks in order, keep at most two chunks per worker queued
+            while pending and (chunk is None or len(pending) >= 2 * workers):
+                matches, pid, rows, seconds, matcher_counts, new_entries = pending.popleft().result()
+                _extend_matches(all_matches, matches)
+                _count_matcher(*matcher_counts)
+                if matcher:
+                    matcher.update(new_entries.items())
+                stats = worker_stats.setdefault(pid, [0, 0.0])
+                stats[0] += rows
+                stats[1] += seconds
+
+    for pid, (rows, seconds) in sorted(worker_stats.items()):
+        print(f'Worker {pid}: {rows} comments in {seconds:.1f}s ({rows / max(seconds, 1e-9):.0f} comments/s)')
+    if matcher:
+        matcher.save(match_cache_path)
+    return all_matches
+
+
+def iter_chunks(data, chunk_size):
+    '''
+    Split a DataFrame or an iterable of DataFrames into chunks of at most chunk_size rows.
+
+    :param data: DataFrame or iterable of DataFrames.
+    :param chunk_size: Maximum number of rows per chunk.
+    :return: Generator of DataFrames.
+    '''
+    batches = [data] if isinstance(data, pd.DataFrame) else data
+    for batch in batches:
+        for start in range(0, len(batch), chunk_size):
+            yield batch.iloc[start:start + chunk_size]
+
+
+_worker_keywords = None
+_worker_matcher = None
+
+def _init_match_worker(keywords_to_include, match_cache_path):
+    global _worker_keywords, _worker_matcher
+    _worker_keywords = keywords_to_include
+    _worker_matcher = KeywordMatcher(keywords_to_include, track_new_entries=bool(match_cache_path))
+    if match_cache_path:
+        _worker_matcher.load(match_cache_path)
+
+
+def _match_chunk(chunk):
+    start = time.perf_counter()
+    before = (_worker_matcher.hits, _worker_matcher.misses, _worker_matcher.scored_pairs)
+    matches = match_comments(chunk, _worker_keywords, _worker_matcher)
+    # counters of the worker process are lost, the parent counts what this chunk added
+    matcher_counts = (_worker_matcher.hits - before[0], _worker_matcher.misses - before[1],
+                      _worker_matcher.scored_pairs - before[2])
+    # tokens scored in this chunk go back to the parent for the cache on disk
+    new_entries = _worker_matcher.take_new_entries() if _worker_matcher.new_entries is not None else {}
+    return matches, os.getpid(), len(chunk), time.perf_counter() - start, matcher_counts, new_entries
 
-    return return_df
 
 # --- helper functions --- 
+# python's \s for ascii text, spelled out so pyarrow's regex engine matches the same characters
+ASCII_WHITESPACE = r'\t\n\x0b\x0c\r\x1c-\x1f '
+URL_PATTERN = r'http[^' + ASCII_WHITESPACE + r']+'
+# literal '\n', '\r', '/' and whitespace all end up as a single space
+SEPARATOR_PATTERN = r'(?:[' + ASCII_WHITESPACE + r'/]|\\[nr])+'
+URL_REGEX = re.compile(URL_PATTERN)
+SEPARATOR_REGEX = re.compile(SEPARATOR_PATTERN)
+
+
 def preprocess_text(text):
     '''
     Preprocess text by normalizing unicode characters, removing URLs, and cleaning up special characters.
@@ -101,12 +324,31 @@ def preprocess_text(text):
     :param text: String containing the text to be preprocessed.
     :return: String with the text preprocessed.
     '''
-    text = normalize_unicode(text)
-    text = remove_urls(text)
-    text = remove_special_chars(text)
+    if not text.isascii():
+        text = normalize_unicode(text)
+    text = URL_REGEX.sub('', text)
+    text = SEPARATOR_REGEX.sub(' ', text)
     return text
 
 
+def normalize_text_column(texts):
+    '''
+    Preprocess a whole column of texts at once, equal to applying preprocess_text to every row.
+    Unicode normalization is skipped for pure ASCII texts and the regex passes run as vectorized
+    string operations, which pyarrow backed string columns execute natively.
+
+    :param texts: Series of strings, missing values are treated as empty strings.
+    :return: Series with the texts preprocessed.
+    '''
+    texts = texts.fillna('')
+    is_ascii = texts.map(str.isascii).astype(bool)
+    if not is_ascii.all():
+        texts = texts.where(is_ascii, texts[~is_ascii].map(normalize_unicode))
+    texts = texts.str.replace(URL_PATTERN, '', regex=True)
+    texts = texts.str.replace(SEPARATOR_PATTERN, ' ', regex=True)
+    return texts
+
+
 def normalize_unicode(text):
     '''
     Normalize unicode characters in a given text to ASCII.
@@ -141,41 +383,23 @@ def remove_special_chars(text):
     return text
 
 
-def contains_keyword(subreddit, comment, keywords):
+def contains_keyword(subreddit, comment, keywords, matcher=None):
     '''
-    Recursively searches for all keywords in a given comment.
+    Searches for all keywords in a given comment in a single pass.
     Allows for typos and is not case-sensitive.
 
     :param subreddit: String representing the subreddit the comment is taken from.
     :param comment: String to be parsed for keywords.
     :param keywords: List of keywords to search for.
+    :param matcher: Optional KeywordMatcher built for keywords, reused to cache scores across comments.
     :return: List of dictionaries in JSON-like format with the shape 
              [{'subreddit': subreddit, 'keyword': keyword, 'matched_word': matched_word, 'comment': comment}]. 
              One dictionary for each keyword found.
     '''
-    MIN_SCORE = 85
-    words = comment.lower().split()
-    best_score = 0
-    best_match = None
-    matched_word = None
-
-    for keyword in keywords:
-        for word in words:
-            score = fuzz.ratio(word, keyword.lower())
-            if score > MIN_SCORE and score > best_score:
-                best_score = score
-                best_match = keyword
-                matched_word = word
-    
-    if best_match:
-        keywords.remove(best_match) 
-        # recursively call contains_keyword to find the second match
-        second_match = contains_keyword(subreddit, comment, keywords)
-        match_data = [{'subreddit': subreddit, 'keyword': best_match, 'matched_word': matched_word, 'comment': comment}]
-        if second_match:
-            match_data.extend(second_match)
-        return match_data
-    return []
+    if matcher is None:
+        matcher = KeywordMatcher(keywords)
+    return [{'subreddit': subreddit, 'keyword': keyword, 'matched_word': matched_word, 'comment': comment}
+            for keyword, matched_word in matcher.find_keywords(comment)]
 
 
 def clear_of_lowercase(df, keywords):
@@ -187,14 +411,9 @@ def clear_of_lowercase(df, keywords):
     :param keywords: List of keywords to check
     :return: DataFrame with specified rows removed
     '''
-    indices_to_drop = []
-
-    for idx, row in df.iterrows():
-        if row['keyword'] in keywords and row['matched_word'] in row['comment']: 
-            indices_to_drop.append(idx)
-
-    df = df.drop(indices_to_drop).reset_index(drop=True)
-    return df
+    to_drop = pd.Series([keyword in keywords and matched_word in comment for keyword, matched_word, comment
+                         in zip(df['keyword'], df['matched_word'], df['comment'])], index=df.index, dtype=bool)
+    return df[~to_drop].reset_index(drop=True)
 
 
 def remove_brand_by_threshold(df):
@@ -204,14 +423,48 @@ def remove_brand_by_threshold(df):
     :param df: DataFrame with columns 'keyword', 'matched_word', and 'comment'
     :return: DataFrame with rows of infrequent keywords removed
     '''
-    THRESHOLD = 100
-    counts = df['keyword'].value_counts()
-    rare_brands = counts[counts < THRESHOLD].index
+    keyword_counts = df['keyword'].value_counts()
+    rare_brands = find_rare_brands(keyword_counts[keyword_counts > 0])  # categoricals also count removed keywords
     print(f'Deleted brands: {rare_brands.tolist()}')
+    metrics.count('deleted_brands', len(rare_brands))
     filtered_df = df[~df['keyword'].isin(rare_brands)]
     return filtered_df
 
 
+def find_rare_brands(keyword_counts):
+    '''
+    :param keyword_counts: Series with the number of rows per keyword, e.g. aggregated over many batches.
+    :return: Index of the keywords found fewer than BRAND_THRESHOLD times.
+    '''
+    return keyword_counts[keyword_counts < BRAND_THRESHOLD].index
+
+
+def compact_layout(df):
+    '''
+    Store a table of comments compactly. Every distinct comment is kept once in a string table,
+    the categories of a categorical column, and rows refer to it by an integer code. Labels
+    repeated on every row become categoricals as well and scores become float32.
+    All stages accept tables with or without this layout.
+
+    :param df: DataFrame with some of the columns 'subreddit', 'keyword', 'matched_word', 'comment', 'sentiment' and 'score'.
+    :return: DataFrame with the same values in the compact layout, unused categories removed.
+    '''
+    columns = {}
+    for column, values in df.items():
+        if column == 'comment' and not isinstance(values.dtype, pd.CategoricalDtype):
+            # factorize keeps the order of appearance, sorting millions of comments would only cost time
+            codes, uniques = pd.factorize(values)
+            values = pd.Series(pd.Categorical.from_codes(codes, uniques), index=values.index)
+        elif column in LABEL_COLUMNS and not isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype('category')  # sorted categories, sorting by them stays alphabetical
+        elif column == 'score':
+            values = values.astype('float32')
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.cat.remove_unused_categories()
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
 def calculate_percentage_with_brands(filtered_df, brands):
     '''
     Calculate the percentage of comments that mention any of the specified brands.
@@ -246,12 +499,19 @@ if __name__ == '__main__':
         
         no_lowercase = ['Cube', 'Giant', 'Rose']  # found by testing
         # load and save Reddit comments from June 2005 to June 2024
-        old_comments_df = reformat_old_comments_to_df()
-        old_comments_df.to_json(r'data/old_comments.json')  # better safe than sorry
-        new_comments_df = get_comments_from_2024()
-        new_comments_df.to_json(r'data/new_comments_temp.json')  # better safe than sorry
-        combined_df = pd.concat([old_comments_df, new_comments_df], ignore_index=True)
-        filtered_df = prepare_for_analysis(brands, no_lowercase, combined_df)
-        filtered_df.to_json(r'data/filtered.json', orient='records', lines=True)
+        scraped_path = r'data/new_comments_temp.json'
+        # the scrape is its own step, delete the file to scrape again. A new scrape always changes its fingerprint,
+        # so scraping on every run would never let the filtered stage below be up to date
+        if not os.path.exists(scraped_path):
+            get_comments_from_2024().to_json(scraped_path)  # better safe than sorry
+        # old comments are streamed from the dumps batch by batch
+        comment_batches = itertools.chain(iter_old_comments(), [pd.read_json(scraped_path)])
+        input_files = ['data/subreddits08-23/' + file_path for file_path in OLD_COMMENT_FILES] + [scraped_path]
+        filtered_df, _ = stage_cache.run_stage(
+            'filtered',
+            lambda: prepare_for_analysis(brands, no_lowercase, comment_batches, match_cache_path=r'data/match_cache.json',
+                                         workers=os.cpu_count()),
+            inputs=[stage_cache.file_fingerprint(path) for path in input_files],
+            params={'brands': brands, 'no_lowercase': no_lowercase, 'min_score': MIN_SCORE, 'threshold': BRAND_THRESHOLD})
         
         print(calculate_percentage_with_brands(filtered_df, brands)) 
@@ -1,60 +1,98 @@
+import bisect
+import heapq
+import metrics
 import pandas as pd
 import re
+import stage_cache
+from data_fetcher import compact_layout
+
+SENTENCE_PATTERN = re.compile(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s')
+
 
 def keyword_based_segmentation(df):  
     '''
     Segments each sentence based on keywords in it. Cuts of information that isn't necessary for semantic analysis.
+    Every distinct comment is split and scanned for brands once, the segments of all its brands are cut from that.
     
     :param df: DataFrame with columns 'subreddit', 'keyword', 'matched_word', 'comment' and 'mulitple'
+    :return: DataFrame with the segments as 'comment', in the layout of data_fetcher.compact_layout.
+    '''
+    with metrics.stage('segment', rows_in=len(df)) as record:
+        df_single, df_multiple = df[~df['multiple']], df[df['multiple']]
+        segmented_rows = []
+        # identify all unique keywords (brands) for detection
+        unique_keywords = df_multiple['matched_word'].unique()
+        brand_pattern = re.compile('|'.join(re.escape(kw) for kw in unique_keywords), re.IGNORECASE)
+        tagged_comments = {}
+        for subreddit, keyword, matched_word, comment, multiple in zip(df_multiple['subreddit'], df_multiple['keyword'],
+                                                                        df_multiple['matched_word'], df_multiple['comment'],
+                                                                        df_multiple['multiple']):
+            tagged = tagged_comments.get(comment)
+            if tagged is None:
+                tagged = tagged_comments[comment] = tag_sentences(comment, brand_pattern)
+            segment = brand_segment(tagged, matched_word)
+            if segment is not None:
+                segmented_rows.append({
+                    'subreddit': subreddit,
+                    'keyword': keyword,
+                    'matched_word': matched_word,
+                    'comment': segment,
+                    'multiple': multiple
+                })
+
+        metrics.count('segmented_comments', len(tagged_comments))
+        df_multiple_segmented = pd.DataFrame(segmented_rows)
+        df_all = compact_layout(pd.concat([df_single, df_multiple_segmented], ignore_index=True))
+        df_all = df_all.sort_values('keyword')
+        record.rows_out = len(df_all)
+    return df_all
+
+
+def tag_sentences(comment, brand_pattern):
+    '''
+    Split a comment into sentences and find the brands of every sentence in one scan.
+
+    :param comment: String of the comment.
+    :param brand_pattern: Compiled case-insensitive pattern matching all brands.
+    :return: Tuple (sentences, positions, brand_free). sentences is the list of stripped sentences, positions maps
+             every lowercase brand to the positions of the sentences mentioning it and brand_free lists the
+             positions of the sentences without any brand.
+    '''
+    # split comment into sentences using regex to handle different punctuation
+    sentences = SENTENCE_PATTERN.split(comment)
+    positions = {}
+    brand_free = []
+    for position, sentence in enumerate(sentences):
+        brands = {brand.lower() for brand in brand_pattern.findall(sentence)}
+        if not brands:
+            brand_free.append(position)
+        for brand in brands:
+            positions.setdefault(brand, []).append(position)
+    return [sentence.strip() for sentence in sentences], positions, brand_free
+
+
+def brand_segment(tagged, brand):
+    '''
+    Cut the segment of one brand: the sentences mentioning it and the sentences without any brand
+    following its first mention. Sentences mentioning only other brands are left out.
+
+    :param tagged: Tuple returned by tag_sentences.
+    :param brand: String of the brand as matched in the comment.
+    :return: String of the segment, or None if no sentence mentions the brand.
     '''
-    df_single, df_multiple = df[~df['multiple']], df[df['multiple']]
-    segmented_rows = []
-    # identify all unique keywords (brands) for detection
-    unique_keywords = df_multiple['matched_word'].unique()
-    brand_pattern = re.compile('|'.join(re.escape(kw) for kw in unique_keywords), re.IGNORECASE)
-    for _, row in df_multiple.iterrows():
-        comment = row['comment']
-        matched_word = row['matched_word']
-        # split comment into sentences using regex to handle different punctuation
-        sentences = re.split(r'(?<!\w\.\w.)(?<![A-Z][a-z]\.)(?<=\.|\?|\!)\s', comment)
-        current_segment = []
-        current_brand = None
-        for sentence in sentences:
-            brands_in_sentence = brand_pattern.findall(sentence)
-            if matched_word.lower() in map(str.lower, brands_in_sentence):
-                if current_brand and current_brand.lower() != matched_word.lower():
-                    segmented_rows.append({
-                        'subreddit': row['subreddit'],
-                        'keyword': row['keyword'],
-                        'matched_word': current_brand,
-                        'comment': ' '.join(current_segment),
-                        'multiple': row['multiple']
-                    })
-                    current_segment = []
-                current_brand = matched_word
-                current_segment.append(sentence.strip())
-            elif not brands_in_sentence and current_segment:
-                current_segment.append(sentence.strip())
-        # append the last segment if not empty
-        if current_brand and current_segment:
-            segmented_rows.append({
-                'subreddit': row['subreddit'],
-                'keyword': row['keyword'],
-                'matched_word': current_brand,
-                'comment': ' '.join(current_segment),
-                'multiple': row['multiple']
-            })
-
-    df_multiple_segmented = pd.DataFrame(segmented_rows)
-    df_all = pd.concat([df_single, df_multiple_segmented], ignore_index=True)
-    return df_all.sort_values('keyword')
+    sentences, positions, brand_free = tagged
+    mentions = positions.get(brand.lower())
+    if not mentions:
+        return None
+    following = brand_free[bisect.bisect_left(brand_free, mentions[0]):]
+    return ' '.join(sentences[position] for position in heapq.merge(mentions, following))
 
 
 if __name__ == '__main__':
     RUNNABLE = False  # prevent faulty execution and data overwriting
 
     if RUNNABLE: 
-        data = pd.read_json(r'data/filtered.json', orient='records', lines=True)
-        segmented = keyword_based_segmentation(data)
-        segmented.to_json(r'data/segmented.json', orient='records', lines=True)
+        filtered_key = stage_cache.latest_key('filtered')
+        stage_cache.run_stage('segmented', lambda: keyword_based_segmentation(stage_cache.load_artifact('filtered', filtered_key)),
+                              inputs=[filtered_key], params={})
         
\ No newline at end of file
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import metrics
+import os
+import time
+from urllib.parse import urlencode
+
+
+class ResponseCache:
+    '''
+    Persistent cache of HTTP responses, keyed by url and query parameters.
+    Fresh entries are served without a request, stale entries are revalidated with
+    If-None-Match/If-Modified-Since. The least recently used entries are evicted once
+    the cache grows beyond its size limit.
+    '''
+
+    def __init__(self, directory='data/http_cache', ttl=3600, max_bytes=512 * 1024 * 1024):
+        '''
+        :param directory: String path of the cache directory, created if it doesn't exist.
+        :param ttl: Default number of seconds an entry is served without revalidation.
+        :param max_bytes: Maximum total size of the cached response bodies.
+        '''
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = set()  # keys of stale entries being revalidated, a new response counts as miss
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(meta['size'] for _, meta in self._entries())
+
+    def key(self, url, params=None):
+        '''
+        :param url: String url of the request.
+        :param params: Optional dictionary of query parameters, None values are ignored like httpx does.
+        :return: Hex digest identifying the request.
+        '''
+        query = urlencode(sorted((k, v) for k, v in (params or {}).items() if v is not None))
+        return hashlib.sha256(f'{url}?{query}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, url, params=None):
+        '''
+        Find the cached response of a request.
+
+        :param url: String url of the request.
+        :param params: Optional dictionary of query parameters.
+        :return: Dictionary with the entry metadata and its 'body' bytes, or None.
+        '''
+        key = self.key(url, params)
+        meta = self._read_meta(key)
+        if meta is None:
+            self.misses += 1
+            metrics.count('http_cache_misses')
+            return None
+        try:
+            with open(self._path(key, 'body'), 'rb') as file:
+                meta['body'] = file.read()
+        except FileNotFoundError:
+            self.misses += 1
+            metrics.count('http_cache_misses')
+            return None
+        meta['key'] = key
+        meta['accessed'] = time.time()
+        self._write_meta(key, meta)
+        return meta
+
+    def is_fresh(self, entry):
+        '''
+        :param entry: Entry returned by lookup.
+        :return: True if the entry may be served without asking the server, counted as hit.
+                 A stale entry is counted as revalidated or as miss once the server answered.
+        '''
+        fresh = time.time() - entry['stored_at'] < entry['ttl']
+        if fresh:
+            self.hits += 1
+            metrics.count('http_cache_hits')
+        else:
+            self.stale.add(entry['key'])
+        return fresh
+
+    def conditional_headers(self, entry):
+        '''
+        :param entry: Stale entry returned by lookup.
+        :return: Dictionary of headers asking the server whether the entry is still valid.
+        '''
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def mark_revalidated(self, entry):
+        '''
+        Restart the lifetime of an entry after the server answered 304 Not Modified.
+
+        :param entry: Entry returned by lookup.
+        '''
+        self.revalidated += 1
+        metrics.count('http_cache_revalidated')
+        self.stale.discard(entry['key'])
+        entry['stored_at'] = time.time()
+        self._write_meta(entry['key'], entry)
+
+    def store(self, url, params, response, ttl=None):
+        '''
+        Cache a successful response.
+
+        :param url: String url of the request.
+        :param params: Optional dictionary of query parameters.
+        :param response: httpx.Response with status 200.
+        :param ttl: Optional lifetime in seconds, defaults to the cache ttl.
+        '''
+        key = self.key(url, params)
+        if key in self.stale:  # the stale entry changed on the server
+            self.stale.discard(key)
+            self.misses += 1
+            metrics.count('http_cache_misses')
+        old = self._read_meta(key)
+        if old is not None:
+            self.size -= old['size']
+        body = response.content
+        with open(self._path(key, 'body'), 'wb') as file:
+            file.write(body)
+        now = time.time()
+        self._write_meta(key, {
+            'url': url,
+            'etag': response.headers.get('etag'),
+            'last_modified': response.headers.get('last-modified'),
+            'stored_at': now,
+            'accessed': now,
+            'ttl': self.ttl if ttl is None else ttl,
+            'size': len(body)
+        })
+        self.size += len(body)
+        if self.size > self.max_bytes:
+            self._evict()
+
+    def stats(self):
+        '''
+        :return: Dictionary with hit, revalidation, miss and eviction counters and the cache size.
+        '''
+        return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses,
+                'evictions': self.evictions, 'bytes': self.size}
+
+    def _evict(self):
+        # drop least recently used entries until the cache is back to 90% of its limit
+        for key, meta in sorted(self._entries(), key=lambda entry: entry[1]['accessed']):
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            for suffix in ('body', 'json'):
+                try:
+                    os.remove(self._path(key, suffix))
+                except FileNotFoundError:
+                    pass
+            self.size -= meta['size']
+            self.evictions += 1
+            metrics.count('http_cache_evictions')
+
+    def _entries(self):
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.json'):
+                key = file_name[:-len('.json')]
+                meta = self._read_meta(key)
+                if meta is not None:
+                    yield key, meta
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, f'{key}.{suffix}')
+
+    def _read_meta(self, key):
+        try:
+            with open(self._path(key, 'json'), 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_meta(self, key, meta):
+        meta = {name: value for name, value in meta.items() if name not in ('body', 'key')}
+        with open(self._path(key, 'json'), 'w', encoding='utf-8') as file:
+            json.dump(meta, file)
@@ -0,0 +1,181 @@
+import json
+import os
+import pandas as pd
+import stage_cache
+import time
+
+STATE_PATH = 'data/incremental_state.json'
+
+
+def load_state(path=STATE_PATH):
+    '''
+    :param path: String path of the state file.
+    :return: Dictionary with the watermark of every source, the key of the merged counts,
+             the parameters they were computed with and a log of earlier runs.
+    '''
+    if not os.path.exists(path):
+        return {'watermarks': {}, 'counts_key': None, 'params': None, 'runs': []}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def save_state(state, path=STATE_PATH):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(state, file, indent=2)
+    os.replace(temp_path, path)  # the watermarks and the counts they belong to change together
+
+
+def new_rows_mask(batch, watermark):
+    '''
+    Select the comments created after the watermark. Comments created in the same second as the
+    watermark are told apart by their id.
+
+    :param batch: DataFrame with columns 'id' and 'created_utc'.
+    :param watermark: Dictionary with 'created_utc' and the 'ids' created at that time, or None before the first run.
+    :return: Boolean Series, True for new comments.
+    '''
+    created = pd.to_numeric(batch['created_utc'], errors='coerce')
+    if watermark is None:
+        return pd.Series(True, index=batch.index)
+    # comments without a creation time can't be placed after a watermark, they are only taken in the first run
+    return (created > watermark['created_utc']) | ((created == watermark['created_utc'])
+                                                    & ~batch['id'].astype(str).isin(watermark['ids']))
+
+
+def advance_watermark(watermark, batch):
+    '''
+    :param watermark: Dictionary with 'created_utc' and 'ids', or None.
+    :param batch: DataFrame of new comments with columns 'id' and 'created_utc'.
+    :return: Watermark covering the comments of the batch as well.
+    '''
+    created = pd.to_numeric(batch['created_utc'], errors='coerce')
+    if created.isna().all():
+        return watermark
+    latest = float(created.max())
+    ids = batch.loc[created == latest, 'id'].dropna().astype(str).tolist()
+    if watermark is None or latest > watermark['created_utc']:
+        return {'created_utc': latest, 'ids': sorted(set(ids))}
+    if latest == watermark['created_utc']:
+        return {'created_utc': latest, 'ids': sorted(set(watermark['ids']) | set(ids))}
+    return watermark
+
+
+def iter_new_rows(sources, watermarks, new_watermarks, new_row_counts):
+    '''
+    Stream only the comments each source hasn't delivered in earlier runs.
+
+    :param sources: Dictionary mapping source names to iterables of DataFrames with columns 'subreddit', 'body',
+                    'id' and 'created_utc'.
+    :param watermarks: Dictionary mapping source names to the watermarks of the last run.
+    :param new_watermarks: Dictionary filled with the advanced watermark of every source.
+    :param new_row_counts: Dictionary filled with the number of new comments of every source.
+    :return: Generator of DataFrames of new comments.
+    '''
+    for name, batches in sources.items():
+        watermark = watermarks.get(name)
+        new_watermarks[name] = watermark
+        new_row_counts[name] = 0
+        for batch in batches:
+            new_rows = batch[new_rows_mask(batch, watermark)]
+            if not len(new_rows):
+                continue
+            new_watermarks[name] = advance_watermark(new_watermarks[name], new_rows)
+            new_row_counts[name] += len(new_rows)
+            yield new_rows
+        print(f'Source {name}: {new_row_counts[name]} new comments')
+
+
+def run_incremental(sources, keywords, no_lowercase_keywords, model_id, cache=None, scorer=None, state_path=STATE_PATH):
+    '''
+    Match, segment and score only the comments added since the last run and merge their sentiment counts
+    into the persisted counts. Thresholds and ratios are computed from the merged counts, see report_counts.
+    If keywords or model changed since the last run, the counts are rebuilt from scratch.
+
+    :param sources: Dictionary mapping source names to iterables of DataFrames with columns 'subreddit', 'body',
+                    'id' and 'created_utc', e.g. data_fetcher.iter_old_comments with those columns.
+    :param keywords: List of keywords to search for in the comments.
+    :param no_lowercase_keywords: Keywords that are dropped when matched in lowercase.
+    :param model_id: String identifying the sentiment model, part of the parameters of the counts.
+    :param cache: Optional SentimentCache, see analysis.analyse_sentiment.
+    :param scorer: Optional function scoring a list of texts, see analysis.analyse_sentiment.
+    :param state_path: String path of the state file.
+    :return: Series of merged sentiment counts indexed by 'subreddit', 'keyword' and 'sentiment', rare brands included.
+    '''
+    from pipeline import stream_sentiment_counts
+    from visualization import merge_counts
+
+    state = load_state(state_path)
+    params = {'keywords': list(keywords), 'no_lowercase': list(no_lowercase_keywords), 'model_id': model_id}
+    if state['counts_key'] and state['params'] != params:
+        print('Keywords or model changed since the last run, rebuilding the counts from scratch')
+        state = {'watermarks': {}, 'counts_key': None, 'params': None, 'runs': state['runs']}
+
+    new_watermarks = {}
+    new_row_counts = {}
+    batches = iter_new_rows(sources, state['watermarks'], new_watermarks, new_row_counts)
+    new_counts = stream_sentiment_counts(batches, keywords, no_lowercase_keywords, cache=cache, scorer=scorer,
+                                         model_id=model_id, remove_rare_brands=False)
+    counts = new_counts if state['counts_key'] is None else merge_counts(load_counts(state['counts_key']), new_counts)
+
+    key = stage_cache.stage_key('sentiment_counts', [state['counts_key'] or ''], {**params, 'watermarks': new_watermarks})
+    stage_cache.save_artifact(counts.rename('count').reset_index(), 'sentiment_counts', key)
+    state['runs'].append({'time': time.time(), 'new_comments': new_row_counts, 'counted': int(new_counts.sum())})
+    save_state({'watermarks': new_watermarks, 'counts_key': key, 'params': params, 'runs': state['runs']}, state_path)
+    print(f'Merged {int(new_counts.sum())} new rows into {int(counts.sum())} counted rows')
+    return counts
+
+
+def load_counts(key=None, state_path=STATE_PATH):
+    '''
+    :param key: Key of a counts artifact, defaults to the counts of the last incremental run.
+    :param state_path: String path of the state file of the incremental runs.
+    :return: Series of sentiment counts indexed by 'subreddit', 'keyword' and 'sentiment', or None if there are none.
+    '''
+    if key is None:
+        key = load_state(state_path)['counts_key']
+        if key is None:
+            return None
+    counts = stage_cache.load_artifact('sentiment_counts', key)
+    return counts.set_index(['subreddit', 'keyword', 'sentiment'])['count']
+
+
+def report_counts(counts):
+    '''
+    Apply the brand threshold to merged counts and build the tables of the charts.
+
+    :param counts: Series returned by run_incremental or load_counts.
+    :return: Tuple (brand_df, sub_df, comment_count), see visualization.prep_data.
+    '''
+    from pipeline import drop_rare_brands
+    from visualization import prep_data_from_counts
+
+    return prep_data_from_counts(drop_rare_brands(counts))
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        import analysis
+        from data_fetcher import OLD_COMMENT_FILES, get_comments_from_2024, iter_chunks, iter_old_comments
+        from sentiment_cache import SentimentCache
+        from visualization import vis_one, vis_three, vis_two
+
+        brands = ['Argon 18', 'Bianchi', 'BMC', 'Cannondale', 'Canyon', 'Cervelo', 'Cinelli', 'Colnago', 'Cube',
+                  'Giant', 'Merida', 'Orbea', 'Pinarello', 'Ridley', 'Rose', 'Scott', 'Specialized', 'Trek',
+                  'Ventum', 'Wilier']
+        no_lowercase = ['Cube', 'Giant', 'Rose']
+        model_path = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
+        analysis.sentiment_task = analysis.load_sentiment_task(model_path, 'onnx')
+
+        columns = ('subreddit', 'body', 'id', 'created_utc')
+        sources = {file_name: iter_old_comments(['data/subreddits08-23/' + file_name], chunk_size=20_000, columns=columns)
+                   for file_name in OLD_COMMENT_FILES}
+        sources['scraped'] = iter_chunks(get_comments_from_2024(), 20_000)
+        counts = run_incremental(sources, brands, no_lowercase, analysis.sentiment_model_id(model_path, 'onnx'),
+                                 cache=SentimentCache(r'data/sentiment_cache.sqlite'))
+        brand_df, sub_df, total = report_counts(counts)
+        vis_one(brand_df, total)
+        vis_two(sub_df, total)
+        vis_three(brand_df, total)
@@ -0,0 +1,234 @@
+import json
+import math
+import numpy as np
+import os
+from collections import Counter, OrderedDict, defaultdict
+from rapidfuzz import fuzz, process
+
+MIN_SCORE = 85
+
+
+class KeywordMatcher:
+    '''
+    Fuzzy matches comment tokens against a fixed list of keywords (brands).
+    Every distinct lowercased token is scored against the keywords only once, the result is kept
+    in a bounded least-recently-used cache which can be saved to disk and reloaded between runs.
+    Keywords are indexed by length and character bigrams, so a token is only scored against
+    keywords it could possibly match.
+    '''
+
+    def __init__(self, keywords, max_cache_size=1_000_000, min_score=MIN_SCORE, track_new_entries=False):
+        '''
+        :param keywords: List of keywords to search for. The order decides ties between equally good keywords.
+        :param max_cache_size: Maximum amount of distinct tokens kept in the cache.
+        :param min_score: Score a token has to exceed to count as a match for a keyword.
+        :param track_new_entries: If True, newly scored tokens are collected for take_new_entries,
+                                  e.g. to merge the caches of worker processes.
+        '''
+        self.keywords = list(keywords)
+        self.lowered_keywords = [keyword.lower() for keyword in self.keywords]
+        self.max_cache_size = max_cache_size
+        self.min_score = min_score
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.scored_pairs = 0
+        self.new_entries = {} if track_new_entries else None  # tokens scored since the last take_new_entries call
+        self._build_index()
+
+    def _build_index(self):
+        self.exact_index = {}  # lowered keyword -> keyword indices
+        self.length_buckets = defaultdict(list)  # keyword length -> keyword indices
+        self.bigram_postings = defaultdict(list)  # bigram -> [(keyword_index, count)]
+        for index, keyword in enumerate(self.lowered_keywords):
+            self.exact_index.setdefault(keyword, []).append(index)
+            self.length_buckets[len(keyword)].append(index)
+            for bigram, count in Counter(_bigrams(keyword)).items():
+                self.bigram_postings[bigram].append((index, count))
+
+    def _max_distance(self, total_length):
+        # fuzz.ratio = 100 * (1 - distance / total_length), so a score above min_score needs
+        # distance < total_length * (100 - min_score) / 100; rounded up to stay on the safe side
+        return math.floor(total_length * (100 - self.min_score) / 100)
+
+    def candidates(self, token):
+        '''
+        Find the keywords a token could score above min_score against.
+        Keywords that differ too much in length or share too few character bigrams with the
+        token are pruned, keywords equal to the token are returned as exact hits.
+
+        :param token: Lowercased string to be matched.
+        :return: Tuple of (exact_indices, candidate_indices) lists of keyword indices.
+        '''
+        exact = self.exact_index.get(token, [])
+        length = len(token)
+        plausible = []
+        for keyword_length, indices in self.length_buckets.items():
+            if abs(length - keyword_length) <= self._max_distance(length + keyword_length):
+                plausible.extend(index for index in indices if index not in exact)
+        if not plausible:
+            return exact, plausible
+
+        # each insertion or deletion destroys at most two bigrams of the longer string,
+        # so a match needs at least max_length - 1 - 2 * max_distance shared bigrams
+        shared = Counter()
+        for bigram, count in Counter(_bigrams(token)).items():
+            for index, keyword_count in self.bigram_postings.get(bigram, ()):
+                shared[index] += min(count, keyword_count)
+
+        candidates = []
+        for index in plausible:
+            keyword_length = len(self.lowered_keywords[index])
+            required = max(length, keyword_length) - 1 - 2 * self._max_distance(length + keyword_length)
+            if shared[index] >= required:
+                candidates.append(index)
+        return exact, candidates
+
+    def token_matches(self, token):
+        '''
+        Score a lowercased token against all keywords, using the cache if possible.
+
+        :param token: Lowercased string to be scored.
+        :return: Tuple of (keyword_index, score) pairs for every keyword the token matches.
+        '''
+        return self.score_tokens([token])[token]
+
+    def score_tokens(self, tokens):
+        '''
+        Score lowercased tokens against all keywords. Tokens missing from the cache are
+        pruned with the keyword index and scored together in one batched call.
+
+        :param tokens: Iterable of lowercased strings to be scored.
+        :return: Dictionary mapping each token to a tuple of (keyword_index, score) pairs.
+        '''
+        results = {}
+        missing = []
+        for token in tokens:
+            if token in results:
+                continue
+            matches = self.cache.get(token)
+            if matches is None:
+                self.misses += 1
+                results[token] = None
+                missing.append(token)
+            else:
+                self.hits += 1
+                self.cache.move_to_end(token)
+                results[token] = matches
+
+        if missing:
+            scored = list(zip(missing, self._score_missing(missing)))
+            results.update(scored)
+            self.update(scored)
+            if self.new_entries is not None:
+                self.new_entries.update(scored)
+        return results
+
+    def update(self, entries):
+        '''
+        Add scored tokens to the cache, e.g. the new entries of a matcher in another process.
+
+        :param entries: Iterable of (token, matches) pairs, matches as returned by token_matches.
+        '''
+        for token, matches in entries:
+            self.cache[token] = matches
+            self.cache.move_to_end(token)
+            if len(self.cache) > self.max_cache_size:
+                self.cache.popitem(last=False)  # evict least recently used token
+
+    def take_new_entries(self):
+        '''
+        :return: Dictionary of the tokens scored since the last call, mapping them to their matches.
+        '''
+        entries, self.new_entries = self.new_entries, {}
+        return entries
+
+    def _score_missing(self, tokens):
+        candidate_lists = []
+        columns = {}  # keyword index -> column in the score matrix
+        for token in tokens:
+            exact, candidates = self.candidates(token)
+            candidate_lists.append((exact, candidates))
+            for index in candidates:
+                columns.setdefault(index, len(columns))
+
+        scores = None
+        candidate_tokens = [token for token, (_, candidates) in zip(tokens, candidate_lists) if candidates]
+        if candidate_tokens:
+            choices = [None] * len(columns)
+            for index, column in columns.items():
+                choices[column] = self.lowered_keywords[index]
+            scores = process.cdist(candidate_tokens, choices, scorer=fuzz.ratio,
+                                   score_cutoff=self.min_score, dtype=np.float64)
+
+        all_matches = []
+        row = 0
+        for exact, candidates in candidate_lists:
+            matches = [(index, 100.0) for index in exact]
+            if candidates:
+                for index in candidates:
+                    score = float(scores[row, columns[index]])
+                    if score > self.min_score:
+                        matches.append((index, score))
+                self.scored_pairs += len(candidates)
+                row += 1
+            all_matches.append(tuple(sorted(matches)))
+        return all_matches
+
+    def find_keywords(self, comment):
+        '''
+        Find all keywords mentioned in a comment in a single pass over its words.
+        For every keyword the first word with the highest score is taken as its matched word.
+        Keywords are ordered by descending score, ties are broken by the order of the keyword list.
+
+        :param comment: String to be parsed for keywords.
+        :return: List of (keyword, matched_word) tuples.
+        '''
+        words = comment.lower().split()
+        token_matches = self.score_tokens(words)
+        best = {}  # keyword_index -> (score, matched_word)
+        for word in words:
+            for index, score in token_matches[word]:
+                if index not in best or score > best[index][0]:
+                    best[index] = (score, word)
+
+        ordered = sorted(best.items(), key=lambda item: (-item[1][0], item[0]))
+        return [(self.keywords[index], word) for index, (_, word) in ordered]
+
+    def save(self, path):
+        '''
+        Save the token cache to a JSON file.
+
+        :param path: String path of the file to write.
+        '''
+        data = {
+            'keywords': self.keywords,
+            'min_score': self.min_score,
+            'tokens': {token: [list(match) for match in matches] for token, matches in self.cache.items()}
+        }
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+
+    def load(self, path):
+        '''
+        Load a token cache saved by save(). The cache is ignored if it was built
+        for a different keyword list or score threshold or if the file doesn't exist.
+
+        :param path: String path of the file to read.
+        :return: True if the cache was loaded, False otherwise.
+        '''
+        if not os.path.exists(path):
+            return False
+        with open(path, 'r', encoding='utf-8') as file:
+            data = json.load(file)
+        if data['keywords'] != self.keywords or data['min_score'] != self.min_score:
+            print('Match cache was built for different keywords, ignoring it')
+            return False
+
+        self.update((token, tuple((index, score) for index, score in matches))
+                    for token, matches in data['tokens'].items())
+        return True
+
+
+def _bigrams(text):
+    return [text[i:i + 2] for i in range(len(text) - 1)]
@@ -0,0 +1,90 @@
+import json
+import numpy as np
+import random
+import threading
+import time
+import urllib.request
+
+
+def send_request(url, comments, filter_results=False, timeout=60):
+    '''
+    :param url: String base url of the scoring service, e.g. 'http://127.0.0.1:8000'.
+    :param comments: List of comment strings or row dictionaries with a 'comment' key.
+    :param filter_results: If True, the service only returns rows kept by filter_sentiment.
+    :param timeout: Number of seconds to wait for the response.
+    :return: List of scored rows.
+    '''
+    payload = json.dumps({'comments': comments, 'filter': filter_results}).encode('utf-8')
+    request = urllib.request.Request(f'{url}/score', data=payload, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())['results']
+
+
+def get_metrics(url):
+    with urllib.request.urlopen(f'{url}/metrics', timeout=10) as response:
+        return json.loads(response.read())
+
+
+def run_load(url, comments, clients=16, requests_per_client=50, comments_per_request=(1, 8), seed=42):
+    '''
+    Send requests from several concurrent clients, each waiting for its response before the next request,
+    and report the client-side latency and throughput next to the metrics of the service.
+
+    :param url: String base url of the scoring service.
+    :param comments: List of comment strings requests are sampled from.
+    :param clients: Number of concurrent client threads.
+    :param requests_per_client: Number of requests every client sends.
+    :param comments_per_request: Tuple with the minimum and maximum number of comments per request.
+    :param seed: Seed of the sampling.
+    :return: Dictionary with the client report under 'client' and the service metrics under 'service'.
+    '''
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(client_id):
+        generator = random.Random(seed + client_id)
+        for _ in range(requests_per_client):
+            sample = generator.sample(comments, generator.randint(*comments_per_request))
+            start = time.perf_counter()
+            try:
+                send_request(url, sample)
+            except OSError as error:
+                with lock:
+                    errors.append(repr(error))
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - start, len(sample)))
+
+    threads = [threading.Thread(target=client, args=(client_id,)) for client_id in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.perf_counter() - start, 1e-9)
+
+    seconds = np.array([latency for latency, _ in latencies]) * 1000
+    report = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_s': len(latencies) / elapsed,
+        'comments_per_s': sum(size for _, size in latencies) / elapsed,
+        'latency_p50_ms': float(np.percentile(seconds, 50)) if len(seconds) else None,
+        'latency_p99_ms': float(np.percentile(seconds, 99)) if len(seconds) else None
+    }
+    service = get_metrics(url)
+    print(f'Client: {report}')
+    print(f'Service: {service}')
+    return {'client': report, 'service': service}
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution, start scoring_service.py first
+
+    if RUNNABLE:
+        import stage_cache
+
+        sample = stage_cache.load_artifact('segmented')['comment'].sample(10_000, random_state=42).tolist()
+        for clients in (1, 8, 32):
+            run_load('http://127.0.0.1:8000', sample, clients=clients)
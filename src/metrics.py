@@ -0,0 +1,178 @@
+import contextlib
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+from collections import deque
+
+# exports are off unless configured, e.g. METRICS_LOG=data/metrics.jsonl METRICS_TEXTFILE=data/metrics.prom
+_config = {
+    'log_path': os.environ.get('METRICS_LOG'),
+    'textfile_path': os.environ.get('METRICS_TEXTFILE'),
+    'profile_stage': os.environ.get('PROFILE_STAGE'),
+    'profile_dir': os.environ.get('PROFILE_DIR', 'data/profiles')
+}
+_lock = threading.Lock()
+_counters = {}
+_latest = {}  # stage name -> record of its last run, exported as Prometheus gauges
+history = deque(maxlen=1000)
+
+
+def configure(log_path=None, textfile_path=None, profile_stage=None, profile_dir=None):
+    '''
+    Set where stage metrics are exported. Arguments left at None keep their current value,
+    which defaults to the environment variables METRICS_LOG, METRICS_TEXTFILE, PROFILE_STAGE and PROFILE_DIR.
+
+    :param log_path: String path of a file every finished stage is appended to as one JSON line.
+    :param textfile_path: String path of a Prometheus textfile rewritten after every stage,
+                          e.g. in the directory of node_exporter's textfile collector.
+    :param profile_stage: Name of a stage run under cProfile.
+    :param profile_dir: Directory the profiles are written to.
+    '''
+    for name, value in (('log_path', log_path), ('textfile_path', textfile_path),
+                        ('profile_stage', profile_stage), ('profile_dir', profile_dir)):
+        if value is not None:
+            _config[name] = value
+
+
+def count(name, amount=1):
+    '''
+    Add to a process wide counter, e.g. 'http_requests'. Every stage reports how much its counters
+    grew while it ran, so code deep inside a stage doesn't need to know which stage it belongs to.
+    Counters ending in '_hits' and '_misses' are reported with a hit rate.
+
+    :param name: String name of the counter.
+    :param amount: Number added to the counter.
+    '''
+    if not amount:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+class StageRecord:
+    '''
+    Metrics of one run of a stage, filled in by the stage context manager.
+    '''
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.seconds = None
+        self.cpu_seconds = None
+        self.counters = {}
+        self.error = None
+
+    def as_dict(self):
+        record = {'stage': self.name, 'time': time.time(), 'seconds': self.seconds, 'cpu_seconds': self.cpu_seconds,
+                  'rows_in': self.rows_in, 'rows_out': self.rows_out, 'counters': self.counters}
+        for name in self.counters:
+            if name.endswith('_hits'):
+                prefix = name[:-len('_hits')]
+                lookups = self.counters[name] + self.counters.get(prefix + '_misses', 0)
+                record[prefix + '_hit_rate'] = self.counters[name] / lookups if lookups else None
+        if self.error:
+            record['error'] = self.error
+        return record
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    '''
+    Measure a pipeline stage: wall and CPU time, rows in and out and the growth of every counter.
+    CPU time and counters are those of the whole process, so stages running at the same time share them.
+
+        with metrics.stage('segment', rows_in=len(df)) as record:
+            ...
+            record.rows_out = len(result)
+
+    :param name: String name of the stage, also the name PROFILE_STAGE selects.
+    :param rows_in: Optional number of input rows, can also be set on the record.
+    :return: Context manager yielding the StageRecord.
+    '''
+    record = StageRecord(name, rows_in)
+    counters_before = counters()
+    profiler = cProfile.Profile() if _config['profile_stage'] == name else None
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield record
+    except BaseException as error:
+        record.error = repr(error)
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+        record.seconds = time.perf_counter() - start
+        record.cpu_seconds = time.process_time() - cpu_start
+        record.counters = {counter: value - counters_before.get(counter, 0) for counter, value in counters().items()
+                           if value != counters_before.get(counter, 0)}
+        _finish(record, profiler)
+
+
+def _finish(record, profiler):
+    entry = record.as_dict()
+    with _lock:
+        history.append(entry)
+        _latest[record.name] = entry
+    if _config['log_path']:
+        with _lock, open(_config['log_path'], 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry) + '\n')
+    if _config['textfile_path']:
+        write_textfile(_config['textfile_path'])
+    if profiler:
+        os.makedirs(_config['profile_dir'], exist_ok=True)
+        path = os.path.join(_config['profile_dir'], f'{record.name}-{int(time.time())}.prof')
+        profiler.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(15)
+        print(f'Profile of stage {record.name} written to {path}\n{summary.getvalue()}')
+
+
+def prometheus_text():
+    '''
+    :return: String in the Prometheus text format with the last run of every stage and the process wide counters.
+    '''
+    with _lock:
+        latest = dict(_latest)
+        totals = dict(_counters)
+    gauges = [('seconds', 'Wall time of the last run of a stage.'),
+              ('cpu_seconds', 'CPU time of the process during the last run of a stage.'),
+              ('rows_in', 'Input rows of the last run of a stage.'),
+              ('rows_out', 'Output rows of the last run of a stage.')]
+    lines = []
+    for field, description in gauges:
+        lines += [f'# HELP sentiment_stage_{field} {description}', f'# TYPE sentiment_stage_{field} gauge']
+        lines += [f'sentiment_stage_{field}{{stage="{name}"}} {entry[field]}'
+                  for name, entry in sorted(latest.items()) if entry[field] is not None]
+    lines += ['# HELP sentiment_stage_counter Counter growth during the last run of a stage.',
+              '# TYPE sentiment_stage_counter gauge']
+    lines += [f'sentiment_stage_counter{{stage="{name}",counter="{counter}"}} {value}'
+              for name, entry in sorted(latest.items()) for counter, value in sorted(entry['counters'].items())]
+    lines += ['# HELP sentiment_events_total Process wide counters.', '# TYPE sentiment_events_total counter']
+    lines += [f'sentiment_events_total{{counter="{counter}"}} {value}' for counter, value in sorted(totals.items())]
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    '''
+    :param path: String path of the Prometheus textfile, replaced atomically so scrapers never read half of it.
+    '''
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        file.write(prometheus_text())
+    os.replace(temp_path, path)
@@ -0,0 +1,143 @@
+import itertools
+import mmap
+import numpy as np
+import os
+import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import orjson as json_parser  # optional, several times faster than the standard library
+except ImportError:
+    import json as json_parser
+
+BLOCK_SIZE = 64 * 1024 * 1024  # bytes scanned for line breaks at once
+
+
+def build_line_index(path):
+    '''
+    Find the byte offset of every line in a .ndjson file.
+
+    :param path: String path of the .ndjson file.
+    :return: Numpy int64 array with the start offset of every line followed by the file size,
+             so line i spans offsets[i]:offsets[i + 1].
+    '''
+    size = os.path.getsize(path)
+    if size == 0:
+        return np.zeros(1, dtype=np.int64)
+
+    starts = [np.zeros(1, dtype=np.int64)]
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for block_start in range(0, size, BLOCK_SIZE):
+            block = np.frombuffer(mm, dtype=np.uint8, count=min(BLOCK_SIZE, size - block_start), offset=block_start)
+            starts.append(np.flatnonzero(block == ord('\n')).astype(np.int64) + block_start + 1)
+            del block  # release the buffer so the mmap can be closed
+
+    offsets = np.concatenate(starts)
+    if offsets[-1] != size:
+        offsets = np.append(offsets, size)  # last line has no trailing line break
+    return offsets
+
+
+def load_line_index(path):
+    '''
+    Load the line index cached next to a .ndjson file, building and caching it if it is missing
+    or the file changed since it was built.
+
+    :param path: String path of the .ndjson file.
+    :return: Line offsets as returned by build_line_index.
+    '''
+    index_path = path + '.lineidx.npz'
+    stat = os.stat(path)
+    if os.path.exists(index_path):
+        cached = np.load(index_path)
+        if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+            return cached['offsets']
+
+    offsets = build_line_index(path)
+    np.savez(index_path, offsets=offsets, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    return offsets
+
+
+def parse_byte_range(path, start, end, columns):
+    '''
+    Parse the lines between two byte offsets of a .ndjson file, keeping only the requested fields.
+
+    :param path: String path of the .ndjson file.
+    :param start: Offset of the first byte, must be the start of a line.
+    :param end: Offset after the last byte, must be the end of a line.
+    :param columns: Fields to keep from every record, missing fields become None.
+    :return: Dictionary mapping every column to a list of values.
+    '''
+    batch = {column: [] for column in columns}
+    if end <= start:
+        return batch
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line in mm[start:end].split(b'\n'):
+            if not line.strip():
+                continue
+            record = json_parser.loads(line)
+            for column in columns:
+                batch[column].append(record.get(column))
+    return batch
+
+
+def iter_ndjson_parallel(path, columns=('subreddit', 'body'), workers=None, lines_per_task=100_000):
+    '''
+    Parse a .ndjson file in worker processes, each one handling a disjoint byte range.
+    Batches are yielded in file order and only a few ranges per worker are in flight at once.
+
+    :param path: String path of the .ndjson file.
+    :param columns: Fields to keep from every record.
+    :param workers: Number of worker processes, defaults to the number of cores.
+    :param lines_per_task: Number of lines parsed by a worker at once.
+    :return: Generator of DataFrames with the requested columns.
+    '''
+    workers = workers or os.cpu_count()
+    offsets = load_line_index(path)
+    ranges = ((int(offsets[i]), int(offsets[min(i + lines_per_task, len(offsets) - 1)]))
+              for i in range(0, len(offsets) - 1, lines_per_task))
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for byte_range in itertools.chain(ranges, [None]):
+            if byte_range is not None:
+                pending.append(executor.submit(parse_byte_range, path, *byte_range, columns))
+            while pending and (byte_range is None or len(pending) >= 2 * workers):
+                yield pd.DataFrame(pending.popleft().result(), columns=list(columns))
+
+
+def read_lines(path, line_numbers, columns=('subreddit', 'body')):
+    '''
+    Randomly access single lines of a .ndjson file through its line index.
+
+    :param path: String path of the .ndjson file.
+    :param line_numbers: Iterable of zero-based line numbers.
+    :param columns: Fields to keep from every record.
+    :return: DataFrame with one row per requested line, in the requested order.
+    '''
+    offsets = load_line_index(path)
+    batch = {column: [] for column in columns}
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for line_number in line_numbers:
+            line = mm[offsets[line_number]:offsets[line_number + 1]]
+            record = json_parser.loads(line) if line.strip() else {}
+            for column in columns:
+                batch[column].append(record.get(column))
+    return pd.DataFrame(batch, columns=list(columns))
+
+
+def sample_ndjson(path, n, columns=('subreddit', 'body'), seed=None):
+    '''
+    Draw a random sample of lines from a .ndjson file without reading the whole file.
+
+    :param path: String path of the .ndjson file.
+    :param n: Number of lines to sample, capped at the number of lines in the file.
+    :param columns: Fields to keep from every record.
+    :param seed: Optional seed for reproducible samples.
+    :return: DataFrame with the sampled records in file order.
+    '''
+    line_count = len(load_line_index(path)) - 1
+    rng = np.random.default_rng(seed)
+    line_numbers = np.sort(rng.choice(line_count, size=min(n, line_count), replace=False))
+    return read_lines(path, line_numbers, columns)
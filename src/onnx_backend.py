@@ -0,0 +1,182 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+
+class OnnxSentimentTask:
+    '''
+    Sentiment classifier running an exported model with ONNX Runtime on the CPU.
+    Called like a Hugging Face sentiment-analysis pipeline: with a list of texts it returns
+    one dictionary with 'label' and 'score' per text.
+    '''
+
+    def __init__(self, model_dir, threads=None, max_length=512, quantize=True):
+        '''
+        :param model_dir: Directory written by export_onnx.
+        :param threads: Number of intra-op threads, defaults to the number of cores.
+        :param max_length: Number of tokens texts are truncated to.
+        :param quantize: If True, the int8 quantized export is run, the float one otherwise.
+        '''
+        import onnxruntime
+        from transformers import AutoConfig, AutoTokenizer
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads or os.cpu_count()
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        model_file = onnx_model_file(model_dir, quantize)
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = AutoConfig.from_pretrained(model_dir)  # exposes name_or_path and id2label like a model
+        self.model.name_or_path = model_file  # keeps cached results apart per backend
+        self.max_length = max_length
+
+    def encode(self, texts, tokenizer=None):
+        '''
+        :param texts: List of strings.
+        :param tokenizer: Optional copy of the tokenizer, fast tokenizers must not be shared between threads.
+        :return: Dictionary of model inputs.
+        '''
+        tokenizer = tokenizer or self.tokenizer
+        encoded = tokenizer(texts, padding=True, truncation=True, max_length=self.max_length, return_tensors='np')
+        return {name: array.astype(np.int64) for name, array in encoded.items() if name in self.input_names}
+
+    def forward(self, inputs):
+        '''
+        :param inputs: Dictionary of model inputs returned by encode.
+        :return: Numpy array of shape (number of texts, number of labels).
+        '''
+        return self.session.run(['logits'], inputs)[0]
+
+    def logits(self, texts):
+        '''
+        :param texts: List of strings.
+        :return: Numpy array of shape (len(texts), number of labels).
+        '''
+        return self.forward(self.encode(texts))
+
+    def __call__(self, texts, batch_size=None):
+        '''
+        :param texts: String or list of strings.
+        :param batch_size: Optional number of texts run at once, defaults to all of them.
+        :return: List of result dictionaries with 'label' and 'score'.
+        '''
+        if isinstance(texts, str):
+            texts = [texts]
+        batch_size = batch_size or len(texts)
+        results = []
+        for start in range(0, len(texts), batch_size):
+            logits = self.logits(texts[start:start + batch_size])
+            probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+            probabilities /= probabilities.sum(axis=1, keepdims=True)
+            labels = probabilities.argmax(axis=1)
+            results.extend({'label': self.model.id2label[int(label)], 'score': float(probabilities[row, label])}
+                           for row, label in enumerate(labels))
+        return results
+
+
+def onnx_model_file(model_dir, quantize=True):
+    '''
+    :param model_dir: Directory written by export_onnx.
+    :param quantize: If True, the int8 quantized model, the float one otherwise.
+    :return: String path of the model file OnnxSentimentTask runs, it may not be exported yet.
+    '''
+    return os.path.join(model_dir, 'model_quantized.onnx' if quantize else 'model.onnx')
+
+
+def export_onnx(model_path, output_dir, quantize=True):
+    '''
+    Export a Hugging Face sequence classification model to ONNX and optionally quantize its weights
+    to int8 (dynamic quantization, activations stay float).
+
+    :param model_path: Hugging Face model id or local directory.
+    :param output_dir: Directory the ONNX model, tokenizer and config are written to.
+    :param quantize: If True, additionally writes model_quantized.onnx which OnnxSentimentTask runs with quantize=True.
+    :return: String path of the output directory.
+    '''
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    # written to a temporary directory next to output_dir and moved into place at the end,
+    # so nobody loads a half written model
+    parent_dir = os.path.dirname(os.path.abspath(output_dir))
+    os.makedirs(parent_dir, exist_ok=True)
+    temp_dir = tempfile.mkdtemp(prefix=os.path.basename(output_dir) + '.', suffix='.tmp', dir=parent_dir)
+    try:
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        model = AutoModelForSequenceClassification.from_pretrained(model_path)
+        model.config.return_dict = False
+        model.eval()
+        tokenizer.save_pretrained(temp_dir)
+        model.config.save_pretrained(temp_dir)
+
+        sample = tokenizer(['A short sample sentence.', 'Another one.'], padding=True, return_tensors='pt')
+        onnx_path = os.path.join(temp_dir, 'model.onnx')
+        dynamic_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                        'logits': {0: 'batch'}}
+        with torch.no_grad():
+            torch.onnx.export(model, (sample['input_ids'], sample['attention_mask']), onnx_path,
+                              input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                              dynamic_axes=dynamic_axes, opset_version=17, dynamo=False)
+
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(onnx_path, os.path.join(temp_dir, 'model_quantized.onnx'), weight_type=QuantType.QInt8)
+
+        if not os.path.exists(output_dir):
+            os.replace(temp_dir, output_dir)
+        else:
+            # the model files come last, once they exist everything they need is in place
+            model_files = ('model.onnx', 'model_quantized.onnx')
+            for file_name in sorted(os.listdir(temp_dir), key=lambda name: name in model_files):
+                os.replace(os.path.join(temp_dir, file_name), os.path.join(output_dir, file_name))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return output_dir
+
+
+def parity_check(reference_task, candidate_task, texts, batch_size=64):
+    '''
+    Compare the results of two sentiment backends on a held-out sample.
+
+    :param reference_task: Callable returning sentiment results, e.g. the PyTorch pipeline.
+    :param candidate_task: Callable returning sentiment results, e.g. an OnnxSentimentTask.
+    :param texts: List of strings to be scored by both.
+    :param batch_size: Number of texts run at once.
+    :return: Dictionary with the label agreement, mean and maximum score drift and the speedup.
+    '''
+    timings = []
+    outputs = []
+    for task in (reference_task, candidate_task):
+        start = time.perf_counter()
+        outputs.append(task(texts, batch_size=batch_size))
+        timings.append(time.perf_counter() - start)
+
+    reference, candidate = outputs
+    agreement = np.mean([ref['label'] == cand['label'] for ref, cand in zip(reference, candidate)])
+    drift = np.abs(np.array([ref['score'] for ref in reference]) - np.array([cand['score'] for cand in candidate]))
+    report = {
+        'label_agreement': float(agreement),
+        'mean_score_drift': float(drift.mean()),
+        'max_score_drift': float(drift.max()),
+        'speedup': timings[0] / max(timings[1], 1e-9)
+    }
+    print(f'Parity on {len(texts)} texts: {report}')
+    return report
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        import stage_cache
+        from analysis import load_sentiment_task
+
+        model_path = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
+        held_out = stage_cache.load_artifact('segmented')['comment'].sample(2000, random_state=42).tolist()
+        parity_check(load_sentiment_task(model_path, 'torch'), load_sentiment_task(model_path, 'onnx'), held_out)
@@ -0,0 +1,225 @@
+import pandas as pd
+import queue
+import threading
+import time
+from data_fetcher import clear_of_lowercase, find_rare_brands, match_comments, matches_to_df
+from keyword_matcher import KeywordMatcher
+
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class StreamingPipeline:
+    '''
+    Runs batch functions as a chain of threads connected by bounded queues.
+    A stage blocks once its output queue is full, so the slowest stage throttles the ones before it
+    and memory depends on the batch and queue size instead of the size of the corpus.
+    Stages overlap as far as they release the GIL, e.g. inference while the next batch is matched.
+    '''
+
+    def __init__(self, stages, queue_size=2):
+        '''
+        :param stages: List of (name, function) tuples. Every function turns one batch into the batch
+                       of the next stage, None or empty results are dropped.
+        :param queue_size: Maximum number of batches waiting between two stages.
+        '''
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {}
+        self.stop = threading.Event()
+
+    def run(self, source):
+        '''
+        :param source: Iterable of batches, e.g. a generator of DataFrames.
+        :return: Generator of the batches returned by the last stage.
+        '''
+        self.stop.clear()
+        self.stats = {name: {'batches': 0, 'rows_in': 0, 'rows_out': 0, 'seconds': 0.0}
+                      for name in ['read'] + [name for name, _ in self.stages]}
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._read, args=(source, queues[0]), daemon=True)]
+        for (name, function), inbox, outbox in zip(self.stages, queues, queues[1:]):
+            threads.append(threading.Thread(target=self._work, args=(name, function, inbox, outbox), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                batch = queues[-1].get()
+                if batch is _DONE:
+                    break
+                if isinstance(batch, _Failure):
+                    raise batch.error
+                yield batch
+        finally:
+            self.stop.set()  # unblocks the stages if the consumer stops early or a stage failed
+            for thread in threads:
+                thread.join()
+
+    def report(self):
+        '''
+        Print rows in and out, busy time and throughput of every stage.
+
+        :return: Dictionary with the statistics of every stage.
+        '''
+        for name, stats in self.stats.items():
+            rate = stats['rows_in'] / max(stats['seconds'], 1e-9)
+            print(f'{name}: {stats["batches"]} batches, {stats["rows_in"]} rows in, {stats["rows_out"]} rows out, '
+                  f'{stats["seconds"]:.1f}s busy, {rate:.0f} rows/s')
+        return self.stats
+
+    def _read(self, source, outbox):
+        stats = self.stats['read']
+        iterator = iter(source)
+        try:
+            while not self.stop.is_set():
+                start = time.perf_counter()
+                batch = next(iterator, _DONE)
+                stats['seconds'] += time.perf_counter() - start
+                if batch is _DONE:
+                    break
+                stats['batches'] += 1
+                stats['rows_in'] += len(batch)
+                stats['rows_out'] += len(batch)
+                self._put(outbox, batch)
+        except BaseException as error:
+            self._put(outbox, _Failure(error))
+            return
+        self._put(outbox, _DONE)
+
+    def _work(self, name, function, inbox, outbox):
+        stats = self.stats[name]
+        while not self.stop.is_set():
+            try:
+                batch = inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if batch is _DONE or isinstance(batch, _Failure):
+                self._put(outbox, batch)
+                return
+            start = time.perf_counter()
+            try:
+                result = function(batch)
+            except BaseException as error:
+                self._put(outbox, _Failure(error))
+                return
+            stats['seconds'] += time.perf_counter() - start
+            stats['batches'] += 1
+            stats['rows_in'] += len(batch)
+            if result is not None and len(result):
+                stats['rows_out'] += len(result)
+                self._put(outbox, result)
+
+    def _put(self, outbox, item):
+        # wait for room in the queue, this is where backpressure happens
+        while not self.stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+
+def match_batch(batch, keywords, no_lowercase_keywords, matcher):
+    '''
+    Streaming counterpart of data_fetcher.prepare_for_analysis for one batch of comments.
+    Brand thresholds need the whole corpus, so they are applied to the merged counts instead.
+
+    :param batch: DataFrame with columns 'body' and 'subreddit'.
+    :param keywords: List of keywords to search for in the comments.
+    :param no_lowercase_keywords: Keywords that are dropped when matched in lowercase, see clear_of_lowercase.
+    :param matcher: KeywordMatcher built for keywords, shared by all batches.
+    :return: DataFrame with columns 'subreddit', 'keyword', 'matched_word', 'comment' and 'multiple'.
+    '''
+    matches = clear_of_lowercase(matches_to_df(match_comments(batch, keywords, matcher)), no_lowercase_keywords)
+    matches['multiple'] = matches['comment'].duplicated(keep=False)
+    return matches
+
+
+def stream_sentiment_counts(batches, keywords, no_lowercase_keywords, cache=None, scorer=None, model_id=None,
+                            queue_size=2, remove_rare_brands=True):
+    '''
+    Match, segment, score and count comments batch by batch with the stages overlapping.
+    Only sentiment counts are kept, so memory doesn't grow with the corpus.
+
+    Unlike the stage by stage run, rows of rare brands are only removed from the final counts. Before,
+    they were already dropped after matching, so a comment mentioning one common and one rare brand
+    is segmented here while it was kept whole there. Segmentation also only sees the brands of its batch.
+
+    The global analysis.sentiment_task must be loaded unless a scorer is given.
+
+    :param batches: Iterable of DataFrames with columns 'body' and 'subreddit', e.g. from data_fetcher.iter_old_comments.
+    :param keywords: List of keywords to search for in the comments.
+    :param no_lowercase_keywords: Keywords that are dropped when matched in lowercase.
+    :param cache: Optional SentimentCache, see analysis.analyse_sentiment.
+    :param scorer: Optional function scoring a list of texts, see analysis.analyse_sentiment.
+    :param model_id: String identifying the model in the cache.
+    :param queue_size: Maximum number of batches waiting between two stages.
+    :param remove_rare_brands: If False, rare brands are kept, e.g. to merge the counts with those of other runs.
+    :return: Series of sentiment counts indexed by 'subreddit', 'keyword' and 'sentiment', see visualization.count_sentiments.
+    '''
+    from analysis import analyse_sentiment, filter_sentiment
+    from data_split import keyword_based_segmentation
+    from visualization import count_sentiments, merge_counts
+
+    matcher = KeywordMatcher(keywords)
+
+    def score(batch):
+        scored = analyse_sentiment(batch, cache=cache, scorer=scorer, model_id=model_id, verbose=False)
+        return filter_sentiment(scored, remove_rare_brands=False)
+
+    pipeline = StreamingPipeline([
+        ('match', lambda batch: match_batch(batch, keywords, no_lowercase_keywords, matcher)),
+        ('segment', keyword_based_segmentation),
+        ('score', score)
+    ], queue_size)
+    counts = None
+    for scored in pipeline.run(batches):
+        counts = merge_counts(counts, count_sentiments(scored))
+    pipeline.report()
+    if counts is None:
+        counts = pd.Series(dtype='int64', index=pd.MultiIndex.from_tuples([], names=['subreddit', 'keyword', 'sentiment']))
+    return drop_rare_brands(counts) if remove_rare_brands else counts
+
+
+def drop_rare_brands(counts):
+    '''
+    Counterpart of data_fetcher.remove_brand_by_threshold for sentiment counts.
+
+    :param counts: Series of sentiment counts indexed by 'subreddit', 'keyword' and 'sentiment'.
+    :return: Series without the brands counted fewer than BRAND_THRESHOLD times in total.
+    '''
+    rare_brands = find_rare_brands(counts.groupby(level='keyword', observed=True).sum())
+    print(f'Deleted brands: {rare_brands.tolist()}')
+    return counts[~counts.index.get_level_values('keyword').isin(rare_brands)]
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        import analysis
+        import itertools
+        from data_fetcher import iter_chunks, iter_old_comments
+        from sentiment_cache import SentimentCache
+        from visualization import prep_data_from_counts, vis_one, vis_three, vis_two
+
+        brands = ['Argon 18', 'Bianchi', 'BMC', 'Cannondale', 'Canyon', 'Cervelo', 'Cinelli', 'Colnago', 'Cube',
+                  'Giant', 'Merida', 'Orbea', 'Pinarello', 'Ridley', 'Rose', 'Scott', 'Specialized', 'Trek',
+                  'Ventum', 'Wilier']
+        no_lowercase = ['Cube', 'Giant', 'Rose']
+        model_path = 'cardiffnlp/twitter-roberta-base-sentiment-latest'
+        analysis.sentiment_task = analysis.load_sentiment_task(model_path, 'onnx')
+
+        new_comments_df = pd.read_json(r'data/new_comments_temp.json')
+        batches = itertools.chain(iter_old_comments(chunk_size=20_000), iter_chunks(new_comments_df, 20_000))
+        counts = stream_sentiment_counts(batches, brands, no_lowercase, cache=SentimentCache(r'data/sentiment_cache.sqlite'),
+                                         model_id=analysis.sentiment_model_id(model_path, 'onnx'))
+        brand_df, sub_df, total = prep_data_from_counts(counts)
+        vis_one(brand_df, total)
+        vis_two(sub_df, total)
+        vis_three(brand_df, total)
@@ -1,10 +1,17 @@
-import httpx
+import json
+import metrics
 import pandas as pd
 import random
 import time
 from datetime import datetime, timezone
 
-def get_posts_from_2024(endpoint, category='/hot', last_after=None, onlyId=False):
+BASE_URL = 'https://www.reddit.com'
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
+}
+COMMENT_COLUMNS = ['subreddit', 'body', 'id', 'created_utc']  # id and creation time drive incremental runs
+
+def get_posts_from_2024(endpoint, category='/hot', last_after=None, onlyId=False, cache=None):
     '''
     This function gathers up to 1000 posts from a specified subreddit endpoint on Reddit. 
     It retrieves posts made within the year 2024 from the current runtime, excluding those posted before 2024. 
@@ -14,39 +21,23 @@ def get_posts_from_2024(endpoint, category='/hot', last_after=None, onlyId=False
     :param category: Optional string specifying the category of posts to retrieve ('/new', '/hot', or '/top', default is '/hot').
     :param last_after: Optional string indicating the after_post_id to continue scraping from a specific point.
     :param onlyId: Optional boolean. If True, returns a DataFrame with only the post IDs.
+    :param cache: Optional http_cache.ResponseCache serving and revalidating repeated requests.
     :return: A pandas DataFrame containing all post information or only the IDs if onlyId is True,
              along with the last after_post_id for continuation of scraping.
     '''
 
-    base_url = 'https://www.reddit.com'
-    url = base_url + endpoint + category + '.json'
-    if category == 'top/?t=year':
-        url = base_url + endpoint + '/top/' + '.json?t=year'
+    url = BASE_URL + listing_path(endpoint, category)
     dataset = []
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
-    }
     df = None
 
     for i in range(10): 
-        params = {
-            'limit' : 100,  # Max. amount of items per round, limited by the offical endpoint
-            't' : 'year',  # Only get posts that have been made during the last year (starting at runtime)
-            'after' : last_after  # after_post_id for next search iteration (each search is only about 25 items)
-        }
+        params = listing_params(last_after)
         try:
-            response = httpx.get(url, params = params, headers=headers)
-            json_data = response.json()
+            json_data = get_json(url, params, cache)
             dataset.extend([rec['data'] for rec in json_data['data']['children']])
             last_after = json_data['data']['after']
             print(f'Fetched {100 * i + 100} posts :)')
-            # Filtering out all posts made before 01.01.2024
-            df = pd.DataFrame(dataset)
-            start_date = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
-            df['created'] = df['created'].astype(float) 
-            df = df[df['created'] >= start_date]
-            if onlyId:
-                df = df[['id']]
+            df = posts_from_2024(dataset, onlyId)
         except: 
             print('Failed to fetch posts :(')
             #raise
@@ -57,29 +48,107 @@ def get_posts_from_2024(endpoint, category='/hot', last_after=None, onlyId=False
     return df
 
 
-def get_comments(post_id):
+def get_comments(post_id, cache=None):
     '''
     'Retrieves top-level comments associated with a Reddit post identified by post_id, excluding nested replies.'
 
     :param post_id: String representing the unique identifier of the Reddit post.
+    :param cache: Optional http_cache.ResponseCache, posts fetched before are served from it.
     :return: A pandas DataFrame containing subreddit and main comment body for each retrieved comment.
     '''
-    base_url = 'https://www.reddit.com/comments/'
-    url = base_url + post_id + '.json'
-    dataset = []
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36'
-    }
+    url = BASE_URL + comments_path(post_id)
     df = None
 
     try:
-        response = httpx.get(url, headers=headers)
-        json_data = response.json() 
-        comments_data = json_data[1]['data']['children']
-        dataset.extend([comment['data'] for comment in comments_data])
-        df = pd.DataFrame(dataset)[['subreddit', 'body']]
+        json_data = get_json(url, cache=cache)
+        df = comments_to_df(json_data)
         print('Fetched comments :)')
     except:
         print('Failed to fetch comments :(')
 
     return df
+
+
+# --- helper functions, shared with the async client ---
+def get_json(url, params=None, cache=None):
+    '''
+    Send a GET request, answering it from the cache or revalidating the cached response if possible.
+
+    :param url: String url of the request.
+    :param params: Optional dictionary of query parameters.
+    :param cache: Optional http_cache.ResponseCache.
+    :return: Parsed JSON response.
+    '''
+    import httpx  # the helpers below are shared without it, e.g. by scrape_journal
+
+    entry = cache.lookup(url, params) if cache else None
+    if entry is not None and cache.is_fresh(entry):
+        return json.loads(entry['body'])
+
+    headers = dict(HEADERS)
+    if entry is not None:
+        headers.update(cache.conditional_headers(entry))
+    metrics.count('http_requests')
+    response = httpx.get(url, params=params, headers=headers)
+    if response.status_code == 304 and entry is not None:
+        cache.mark_revalidated(entry)
+        return json.loads(entry['body'])
+    response.raise_for_status()
+    data = response.json()
+    if cache:
+        cache.store(url, params, response)
+    return data
+
+
+def listing_path(endpoint, category='/hot'):
+    '''
+    Build the path of a subreddit listing.
+
+    :param endpoint: String representing the subreddit endpoint in the format '/r/subreddit_name'.
+    :param category: String specifying the category of posts ('/new', '/hot', or 'top/?t=year').
+    :return: String path of the listing, relative to the Reddit base url.
+    '''
+    if category == 'top/?t=year':
+        return endpoint + '/top/' + '.json?t=year'
+    return endpoint + category + '.json'
+
+
+def listing_params(last_after=None):
+    return {
+        'limit' : 100,  # Max. amount of items per round, limited by the offical endpoint
+        't' : 'year',  # Only get posts that have been made during the last year (starting at runtime)
+        'after' : last_after  # after_post_id for next search iteration (each search is only about 25 items)
+    }
+
+
+def posts_from_2024(dataset, onlyId=False):
+    '''
+    Filter out all posts made before 01.01.2024.
+
+    :param dataset: List of post dictionaries as returned by a listing.
+    :param onlyId: Optional boolean. If True, returns a DataFrame with only the post IDs.
+    :return: A pandas DataFrame containing the remaining posts.
+    '''
+    df = pd.DataFrame(dataset)
+    start_date = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    df['created'] = df['created'].astype(float) 
+    df = df[df['created'] >= start_date]
+    if onlyId:
+        df = df[['id']]
+    return df
+
+
+def comments_path(post_id):
+    return '/comments/' + post_id + '.json'
+
+
+def comments_to_df(json_data):
+    '''
+    Extract the top-level comments from the JSON response of a post.
+
+    :param json_data: Parsed JSON response of a comments endpoint.
+    :return: A pandas DataFrame containing subreddit, main comment body, id and creation time for each comment.
+    '''
+    comments_data = json_data[1]['data']['children']
+    dataset = [comment['data'] for comment in comments_data]
+    return pd.DataFrame(dataset).reindex(columns=COMMENT_COLUMNS)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import pandas as pd
+import stage_cache
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+REPORT_DIR = 'data/report'
+FORMATS = ('png', 'svg')
+
+
+def chart_jobs(brand_df, sub_df, total, split_subreddits=True):
+    '''
+    Describe every chart of the report by the visualization function drawing it and its input.
+    The controversy scores are computed once for both charts using them.
+
+    :param brand_df: DataFrame brand_df returned by visualization.prep_data.
+    :param sub_df: DataFrame sub_df returned by visualization.prep_data.
+    :param total: Number of comments returned by visualization.prep_data.
+    :param split_subreddits: If True, every subreddit gets a chart of its own instead of one tall figure,
+                             so they are rendered in parallel.
+    :return: Dictionary mapping chart names to (function name, data, keyword arguments) tuples.
+    '''
+    from visualization import controversy_scores
+
+    scored, max_comments = controversy_scores(brand_df)
+    jobs = {
+        'vis1': ('vis_one', brand_df, {'total': total}),
+        'vis31': ('vis_three_radar', scored, {'total': total}),
+        'vis32': ('vis_three_scatter', scored, {'total': total, 'max_comments': max_comments})
+    }
+    if split_subreddits:
+        for subreddit in sub_df.loc[sub_df['total'] >= 100, 'subreddit'].unique():
+            # only the rows of the subreddit are hashed, other subreddits changing don't render it again
+            jobs[f'vis2_{subreddit}'] = ('vis_two', sub_df[sub_df['subreddit'] == subreddit].reset_index(drop=True),
+                                         {'total': total, 'subreddits': [subreddit]})
+    else:
+        jobs['vis2'] = ('vis_two', sub_df, {'total': total})
+    return jobs
+
+
+def chart_hash(function_name, data, kwargs, formats, dpi):
+    '''
+    :return: Hex digest of everything a chart depends on: its input aggregates, arguments, output formats
+             and the code of the visualization module.
+    '''
+    import visualization
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'function': function_name, 'kwargs': kwargs, 'columns': list(data.columns),
+                              'formats': list(formats), 'dpi': dpi,
+                              'code': stage_cache.file_fingerprint(visualization.__file__)},
+                             sort_keys=True, default=str).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def render_report(brand_df, sub_df, total, output_dir=REPORT_DIR, formats=FORMATS, workers=None, dpi=100,
+                  split_subreddits=True, force=False):
+    '''
+    Render all charts headless with the Agg backend and write them to files. Independent charts are
+    rendered in parallel processes. Charts whose input hasn't changed since the last render, according
+    to the manifest in output_dir, are skipped.
+
+    :param brand_df: DataFrame brand_df returned by visualization.prep_data.
+    :param sub_df: DataFrame sub_df returned by visualization.prep_data.
+    :param total: Number of comments returned by visualization.prep_data.
+    :param output_dir: Directory of the chart files and the manifest.
+    :param formats: File formats every chart is written in, e.g. ('png', 'svg').
+    :param workers: Number of rendering processes, defaults to the number of cores. 1 renders in this process.
+    :param dpi: Resolution of raster formats.
+    :param split_subreddits: If True, every subreddit gets a chart of its own, see chart_jobs.
+    :param force: If True, all charts are rendered even if they are up to date.
+    :return: Dictionary mapping chart names to the list of their files and whether they were rendered or skipped.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as file:
+            manifest = json.load(file)
+
+    results = {}
+    pending = {}
+    for name, (function_name, data, kwargs) in chart_jobs(brand_df, sub_df, total, split_subreddits).items():
+        digest = chart_hash(function_name, data, kwargs, formats, dpi)
+        paths = [os.path.join(output_dir, f'{name}.{file_format}') for file_format in formats]
+        entry = manifest.get(name)
+        if not force and entry and entry['hash'] == digest and all(os.path.exists(path) for path in paths):
+            results[name] = {'files': paths, 'status': 'skipped'}
+            continue
+        pending[name] = (function_name, data, kwargs, paths, dpi, digest)
+
+    start = time.perf_counter()
+    workers = min(workers or os.cpu_count(), len(pending))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {name: executor.submit(_render_chart, *job[:5]) for name, job in pending.items()}
+            for name, future in futures.items():
+                future.result()
+    else:
+        for job in pending.values():
+            _render_chart(*job[:5])
+
+    for name, (_, _, _, paths, _, digest) in pending.items():
+        manifest[name] = {'hash': digest, 'files': paths, 'rendered_at': time.time()}
+        results[name] = {'files': paths, 'status': 'rendered'}
+    temp_path = manifest_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temp_path, manifest_path)  # the manifest only lists charts whose files were written
+    print(f'Rendered {len(pending)} charts in {time.perf_counter() - start:.1f}s with {max(workers, 1)} processes, '
+          f'skipped {len(results) - len(pending)} unchanged ones')
+    return results
+
+
+def _render_chart(function_name, data, kwargs, paths, dpi):
+    import matplotlib
+
+    matplotlib.use('Agg')  # no display on batch nodes, and no window waiting to be closed
+    matplotlib.rcParams['savefig.dpi'] = dpi
+    import visualization
+
+    getattr(visualization, function_name)(data, output=paths, **kwargs)
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        from visualization import prep_data
+
+        brand_df, sub_df, total = prep_data(stage_cache.load_artifact('sentiment_filtered'))
+        render_report(brand_df, sub_df, total)
@@ -0,0 +1,216 @@
+import json
+import numpy as np
+import pandas as pd
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MicroBatcher:
+    '''
+    Collects the comments of concurrent requests into micro-batches scored by a single thread,
+    so the model stays warm and runs on full batches instead of one request at a time.
+    A batch is closed once it holds max_batch_size comments or max_wait seconds after its first request.
+    '''
+
+    def __init__(self, score_rows, max_batch_size=64, max_wait=0.01, window=10_000):
+        '''
+        :param score_rows: Function scoring a DataFrame of comments, e.g. analysis.analyse_sentiment.
+        :param max_batch_size: Number of comments that closes a batch immediately.
+        :param max_wait: Maximum number of seconds a request waits for others to join its batch.
+        :param window: Number of recent requests and batches the latency and fill metrics are computed over.
+        '''
+        self.score_rows = score_rows
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.request_count = 0
+        self.comment_count = 0
+        self.batch_count = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, rows):
+        '''
+        :param rows: DataFrame of comments with at least a 'comment' column.
+        :return: Future resolving to the scored DataFrame.
+        '''
+        future = Future()
+        self.requests.put((rows, future, time.perf_counter()))
+        return future
+
+    def metrics(self):
+        '''
+        :return: Dictionary with request, comment and batch counters, p50/p99 request latency in
+                 milliseconds and the mean batch size and fill relative to max_batch_size.
+        '''
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            report = {'requests': self.request_count, 'comments': self.comment_count, 'batches': self.batch_count,
+                      'errors': self.errors, 'queued': self.requests.qsize()}
+        if len(latencies):
+            report['latency_p50_ms'] = float(np.percentile(latencies, 50))
+            report['latency_p99_ms'] = float(np.percentile(latencies, 99))
+        if len(batch_sizes):
+            report['mean_batch_size'] = float(batch_sizes.mean())
+            report['mean_batch_fill'] = float(np.minimum(batch_sizes / self.max_batch_size, 1).mean())
+        return report
+
+    def _collect(self):
+        # block for the first request, then wait at most max_wait for others to fill the batch
+        batch = [self.requests.get()]
+        size = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+            size += len(batch[-1][0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                # anything raised here has to reach the futures, an exception ending this thread would hang them all
+                rows = pd.concat([request[0] for request in batch], ignore_index=True)
+                scored = self.score_rows(rows)
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                with self.lock:
+                    self.errors += len(batch)
+                continue
+
+            done = time.perf_counter()
+            start = 0
+            for request_rows, future, _ in batch:
+                future.set_result(scored.iloc[start:start + len(request_rows)].reset_index(drop=True))
+                start += len(request_rows)
+            with self.lock:
+                self.latencies.extend(done - submitted for _, _, submitted in batch)
+                self.request_count += len(batch)
+                self.comment_count += len(rows)
+                self.batch_count += 1
+                self.batch_sizes.append(len(rows))
+
+
+class ScoringHandler(BaseHTTPRequestHandler):
+    '''
+    POST /score with {"comments": [{"comment": ..., ...}], "filter": false} returns {"results": [...]},
+    every row with its 'sentiment' and 'score' added. With "filter": true only the rows kept by
+    analysis.filter_sentiment are returned. GET /metrics returns the batcher metrics.
+    '''
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self._reply(404, {'error': 'not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            rows = pd.DataFrame([{'comment': row} if isinstance(row, str) else row for row in request['comments']])
+            if len(rows) and 'comment' not in rows:
+                raise KeyError('comment')
+        except (ValueError, KeyError, TypeError) as error:
+            return self._reply(400, {'error': f'invalid request: {error!r}'})
+        if not len(rows):
+            return self._reply(200, {'results': []})
+
+        try:
+            scored = self.server.batcher.submit(rows).result()
+        except Exception as error:
+            return self._reply(500, {'error': f'scoring failed: {error!r}'})
+        if request.get('filter'):
+            from analysis import filter_sentiment
+
+            scored = filter_sentiment(scored, remove_rare_brands=False)
+        self._reply(200, {'results': json.loads(scored.to_json(orient='records'))})
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            return self._reply(404, {'error': 'not found'})
+        self._reply(200, self.server.batcher.metrics())
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the metrics
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class ScoringServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default of 5 drops connections of concurrent clients into SYN retries
+
+
+def create_server(score_rows, host='127.0.0.1', port=8000, max_batch_size=64, max_wait=0.01):
+    '''
+    :param score_rows: Function scoring a DataFrame of comments, see MicroBatcher.
+    :param host: Host name the server binds to.
+    :param port: Port the server listens on, 0 picks a free one.
+    :param max_batch_size: Number of comments that closes a batch immediately.
+    :param max_wait: Maximum number of seconds a request waits for others to join its batch.
+    :return: ScoringServer with a 'batcher' attribute, not yet serving.
+    '''
+    server = ScoringServer((host, port), ScoringHandler)
+    server.batcher = MicroBatcher(score_rows, max_batch_size, max_wait)
+    return server
+
+
+def serve(model_path, backend='torch', host='127.0.0.1', port=8000, max_batch_size=64, max_wait=0.01,
+          cache_path=None):
+    '''
+    Load the sentiment model once and score comments over HTTP until interrupted.
+
+    :param model_path: Hugging Face model id or local directory.
+    :param backend: Inference backend, see analysis.load_sentiment_task.
+    :param host: Host name the server binds to.
+    :param port: Port the server listens on.
+    :param max_batch_size: Number of comments that closes a batch immediately.
+    :param max_wait: Maximum number of seconds a request waits for others to join its batch.
+    :param cache_path: Optional path of a SentimentCache shared with the batch runs.
+    '''
+    import analysis
+    from sentiment_cache import SentimentCache
+
+    analysis.sentiment_task = analysis.load_sentiment_task(model_path, backend)
+    cache = SentimentCache(cache_path) if cache_path else None
+    model_id = analysis.sentiment_model_id(model_path, backend)
+
+    def score_rows(rows):
+        return analysis.analyse_sentiment(rows, token_budget=max_batch_size * 128, cache=cache, model_id=model_id,
+                                          verbose=False)
+
+    server = create_server(score_rows, host, port, max_batch_size, max_wait)
+    print(f'Scoring service listening on http://{host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f'Metrics: {server.batcher.metrics()}')
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        serve('cardiffnlp/twitter-roberta-base-sentiment-latest', backend='onnx', max_batch_size=64, max_wait=0.01,
+              cache_path=r'data/sentiment_cache.sqlite')
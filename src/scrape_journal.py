@@ -0,0 +1,137 @@
+import json
+import os
+import pandas as pd
+import time
+from reddit_scraper import COMMENT_COLUMNS
+
+
+class ScrapeJournal:
+    '''
+    Append-only journal of scraped posts. Every completed post is written as one JSON line holding
+    its id and comments, so an interrupted scrape can resume where it stopped.
+    Writes are flushed and fsynced in batches. Use it as context manager.
+    '''
+
+    def __init__(self, path, fsync_every=25):
+        '''
+        :param path: String path of the journal file, created if it doesn't exist.
+        :param fsync_every: Number of appended posts after which the journal is synced to disk.
+        '''
+        self.path = path
+        self.fsync_every = fsync_every
+        self.completed = set()
+        self.unsynced = 0
+        self.file = None
+
+    def __enter__(self):
+        self.completed = set(_recover(self.path))
+        self.file = open(self.path, 'a', encoding='utf-8')
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sync()
+        self.file.close()
+
+    def append(self, post_id, comments):
+        '''
+        Record the comments of a completed post. Posts without a DataFrame (failed fetches)
+        are not recorded, so they are fetched again on the next run.
+
+        :param post_id: String id of the post.
+        :param comments: DataFrame with columns 'subreddit', 'body', 'id' and 'created_utc' or None.
+        '''
+        if comments is None or post_id in self.completed:
+            return
+        comments = comments.reindex(columns=COMMENT_COLUMNS).astype(object)
+        record = {'post_id': post_id, 'comments': comments.where(comments.notna(), None).to_dict('records')}
+        self.file.write(json.dumps(record) + '\n')
+        self.completed.add(post_id)
+        self.unsynced += 1
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+
+    def sync(self):
+        '''
+        Flush buffered records and fsync the journal.
+        '''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+
+def compact_journal(path, post_ids=None):
+    '''
+    Turn a journal into one DataFrame of comments.
+
+    :param path: String path of the journal file.
+    :param post_ids: Optional list of post ids, defines which posts are kept and their order.
+                     Defaults to all posts in journal order.
+    :return: DataFrame with columns 'subreddit', 'body', 'id' and 'created_utc', the latter two are missing
+             in journals written before they were recorded.
+    '''
+    comments_by_post = {}
+    for post_id, comments in _records(path):
+        comments_by_post.setdefault(post_id, comments)
+
+    if post_ids is None:
+        post_ids = list(comments_by_post)
+    rows = [comment for post_id in post_ids for comment in comments_by_post.get(post_id, [])]
+    return pd.DataFrame(rows, columns=COMMENT_COLUMNS)
+
+
+def archive_journal(path, companion_paths=()):
+    '''
+    Move the journal of a finished scrape and files belonging to its run, e.g. the list of its posts,
+    out of the way by adding a timestamp to their names. The next scrape starts a new run instead of
+    resuming this one.
+
+    :param path: String path of the journal file.
+    :param companion_paths: Paths of further files of the run, archived with the same timestamp.
+    :return: String path of the archived journal or None if there was no journal.
+    '''
+    suffix = time.strftime('%Y%m%dT%H%M%S')
+    archived = None
+    for file_path in [path, *companion_paths]:
+        if os.path.exists(file_path):
+            os.replace(file_path, f'{file_path}.{suffix}')
+            if file_path == path:
+                archived = f'{file_path}.{suffix}'
+    return archived
+
+
+def _records(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                return  # torn last line of an interrupted run
+            yield record['post_id'], record['comments']
+
+
+def _recover(path):
+    '''
+    Read the ids of all completed posts and cut off a torn last line left by a crash,
+    so new records are appended after the last complete one.
+    '''
+    if not os.path.exists(path):
+        return []
+    post_ids = []
+    valid_bytes = 0
+    with open(path, 'rb') as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            if not line.endswith(b'\n'):
+                break
+            post_ids.append(record['post_id'])
+            valid_bytes += len(line)
+    if valid_bytes != os.path.getsize(path):
+        print(f'Dropping incomplete record at the end of {path}')
+        with open(path, 'r+b') as file:
+            file.truncate(valid_bytes)
+    return post_ids
@@ -0,0 +1,68 @@
+import hashlib
+import sqlite3
+
+
+class SentimentCache:
+    '''
+    Persistent cache of sentiment results in a SQLite file, keyed by a hash of the text and the model id,
+    so re-runs and incremental runs only score texts they haven't seen before.
+    '''
+
+    def __init__(self, path='data/sentiment_cache.sqlite'):
+        '''
+        :param path: String path of the SQLite file, created if it doesn't exist.
+        '''
+        # the scoring service uses the cache from its batching thread, never from two threads at once
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS sentiment (
+                text_hash TEXT NOT NULL,
+                model_id TEXT NOT NULL,
+                label TEXT NOT NULL,
+                score REAL NOT NULL,
+                PRIMARY KEY (text_hash, model_id)
+            )''')
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, texts, model_id):
+        '''
+        Look up the cached results of several texts.
+
+        :param texts: List of texts.
+        :param model_id: String identifying the model that scored the texts.
+        :return: Dictionary mapping every cached text to a result dictionary with 'label' and 'score'.
+        '''
+        hashes = {text_hash(text): text for text in texts}
+        found = {}
+        keys = list(hashes)
+        for start in range(0, len(keys), 500):  # stay below SQLite's limit of query parameters
+            chunk = keys[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f'SELECT text_hash, label, score FROM sentiment WHERE model_id = ? AND text_hash IN ({placeholders})',
+                [model_id] + chunk)
+            for key, label, score in rows:
+                found[hashes[key]] = {'label': label, 'score': score}
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, results, model_id):
+        '''
+        Store the results of several texts.
+
+        :param results: Dictionary mapping texts to result dictionaries with 'label' and 'score'.
+        :param model_id: String identifying the model that scored the texts.
+        '''
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO sentiment VALUES (?, ?, ?, ?)',
+                [(text_hash(text), model_id, result['label'], float(result['score'])) for text, result in results.items()])
+
+    def close(self):
+        self.connection.close()
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
@@ -0,0 +1,139 @@
+import itertools
+import metrics
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+_worker_settings = None
+
+
+def _init_worker(model_path, backend, threads, token_budget, max_length, quantize):
+    global _worker_settings
+    # pin every thread pool of the worker before torch or onnxruntime start theirs
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+    import analysis
+
+    if backend == 'torch':
+        import torch
+
+        torch.set_num_threads(threads)
+        torch.set_num_interop_threads(1)
+    analysis.sentiment_task = analysis.load_sentiment_task(model_path, backend, quantize=quantize, threads=threads,
+                                                           max_length=max_length)
+    _worker_settings = (token_budget, max_length)
+
+
+def _score_shard(texts):
+    import analysis
+    import metrics
+
+    start = time.perf_counter()
+    counters_before = metrics.counters()
+    results = analysis.score_texts(texts, *_worker_settings)
+    # counters of the worker process are lost, the parent counts what this shard added
+    counter_deltas = {name: value - counters_before.get(name, 0) for name, value in metrics.counters().items()}
+    return results, os.getpid(), time.perf_counter() - start, counter_deltas
+
+
+def iter_sharded_scores(texts, model_path, backend='torch', workers=2, threads_per_worker=None, shard_size=2048,
+                        token_budget=16_384, max_length=512, quantize=True):
+    '''
+    Score texts in worker processes, each loading the model once with a pinned number of threads.
+    Shards are handed out lazily and their results are yielded in the order of texts.
+
+    :param texts: List of strings.
+    :param model_path: Hugging Face model id or local directory.
+    :param backend: Inference backend, see analysis.load_sentiment_task.
+    :param workers: Number of worker processes.
+    :param threads_per_worker: Number of threads per worker, defaults to splitting the cores evenly.
+    :param shard_size: Number of texts per shard.
+    :param token_budget: Maximum number of (padded) tokens per batch within a worker.
+    :param max_length: Number of tokens texts are truncated to.
+    :param quantize: If True, the ONNX backend runs the int8 quantized export.
+    :return: Generator of result lists, one per shard.
+    '''
+    if backend == 'onnx':
+        import analysis
+
+        # export once here, workers exporting at the same time would write the same files
+        analysis.ensure_onnx_export(model_path, quantize=quantize)
+    threads_per_worker = threads_per_worker or max(1, os.cpu_count() // workers)
+    shards = (texts[start:start + shard_size] for start in range(0, len(texts), shard_size))
+    pending = deque()
+    # spawn instead of fork, forking a process with running torch threads can deadlock
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(model_path, backend, threads_per_worker, token_budget, max_length, quantize)) as executor:
+        for shard in itertools.chain(shards, [None]):
+            if shard is not None:
+                pending.append(executor.submit(_score_shard, shard))
+            while pending and (shard is None or len(pending) >= 2 * workers):
+                results, pid, seconds, counter_deltas = pending.popleft().result()
+                for name, amount in counter_deltas.items():
+                    metrics.count(name, amount)
+                print(f'Worker {pid}: {len(results)} texts in {seconds:.1f}s')
+                yield results
+
+
+def score_texts_sharded(texts, model_path, backend='torch', workers=2, threads_per_worker=None, shard_size=2048,
+                        token_budget=16_384, max_length=512, quantize=True):
+    '''
+    Score texts with iter_sharded_scores and merge the shards.
+
+    :return: List of result dictionaries with 'label' and 'score', in the order of texts.
+    '''
+    results = []
+    for shard_results in iter_sharded_scores(texts, model_path, backend, workers, threads_per_worker, shard_size,
+                                             token_budget, max_length, quantize):
+        results.extend(shard_results)
+    return results
+
+
+def benchmark_splits(texts, model_path, backend='torch', cores=None, shard_size=256):
+    '''
+    Find the split of cores into worker processes and threads per worker with the highest throughput.
+    Every split using all cores is timed on the given sample. Timing starts when the first shard
+    returns, so model loading is mostly left out.
+
+    :param texts: List of strings used as sample, at least two shards per worker of the split with the most workers.
+    :param model_path: Hugging Face model id or local directory.
+    :param backend: Inference backend, see analysis.load_sentiment_task.
+    :param cores: Number of cores to split, defaults to all cores of the machine.
+    :param shard_size: Number of texts per shard.
+    :return: Tuple (workers, threads_per_worker) of the fastest split.
+    '''
+    cores = cores or os.cpu_count()
+    if len(texts) < 2 * shard_size * cores:
+        # the first shard isn't timed, with fewer texts some workers would time nothing
+        raise ValueError(f'Sample of {len(texts)} texts is too small, {cores} workers need at least '
+                         f'{2 * shard_size * cores} texts with shards of {shard_size}')
+    throughput = {}
+    for workers in [n for n in range(1, cores + 1) if cores % n == 0]:
+        threads = cores // workers
+        start = None
+        timed = 0
+        for shard_results in iter_sharded_scores(texts, model_path, backend, workers, threads, shard_size):
+            if start is None:
+                start = time.perf_counter()
+            else:
+                timed += len(shard_results)
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        throughput[(workers, threads)] = timed / elapsed
+        print(f'{workers} workers x {threads} threads: {throughput[(workers, threads)]:.1f} texts/s')
+
+    best = max(throughput, key=throughput.get)
+    print(f'Best split: {best[0]} workers x {best[1]} threads')
+    return best
+
+
+if __name__ == '__main__':
+    RUNNABLE = False  # prevent faulty execution
+
+    if RUNNABLE:
+        import stage_cache
+
+        sample = stage_cache.load_artifact('segmented')['comment'].sample(5000, random_state=42).tolist()
+        benchmark_splits(sample, 'cardiffnlp/twitter-roberta-base-sentiment-latest', backend='onnx')
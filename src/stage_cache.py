@@ -0,0 +1,219 @@
+import hashlib
+import json
+import metrics
+import os
+
+STAGE_DIR = 'data/stages'
+
+
+def file_fingerprint(path):
+    '''
+    Hash the content of a file, used as input of the first pipeline stage.
+
+    :param path: String path of the file.
+    :return: Hex digest of the file content.
+    '''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def stage_key(stage, inputs, params):
+    '''
+    Compute the content address of a stage artifact from everything it depends on.
+
+    :param stage: String name of the stage.
+    :param inputs: List of keys of upstream artifacts or fingerprints of input files.
+    :param params: JSON serializable dictionary of parameters influencing the output.
+    :return: Hex digest identifying the artifact.
+    '''
+    description = json.dumps({'stage': stage, 'inputs': list(inputs), 'params': params}, sort_keys=True)
+    return hashlib.sha256(description.encode('utf-8')).hexdigest()
+
+
+def artifact_path(stage, key):
+    return os.path.join(STAGE_DIR, f'{stage}-{key[:16]}.arrow')
+
+
+def save_artifact(df, stage, key):
+    '''
+    Write a stage output as Arrow IPC file and remember it as the latest output of the stage.
+
+    :param df: DataFrame to be stored, its index is dropped.
+    :param stage: String name of the stage.
+    :param key: Key of the artifact as returned by stage_key.
+    '''
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    path = artifact_path(stage, key)
+    temp_path = path + '.tmp'
+    df.reset_index(drop=True).to_feather(temp_path)
+    os.replace(temp_path, path)  # never leave a half written artifact behind
+    _set_latest(stage, key)
+
+
+def save_artifact_batches(batches, stage, key, schema=None):
+    '''
+    Write a stage output batch by batch, for outputs too large to be held in memory at once.
+
+    :param batches: Iterable of DataFrames with the same columns.
+    :param stage: String name of the stage.
+    :param key: Key of the artifact as returned by stage_key.
+    :param schema: Optional pyarrow schema of the output. Without it, the schema is taken from the first batches,
+                   batches are held back while a column has only missing values and thus no type yet.
+    :return: Number of rows written.
+    '''
+    import pyarrow as pa
+
+    os.makedirs(STAGE_DIR, exist_ok=True)
+    path = artifact_path(stage, key)
+    temp_path = path + '.tmp'
+    writer = None
+    held_back = []
+    rows = 0
+    try:
+        for batch in batches:
+            table = pa.Table.from_pandas(batch, preserve_index=False)
+            rows += len(batch)
+            if writer is None:
+                held_back.append(table)
+                if schema is None and any(pa.types.is_null(field.type) for field in table.schema):
+                    schema_so_far = pa.unify_schemas([held.schema for held in held_back])
+                    if any(pa.types.is_null(field.type) for field in schema_so_far):
+                        continue
+                writer, schema = _open_writer(temp_path, held_back, schema)
+                held_back = []
+            else:
+                writer.write_table(table.cast(schema))
+        if writer is None and held_back:  # columns missing in every batch stay of null type
+            writer, schema = _open_writer(temp_path, held_back, schema)
+        if writer is None:
+            raise ValueError(f'No batches to store for stage {stage}')
+        writer.close()
+        writer = None
+        os.replace(temp_path, path)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)  # never leave a half written artifact behind
+    _set_latest(stage, key)
+    return rows
+
+
+def _open_writer(temp_path, tables, schema=None):
+    import pyarrow as pa
+
+    if schema is None:
+        # the pandas metadata of a null column would turn its values back into an empty dtype
+        schema = pa.unify_schemas([table.schema for table in tables]).with_metadata(tables[-1].schema.metadata)
+    writer = pa.ipc.new_file(temp_path, schema)
+    for table in tables:
+        writer.write_table(table.cast(schema))
+    return writer, schema
+
+
+def load_artifact(stage, key=None):
+    '''
+    Load a stage output. The Arrow file is memory-mapped, so reading it doesn't parse anything.
+
+    :param stage: String name of the stage.
+    :param key: Optional key of the artifact, defaults to the latest output of the stage.
+    :return: DataFrame stored for the stage.
+    '''
+    from pyarrow import feather
+
+    key = key or latest_key(stage)
+    return feather.read_table(artifact_path(stage, key), memory_map=True).to_pandas()
+
+
+def iter_artifact(stage, key=None):
+    '''
+    Load a stage output batch by batch from the memory-mapped file, e.g. to stream it into the next stage.
+
+    :param stage: String name of the stage.
+    :param key: Optional key of the artifact, defaults to the latest output of the stage.
+    :return: Generator of DataFrames, one per record batch of the artifact.
+    '''
+    import pyarrow as pa
+
+    key = key or latest_key(stage)
+    reader = pa.ipc.open_file(pa.memory_map(artifact_path(stage, key)))
+    for i in range(reader.num_record_batches):
+        yield reader.get_batch(i).to_pandas()
+
+
+def latest_key(stage):
+    '''
+    :param stage: String name of the stage.
+    :return: Key of the latest stored output of the stage.
+    '''
+    latest = _read_latest()
+    if stage not in latest:
+        raise FileNotFoundError(f'No artifact stored for stage {stage}, run it first')
+    return latest[stage]
+
+
+def run_stage(stage, compute, inputs, params):
+    '''
+    Run a pipeline stage unless an artifact for the same inputs and parameters already exists.
+
+    :param stage: String name of the stage.
+    :param compute: Function without arguments returning the stage output as DataFrame.
+    :param inputs: List of keys of upstream artifacts or fingerprints of input files.
+    :param params: JSON serializable dictionary of parameters influencing the output.
+    :return: Tuple of the stage output and its key, to be passed on as input of the next stage.
+    '''
+    key = stage_key(stage, inputs, params)
+    if os.path.exists(artifact_path(stage, key)):
+        print(f'Stage {stage} is up to date, loading {artifact_path(stage, key)}')
+        metrics.count('stage_cache_hits')
+        _set_latest(stage, key)
+        return load_artifact(stage, key), key
+
+    metrics.count('stage_cache_misses')
+    df = compute()
+    save_artifact(df, stage, key)
+    return load_artifact(stage, key), key
+
+
+def run_stage_batches(stage, compute, inputs, params, schema=None):
+    '''
+    Counterpart of run_stage for outputs written batch by batch, see save_artifact_batches.
+
+    :param stage: String name of the stage.
+    :param compute: Function without arguments returning an iterable of DataFrames.
+    :param inputs: List of keys of upstream artifacts or fingerprints of input files.
+    :param params: JSON serializable dictionary of parameters influencing the output.
+    :param schema: Optional pyarrow schema of the output, see save_artifact_batches.
+    :return: Key of the output, its batches are read with iter_artifact.
+    '''
+    key = stage_key(stage, inputs, params)
+    if os.path.exists(artifact_path(stage, key)):
+        print(f'Stage {stage} is up to date, keeping {artifact_path(stage, key)}')
+        metrics.count('stage_cache_hits')
+        _set_latest(stage, key)
+        return key
+
+    metrics.count('stage_cache_misses')
+    rows = save_artifact_batches(compute(), stage, key, schema)
+    print(f'Stage {stage}: stored {rows} rows in {artifact_path(stage, key)}')
+    return key
+
+
+def _read_latest():
+    path = os.path.join(STAGE_DIR, 'latest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def _set_latest(stage, key):
+    latest = _read_latest()
+    if latest.get(stage) == key:
+        return
+    latest[stage] = key
+    with open(os.path.join(STAGE_DIR, 'latest.json'), 'w', encoding='utf-8') as file:
+        json.dump(latest, file, indent=2)
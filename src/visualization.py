@@ -1,58 +1,117 @@
-import matplotlib.pyplot as plt
+import metrics
 import pandas as pd
-import seaborn as sns
 import numpy as np
+import stage_cache
 
 def prep_data(data):
-    # vis 1
-    sentiment_brand_dict = {}
+    return prep_data_from_counts(count_sentiments(data))
+
+
+def count_sentiments(data):
+    '''
+    Count comments per subreddit, brand and sentiment.
+    Counts of several batches can be added up with merge_counts.
+
+    :param data: DataFrame with columns 'subreddit', 'keyword' and 'sentiment', plain or categorical.
+    :return: Series of counts indexed by 'subreddit', 'keyword' and 'sentiment', only combinations that occur.
+    '''
+    return data.groupby(['subreddit', 'keyword', 'sentiment'], sort=False, observed=True).size()
+
+
+def merge_counts(counts, other):
+    '''
+    :param counts: Series returned by count_sentiments, or None.
+    :param other: Series returned by count_sentiments.
+    :return: Series with the counts of both added up.
+    '''
+    if counts is None:
+        return other
+    return counts.add(other, fill_value=0).astype('int64')
+
+
+def prep_data_from_counts(counts):
+    '''
+    Build the tables of the charts from sentiment counts instead of comment rows.
+
+    :param counts: Series returned by count_sentiments or merge_counts.
+    :return: Tuple (brand_df, sub_df, comment_count), see prep_data.
+    '''
+    with metrics.stage('prep_data', rows_in=len(counts)) as record:
+        # the counts are small, plain strings keep categories that don't occur out of the tables and charts
+        counts = counts.rename('count').reset_index().astype({'subreddit': object, 'keyword': object, 'sentiment': object})
+
+        # vis 1
+        is_positive = counts['sentiment'] == 'positive'
+        brand_df = pd.DataFrame({
+            'brand': counts['keyword'],
+            'positive': counts['count'].where(is_positive, 0),
+            'negative': counts['count'].where(~is_positive, 0),
+            'total': counts['count']
+        }).groupby('brand', sort=False)[['positive', 'negative', 'total']].sum().reset_index()
+        brand_df["positive_ratio"] = (brand_df["positive"]/brand_df["total"]).round(4)
+        brand_df["negative_ratio"] = 1 - brand_df["positive_ratio"]
+
+
+        # vis 2
+        grouped_df = counts.groupby(["subreddit", "keyword", "sentiment"])['count'].sum().reset_index()
+        sub_df = grouped_df.pivot_table(index=['subreddit', 'keyword'], columns='sentiment', values='count', fill_value=0).reset_index()
+        sub_df = sub_df.astype({'positive': 'int', 'negative': 'int'})
+
+        sub_df.columns.name = None
+        sub_df["total"] = sub_df["positive"] + sub_df["negative"]
+        sub_df["positive_ratio"] = (sub_df["positive"]/sub_df["total"]).round(4)
+        sub_df["negative_ratio"] = 1 - sub_df["positive_ratio"]
+        # swaparoo
+        sub_df["positive"], sub_df["negative"] = sub_df["negative"], sub_df["positive"]
+        sub_df = sub_df.rename(columns={"positive": "temp_column", "negative": "positive"})
+        sub_df = sub_df.rename(columns={"temp_column": "negative"})
+
+        # vis 3
+        comment_count = int(counts['count'].sum())
+
+        record.rows_out = len(sub_df)
+
+        print(f"Dataframe Brand - Vis 1:\n{brand_df}")
+        print("--------------------------------------------------------------------------------------------------")
+        print(f"Dataframe Sub - Vis 2:\n{sub_df}")
+        print("--------------------------------------------------------------------------------------------------")
+        print(f"Total amount of comments: {comment_count}")
 
-    for _, row in data.iterrows():
-        brand = row["keyword"]
-        sentiment = row["sentiment"]
-
-        if brand not in sentiment_brand_dict:
-            sentiment_brand_dict[brand] = {"pos": 0, "neg": 0, "total": 0}
-
-        if sentiment == "positive":
-            sentiment_brand_dict[brand]["pos"] += 1
-        else:
-            sentiment_brand_dict[brand]["neg"] += 1
+    return brand_df, sub_df, comment_count
 
-        sentiment_brand_dict[brand]["total"] += 1
 
-    brand_df = pd.DataFrame([(brand, counts["pos"], counts["neg"], counts["total"]) for brand, counts in sentiment_brand_dict.items()], columns=["brand", "positive", "negative", "total"])
-    brand_df["positive_ratio"] = (brand_df["positive"]/brand_df["total"]).round(4)
-    brand_df["negative_ratio"] = 1 - brand_df["positive_ratio"]
+def save_or_show(fig, output=None):
+    '''
+    :param fig: Matplotlib figure of a chart.
+    :param output: None to show the figure, or a path or list of paths (e.g. a .png and an .svg)
+                   the figure is saved to before it is closed.
+    '''
+    import matplotlib.pyplot as plt
 
+    if output is None:
+        plt.show()
+        return
+    for path in [output] if isinstance(output, str) else output:
+        fig.savefig(path)
+    plt.close(fig)
 
-    # vis 2
-    grouped_df = data.groupby(["subreddit", "keyword", "sentiment"]).size().reset_index(name="count")
-    sub_df = grouped_df.pivot_table(index=['subreddit', 'keyword'], columns='sentiment', values='count', fill_value=0).reset_index()
-    sub_df = sub_df.astype({'positive': 'int', 'negative': 'int'})
 
-    sub_df.columns.name = None
-    sub_df["total"] = sub_df["positive"] + sub_df["negative"]
-    sub_df["positive_ratio"] = (sub_df["positive"]/sub_df["total"]).round(4)
-    sub_df["negative_ratio"] = 1 - sub_df["positive_ratio"]
-    # swaparoo
-    sub_df["positive"], sub_df["negative"] = sub_df["negative"], sub_df["positive"]
-    sub_df = sub_df.rename(columns={"positive": "temp_column", "negative": "positive"})
-    sub_df = sub_df.rename(columns={"temp_column": "negative"})
+def controversy_scores(data):
+    '''
+    :param data: DataFrame brand_df returned by prep_data.
+    :return: Tuple (copy of data with a 'controversy_score' column, maximum comments the score is relative to).
+    '''
+    # calculate maximum comments
+    max_comments = max(data['total']) * 1.1
 
-    # vis 3
-    comment_count = len(data)
+    # calculate controversy score
+    scored = data.assign(controversy_score=(data['negative'] / data['total']) * (1 - (data['total'] / max_comments)))
+    return scored, max_comments
 
-    print(f"Dataframe Brand - Vis 1:\n{brand_df}")
-    print("--------------------------------------------------------------------------------------------------")
-    print(f"Dataframe Sub - Vis 2:\n{sub_df}")
-    print("--------------------------------------------------------------------------------------------------")
-    print(f"Total amount of comments: {comment_count}")
 
-    return brand_df, sub_df, comment_count
-    
+def vis_one(data, total, output=None):
+    import matplotlib.pyplot as plt
 
-def vis_one(data, total):
     df = data.sort_values(by="positive_ratio", ascending=True)
     print(df)
     brands = [ 'Bianchi', 'BMC',
@@ -101,12 +160,19 @@ def vis_one(data, total):
     plt.text(0.165, 0.97, 'r/cycling, r/bicycling, r/RoadBikes', transform=ax.transAxes, ha='center', fontsize=13, style='italic')
     ax.axis('off')
 
-    plt.show()
+    save_or_show(fig, output)
+
 
+def vis_two(data, total, output=None, subreddits=None):
+    '''
+    :param subreddits: Optional list of the subreddits drawn, defaults to all of them in one figure.
+    '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
-def vis_two(data, total):
     data = data[data['total'] >= 100]
-    subreddits = data['subreddit'].unique()
+    if subreddits is None:
+        subreddits = data['subreddit'].unique()
 
     fig, axes = plt.subplots(len(subreddits), 2, figsize=(14, 6 * len(subreddits)), gridspec_kw={'hspace': 0.4})
     if len(subreddits) == 1:
@@ -145,19 +211,27 @@ def vis_two(data, total):
     plt.figtext(0.5, 0.01, "Note: Brands with fewer than 100 comments are filtered out.", ha='center', fontsize=12, fontstyle='italic')
 
     plt.tight_layout(rect=[0, 0.03, 1, 0.97])
-    plt.show()
+    save_or_show(fig, output)
 
 
 
 
-def vis_three(data, total):
-   # calculate maximum comments
-    max_comments = max(data['total']) * 1.1
+def vis_three(data, total, output=None):
+    '''
+    Draw the controversy scores as radar and as scatter chart, the scores are computed once for both.
 
-    # calculate controversy score
-    data['controversy_score'] = (data['negative'] / data['total']) * (1 - (data['total'] / max_comments))
+    :param output: Optional pair of outputs of the radar and the scatter chart, see save_or_show.
+    '''
+    scored, max_comments = controversy_scores(data)
+    radar_output, scatter_output = output or (None, None)
+    vis_three_radar(scored, total, radar_output)
+    vis_three_scatter(scored, total, max_comments, scatter_output)
+
+
+def vis_three_radar(data, total, output=None):
+    import matplotlib.pyplot as plt
 
-    # sort data by controversy score
+    # sort data by controversy score, see controversy_scores
     df_sorted = data.sort_values(by='controversy_score', ascending=False)
 
     # number of variables (brands) and angles for the radar chart
@@ -203,18 +277,17 @@ def vis_three(data, total):
 
     # add formula below the title
     plt.tight_layout()
-    plt.show()
-    # calculate maximum comments
-    max_comments = max(data['total']) * 1.1
+    save_or_show(fig, output)
 
-    # calculate controversy score
-    data['controversy_score'] = (data['negative'] / data['total']) * (1 - (data['total'] / max_comments))
 
-    # sort data by controversy score
+def vis_three_scatter(data, total, max_comments, output=None):
+    import matplotlib.pyplot as plt
+
+    # sort data by controversy score, see controversy_scores
     df_sorted = data.sort_values(by='controversy_score', ascending=True)
 
     # plotting the data
-    plt.figure(figsize=(10, 8))
+    fig = plt.figure(figsize=(10, 8))
 
     # scatter plot
     plt.scatter(df_sorted['controversy_score'], df_sorted['brand'], color='skyblue', marker='o', s=100, alpha=0.75)
@@ -238,13 +311,13 @@ def vis_three(data, total):
     plt.figtext(0.55, 0.83, max_comments_text, ha='center', fontsize=12, color='gray')
 
     plt.tight_layout()
-    plt.show()
+    save_or_show(fig, output)
 
 if __name__ == '__main__':
     RUNNABLE = True  # prevent faulty execution and data overwriting
 
     if RUNNABLE:   
-        data = pd.read_json(r'data/sentiment_filtered.json', orient='records', lines=True)
+        data = stage_cache.load_artifact('sentiment_filtered')
         brand_df, sub_df, total = prep_data(data)
         # vis_one(brand_df, total)
         # vis_two(sub_df, total)
@@ -0,0 +1,63 @@
+import json
+import os
+import pytest
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# the modules of src are imported flat, as the scripts in src import each other
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, so pooled connections are reused
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.log.append((self.path, self.client_address[1], time.monotonic()))
+            server.headers.append(dict(self.headers))
+            responses = server.routes.get(self.path.split('?')[0], [(404, {}, {}, 0)])
+            status, headers, body, delay = responses.pop(0) if len(responses) > 1 else responses[0]
+        time.sleep(delay)
+        payload = b'' if status == 304 else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    '''
+    Local stand-in of the Reddit API. Tests map paths to lists of (status, headers, body, delay) responses,
+    which are served in order, the last one repeatedly.
+    '''
+    stand_in = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    stand_in.daemon_threads = True
+    stand_in.routes = {}
+    stand_in.log = []
+    stand_in.headers = []  # request headers, in the order of log
+    stand_in.lock = threading.Lock()
+    stand_in.url = f'http://127.0.0.1:{stand_in.server_address[1]}'
+    thread = threading.Thread(target=stand_in.serve_forever, daemon=True)
+    thread.start()
+    yield stand_in
+    stand_in.shutdown()
+    stand_in.server_close()
+
+
+def comments_body(post_id, count=2):
+    '''
+    :return: Body of a comments response of the stand-in server.
+    '''
+    return [{}, {'data': {'children': [{'data': {'subreddit': 'cycling', 'body': f'{post_id} comment {i}',
+                                                 'id': f'{post_id}_{i}', 'created_utc': 1718000000.0 + i}}
+                                       for i in range(count)]}}]
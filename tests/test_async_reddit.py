@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+from async_reddit import AsyncRedditClient, TokenBucket, fetch_comments
+from conftest import comments_body
+
+
+@pytest.fixture(autouse=True)
+def no_jitter(monkeypatch):
+    monkeypatch.setattr('async_reddit.random.random', lambda: 0.0)
+
+
+def fast_limiter():
+    return TokenBucket(rate=1000, capacity=1000)
+
+
+def test_requests_share_pooled_connections(server):
+    post_ids = [f'p{i}' for i in range(20)]
+    for post_id in post_ids:
+        server.routes[f'/comments/{post_id}.json'] = [(200, {}, comments_body(post_id), 0.02)]
+
+    async def run():
+        async with AsyncRedditClient(server.url, rate_limiter=fast_limiter(), max_connections=2) as client:
+            results = await fetch_comments(client, post_ids, concurrency=10)
+        return client, results
+
+    client, results = asyncio.run(run())
+    assert client.requests == 20
+    assert all(len(comments) == 2 for comments in results)
+    assert len({port for _, port, _ in server.log}) <= 2  # 20 requests over at most two keep-alive connections
+
+
+def test_retry_after_is_respected_on_429(server):
+    server.routes['/comments/a.json'] = [(429, {'Retry-After': '0.5'}, {}, 0), (200, {}, comments_body('a'), 0)]
+
+    async def run():
+        async with AsyncRedditClient(server.url, rate_limiter=fast_limiter(), backoff=0.01) as client:
+            comments = await client.get_comments('a')
+        return client, comments
+
+    client, comments = asyncio.run(run())
+    assert client.retries == 1
+    assert comments['body'].tolist() == ['a comment 0', 'a comment 1']
+    (_, _, first), (_, _, second) = server.log
+    assert second - first >= 0.5
+
+
+def test_server_errors_back_off_exponentially(server):
+    server.routes['/comments/a.json'] = [(503, {}, {}, 0), (503, {}, {}, 0), (200, {}, comments_body('a'), 0)]
+
+    async def run():
+        async with AsyncRedditClient(server.url, rate_limiter=fast_limiter(), backoff=0.1) as client:
+            await client.get_comments('a')
+        return client
+
+    client = asyncio.run(run())
+    assert client.retries == 2
+    times = [timestamp for _, _, timestamp in server.log]
+    assert times[1] - times[0] >= 0.1
+    assert times[2] - times[1] >= 0.2
+
+
+def test_client_errors_are_not_retried(server):
+    server.routes['/comments/gone.json'] = [(404, {}, {}, 0)]
+
+    async def run():
+        async with AsyncRedditClient(server.url, rate_limiter=fast_limiter(), backoff=0.01) as client:
+            comments = await client.get_comments('gone')
+        return client, comments
+
+    client, comments = asyncio.run(run())
+    assert comments is None
+    assert client.requests == 1 and client.retries == 0
+
+
+def test_exhausted_rate_limit_blocks_until_reset(server):
+    server.routes['/comments/a.json'] = [(200, {'X-Ratelimit-Remaining': '0', 'X-Ratelimit-Reset': '0.5'},
+                                          comments_body('a'), 0)]
+    server.routes['/comments/b.json'] = [(200, {}, comments_body('b'), 0)]
+
+    async def run():
+        async with AsyncRedditClient(server.url, rate_limiter=fast_limiter()) as client:
+            await client.get_comments('a')
+            await client.get_comments('b')
+
+    asyncio.run(run())
+    (_, _, first), (_, _, second) = server.log
+    assert second - first >= 0.5
+
+
+def test_rate_follows_ratelimit_headers():
+    limiter = TokenBucket(rate=1, capacity=5)
+    limiter.update_from_headers({'x-ratelimit-remaining': '30', 'x-ratelimit-reset': '60'})
+    assert limiter.rate == pytest.approx(0.5)
+    limiter.update_from_headers({'x-ratelimit-remaining': 'soon'})  # malformed headers are ignored
+    assert limiter.rate == pytest.approx(0.5)
+
+
+def test_fetch_comments_keeps_post_order(server):
+    post_ids = [f'p{i}' for i in range(8)]
+    for index, post_id in enumerate(post_ids):
+        # earlier posts answer slower, so they complete last
+        server.routes[f'/comments/{post_id}.json'] = [(200, {}, comments_body(post_id, 1), 0.02 * (8 - index))]
+    server.routes['/comments/p3.json'] = [(404, {}, {}, 0)]
+
+    async def run():
+        async with AsyncRedditClient(server.url, rate_limiter=fast_limiter()) as client:
+            collected = await fetch_comments(client, post_ids, concurrency=8)
+            handed_over = []
+            await fetch_comments(client, post_ids, concurrency=8,
+                                 on_result=lambda post_id, comments: handed_over.append(post_id))
+        return collected, handed_over
+
+    collected, handed_over = asyncio.run(run())
+    assert collected[3] is None
+    assert [comments['body'][0] for comments in collected if comments is not None] == \
+           [f'{post_id} comment 0' for post_id in post_ids if post_id != 'p3']
+    assert sorted(handed_over) == sorted(post_ids)
+    assert handed_over[0] != 'p0'  # handed over as soon as fetched, not in post order
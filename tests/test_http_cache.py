@@ -0,0 +1,81 @@
+import json
+import time
+from conftest import comments_body
+from http_cache import ResponseCache
+from reddit_scraper import get_json
+
+PATH = '/comments/a.json'
+
+
+def test_fresh_entry_is_served_without_request(server, tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=3600)
+    server.routes[PATH] = [(200, {}, comments_body('a'), 0)]
+
+    first = get_json(server.url + PATH, cache=cache)
+    assert get_json(server.url + PATH, cache=cache) == first
+    assert len(server.log) == 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+
+def test_etag_revalidation(server, tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=0)
+    server.routes[PATH] = [(200, {'ETag': '"v1"'}, comments_body('a'), 0), (304, {'ETag': '"v1"'}, {}, 0)]
+
+    first = get_json(server.url + PATH, cache=cache)
+    assert get_json(server.url + PATH, cache=cache) == first
+    assert server.headers[1]['If-None-Match'] == '"v1"'
+    assert cache.stats()['revalidated'] == 1 and cache.stats()['misses'] == 1 and cache.stats()['hits'] == 0
+
+
+def test_last_modified_revalidation(server, tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=0)
+    modified = 'Mon, 03 Jun 2024 10:00:00 GMT'
+    server.routes[PATH] = [(200, {'Last-Modified': modified}, comments_body('a'), 0), (304, {}, {}, 0)]
+
+    first = get_json(server.url + PATH, cache=cache)
+    assert get_json(server.url + PATH, cache=cache) == first
+    assert server.headers[1]['If-Modified-Since'] == modified
+    assert 'If-None-Match' not in server.headers[1]
+    assert cache.stats()['revalidated'] == 1
+
+
+def test_changed_response_replaces_stale_entry(server, tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=0)
+    server.routes[PATH] = [(200, {'ETag': '"v1"'}, comments_body('a', 1), 0),
+                           (200, {'ETag': '"v2"'}, comments_body('a', 2), 0), (304, {}, {}, 0)]
+
+    get_json(server.url + PATH, cache=cache)
+    assert get_json(server.url + PATH, cache=cache) == comments_body('a', 2)
+    assert get_json(server.url + PATH, cache=cache) == comments_body('a', 2)  # served from the replaced entry
+    assert server.headers[2]['If-None-Match'] == '"v2"'
+    assert cache.stats()['misses'] == 2 and cache.stats()['revalidated'] == 1
+
+
+def test_least_recently_used_entries_are_evicted(server, tmp_path):
+    for post_id in 'abc':
+        server.routes[f'/comments/{post_id}.json'] = [(200, {}, comments_body(post_id), 0)]
+    size = len(json.dumps(comments_body('a')))
+    cache = ResponseCache(str(tmp_path), ttl=3600, max_bytes=int(size * 2.5))
+
+    get_json(server.url + '/comments/a.json', cache=cache)
+    time.sleep(0.01)
+    get_json(server.url + '/comments/b.json', cache=cache)
+    time.sleep(0.01)
+    get_json(server.url + '/comments/a.json', cache=cache)  # a is now used more recently than b
+    time.sleep(0.01)
+    get_json(server.url + '/comments/c.json', cache=cache)
+    assert cache.stats()['evictions'] == 1 and cache.stats()['bytes'] == 2 * size
+
+    requests = len(server.log)
+    get_json(server.url + '/comments/a.json', cache=cache)
+    assert len(server.log) == requests
+    get_json(server.url + '/comments/b.json', cache=cache)
+    assert len(server.log) == requests + 1
+
+
+def test_size_is_restored_from_disk(server, tmp_path):
+    server.routes[PATH] = [(200, {}, comments_body('a'), 0)]
+    cache = ResponseCache(str(tmp_path))
+    get_json(server.url + PATH, cache=cache)
+    assert ResponseCache(str(tmp_path)).stats() == {'hits': 0, 'revalidated': 0, 'misses': 0, 'evictions': 0,
+                                                    'bytes': cache.stats()['bytes']}
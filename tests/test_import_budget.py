@@ -0,0 +1,6 @@
+from benchmark import check_import_times
+
+
+def test_imports_stay_within_budget():
+    # fails when a module imports too slowly or pulls in a heavy dependency at import time
+    assert check_import_times() == []
@@ -0,0 +1,125 @@
+import json
+import pandas as pd
+import pytest
+import threading
+import time
+import urllib.error
+import urllib.request
+from load_generator import get_metrics, run_load, send_request
+from scoring_service import MicroBatcher, create_server
+
+
+class StubScorer:
+    '''
+    Labels comments containing 'good' positive and all others neutral, remembering the size of every batch.
+    '''
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def __call__(self, rows):
+        if rows['comment'].str.contains('boom').any():
+            raise RuntimeError('model failed')
+        time.sleep(self.delay)
+        self.batch_sizes.append(len(rows))
+        scored = rows.copy()
+        scored['sentiment'] = ['positive' if 'good' in comment else 'neutral' for comment in rows['comment']]
+        scored['score'] = 0.9
+        return scored
+
+
+def rows(*comments):
+    return pd.DataFrame({'comment': list(comments)})
+
+
+@pytest.fixture
+def service():
+    scorer = StubScorer()
+    server = create_server(scorer, port=0, max_batch_size=8, max_wait=0.02)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}', scorer
+    server.shutdown()
+    server.server_close()
+
+
+def test_requests_are_merged_up_to_max_batch_size():
+    scorer = StubScorer()
+    batcher = MicroBatcher(scorer, max_batch_size=4, max_wait=1.0)
+    futures = [batcher.submit(rows(f'comment {i}')) for i in range(10)]
+    results = [future.result(timeout=5) for future in futures]
+    # the first request waits for the queue to fill, the last two wait until max_wait closes their batch
+    assert scorer.batch_sizes == [4, 4, 2]
+    assert [result['comment'].tolist() for result in results] == [[f'comment {i}'] for i in range(10)]
+    assert batcher.metrics()['batches'] == 3 and batcher.metrics()['requests'] == 10
+
+
+def test_batch_is_closed_after_max_wait():
+    scorer = StubScorer()
+    batcher = MicroBatcher(scorer, max_batch_size=100, max_wait=0.1)
+    start = time.perf_counter()
+    result = batcher.submit(rows('good bike', 'old bike')).result(timeout=5)
+    assert time.perf_counter() - start >= 0.1
+    assert scorer.batch_sizes == [2]
+    assert result['sentiment'].tolist() == ['positive', 'neutral']
+
+
+def test_results_are_split_back_per_request():
+    scorer = StubScorer(delay=0.05)
+    batcher = MicroBatcher(scorer, max_batch_size=100, max_wait=0.05)
+    futures = [batcher.submit(rows(*[f'request {i} comment {j}' for j in range(i + 1)])) for i in range(5)]
+    for i, future in enumerate(futures):
+        result = future.result(timeout=5)
+        assert result['comment'].tolist() == [f'request {i} comment {j}' for j in range(i + 1)]
+        assert result.index.tolist() == list(range(i + 1))
+    assert sum(scorer.batch_sizes) == 15
+
+
+def test_errors_reach_every_request_of_the_batch():
+    batcher = MicroBatcher(StubScorer(), max_batch_size=100, max_wait=0.05)
+    futures = [batcher.submit(rows('fine')), batcher.submit(rows('boom')), batcher.submit(rows('fine too'))]
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+    assert batcher.metrics()['errors'] == 3
+    assert batcher.submit(rows('good again')).result(timeout=5)['sentiment'].tolist() == ['positive']
+
+
+def test_failing_merge_does_not_stop_the_batcher():
+    batcher = MicroBatcher(StubScorer(), max_batch_size=100, max_wait=0.01)
+    with pytest.raises(TypeError):
+        batcher.submit(['not a DataFrame']).result(timeout=5)
+    assert batcher.submit(rows('good')).result(timeout=5)['sentiment'].tolist() == ['positive']
+
+
+def test_score_endpoint(service):
+    url, _ = service
+    results = send_request(url, ['good ride', {'comment': 'flat tire', 'keyword': 'Trek'}])
+    assert [result['sentiment'] for result in results] == ['positive', 'neutral']
+    assert results[1]['keyword'] == 'Trek'
+    assert send_request(url, []) == []
+    filtered = send_request(url, ['good ride', 'flat tire'], filter_results=True)
+    assert [result['comment'] for result in filtered] == ['good ride']
+
+
+@pytest.mark.parametrize('payload', [b'not json', b'{"no_comments": []}', b'{"comments": [{"body": "x"}]}',
+                                     b'{"comments": 5}'])
+def test_bad_requests_are_rejected(service, payload):
+    url, scorer = service
+    request = urllib.request.Request(f'{url}/score', data=payload, headers={'Content-Type': 'application/json'})
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request, timeout=5)
+    assert error.value.code == 400
+    assert 'invalid request' in json.loads(error.value.read())['error']
+    assert scorer.batch_sizes == []
+
+
+def test_concurrent_load_is_batched(service):
+    url, scorer = service
+    report = run_load(url, [f'good comment {i}' for i in range(50)], clients=8, requests_per_client=5,
+                      comments_per_request=(1, 3))
+    assert report['client']['requests'] == 40 and report['client']['errors'] == 0
+    assert report['service']['requests'] == 40
+    assert len(scorer.batch_sizes) < 40  # concurrent requests share batches
+    assert get_metrics(url)['errors'] == 0
@@ -0,0 +1,60 @@
+import os
+import pandas as pd
+from conftest import comments_body
+from data_fetcher import get_comments_from_2024
+from scrape_journal import ScrapeJournal, compact_journal
+
+FAST = {'X-Ratelimit-Remaining': '1000', 'X-Ratelimit-Reset': '1'}
+
+
+def serve_posts(server, post_ids):
+    listing = {'data': {'children': [{'data': {'id': post_id, 'created': 1718000000.0}} for post_id in post_ids],
+                        'after': None}}
+    server.routes = {'/r/cycling/new.json': [(200, FAST, listing, 0)]}
+    for post_id in post_ids:
+        server.routes[f'/comments/{post_id}.json'] = [(200, FAST, comments_body(post_id, 1), 0)]
+
+
+def scrape(server, tmp_path):
+    return get_comments_from_2024(server.url, journal_path=str(tmp_path / 'comments.journal'), cache_dir=None,
+                                  ids_path=str(tmp_path / 'ids.json'))
+
+
+def test_finished_scrape_is_archived(server, tmp_path):
+    serve_posts(server, ['a', 'b'])
+    assert scrape(server, tmp_path)['body'].tolist() == ['a comment 0', 'b comment 0']
+    assert not os.path.exists(tmp_path / 'comments.journal') and not os.path.exists(tmp_path / 'ids.json')
+    assert sorted(name.split('.')[0] for name in os.listdir(tmp_path)) == ['comments', 'ids']
+
+    serve_posts(server, ['c'])  # the next run sees the new posts instead of resuming the finished one
+    assert scrape(server, tmp_path)['body'].tolist() == ['c comment 0']
+
+
+def test_interrupted_scrape_resumes(server, tmp_path):
+    pd.DataFrame({'id': ['a', 'b']}).to_json(tmp_path / 'ids.json')
+    with ScrapeJournal(str(tmp_path / 'comments.journal')) as journal:
+        journal.append('a', pd.DataFrame({'subreddit': ['cycling'], 'body': ['journaled a']}))
+    serve_posts(server, ['a', 'b', 'c'])
+
+    comments = scrape(server, tmp_path)
+    assert comments['body'].tolist() == ['journaled a', 'b comment 0']
+    assert [path for path, _, _ in server.log] == ['/comments/b.json']
+
+
+def test_journal_without_post_ids_is_not_resumed(server, tmp_path):
+    with ScrapeJournal(str(tmp_path / 'comments.journal')) as journal:
+        journal.append('a', pd.DataFrame({'subreddit': ['cycling'], 'body': ['stale a']}))
+    serve_posts(server, ['a'])
+    assert scrape(server, tmp_path)['body'].tolist() == ['a comment 0']
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    path = str(tmp_path / 'comments.journal')
+    with ScrapeJournal(path) as journal:
+        journal.append('a', pd.DataFrame({'subreddit': ['cycling'], 'body': ['a']}))
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write('{"post_id": "b", "comm')
+    with ScrapeJournal(path) as journal:
+        assert journal.completed == {'a'}
+        journal.append('b', pd.DataFrame({'subreddit': ['cycling'], 'body': ['b']}))
+    assert compact_journal(path)['body'].tolist() == ['a', 'b']